@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+'''Benchmark the scraping scripts using the pages from their tests.
+
+Pages are built from the HTML used by the tests of
+emag-resigilate-filter.py and ubuntu-l10n-review-notifications.py,
+repeated --scale times, so no network access is needed.
+
+Each benchmark runs in a separate process, so that its peak memory usage
+can be measured. Results are printed and can be saved as JSON for
+comparing runs.
+
+It depends on the same modules as the benchmarked scripts.
+
+Distributed under WTFPL 2.0.
+'''
+
+import imp
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+
+# Folder containing the benchmarked scripts.
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Number of times the test pages are repeated.
+BENCHMARK_SCALE = 50
+# Minimum time, in seconds, for running each benchmark.
+BENCHMARK_MIN_TIME = 1.0
+# Filter used for the filter_products benchmark.
+BENCHMARK_EXPRESSION = 'price<8000,name~PRODUCT,attr2-name!~ani'
+
+
+def load_script(name):
+    '''Return the module for script `name` from SCRIPTS_DIRECTORY.'''
+    if SCRIPTS_DIRECTORY not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIRECTORY)
+    module_name = name.replace('-', '_').replace('.py', '')
+    return imp.load_source(module_name, os.path.join(SCRIPTS_DIRECTORY, name))
+
+
+def get_emag_pages(emag, scale):
+    '''Return a dictionary of page path to (content, products_fetcher).'''
+    return {
+        emag.EMAG_RESIGILATE_PATH: (
+            emag.TEST_RESIGILATE_PAGE * scale,
+            emag.get_all_resigilate_products_from_page_content),
+        emag.EMAG_LICHIDARI_PATH: (
+            (emag.TEST_LICHIDARI_PRODUCT +
+                emag.TEST_LICHIDARI_DISCOUNT_PRODUCT) * scale,
+            emag.get_all_lichidari_products_from_page_content),
+        }
+
+
+def get_reviews_page(ubuntu, scale):
+    '''Return the TEST_REVIEWS_PAGE with its rows repeated `scale` times.'''
+    page = ubuntu.TEST_REVIEWS_PAGE
+    rows = page[page.index('<tr'):page.rindex('</tr>') + len('</tr>')]
+    return page.replace(rows, rows * scale)
+
+
+def setup_emag_parse_page(engine, page_path):
+    '''Return the benchmark for parsing a page with one of the emag
+    PAGE_PARSERS.'''
+    def setup(scale):
+        emag = load_script('emag-resigilate-filter.py')
+        content, products_fetcher = get_emag_pages(emag, scale)[page_path]
+        page_parser = emag.PAGE_PARSERS[engine]
+
+        def run():
+            return len(page_parser(content, page_path, products_fetcher)[1])
+        return run
+    return setup
+
+
+def setup_emag_get_product(scale):
+    emag = load_script('emag-resigilate-filter.py')
+    content, products_fetcher = get_emag_pages(
+        emag, scale)[emag.EMAG_RESIGILATE_PATH]
+    products_divs = emag.create_soup(content).findAll(
+        'div', {'style': 'height:auto; position:relative;'})
+
+    def run():
+        for product_div in products_divs:
+            emag.get_product(product_div)
+        return len(products_divs)
+    return run
+
+
+def get_emag_products(emag, scale):
+    '''Return the products from the resigilate and lichidari pages.'''
+    products = []
+    for page_path, page in sorted(get_emag_pages(emag, scale).items()):
+        content, products_fetcher = page
+        products.extend(emag.parse_page_with_stream(
+            content, page_path, products_fetcher)[1])
+    return products
+
+
+def setup_emag_filter_products(scale):
+    emag = load_script('emag-resigilate-filter.py')
+    products = get_emag_products(emag, scale)
+    expression = emag.parse_expression(BENCHMARK_EXPRESSION)
+
+    def run():
+        emag.filter_products(products, expression)
+        return len(products)
+    return run
+
+
+def setup_emag_products_to_string(scale):
+    emag = load_script('emag-resigilate-filter.py')
+    products = get_emag_products(emag, scale)
+
+    def run():
+        emag.list_products_stream(products, StringIO())
+        return len(products)
+    return run
+
+
+def setup_ubuntu_parse_page(engine):
+    '''Return the benchmark for parsing a page with one of the ubuntu
+    PAGE_PARSERS.'''
+    def setup(scale):
+        ubuntu = load_script('ubuntu-l10n-review-notifications.py')
+        content = get_reviews_page(ubuntu, scale)
+        page_parser = ubuntu.PAGE_PARSERS[engine]
+
+        def run():
+            return len(page_parser(content)[0])
+        return run
+    return setup
+
+
+def setup_ubuntu_get_page_reviews(scale):
+    ubuntu = load_script('ubuntu-l10n-review-notifications.py')
+    page = ubuntu.create_soup(get_reviews_page(ubuntu, scale))
+
+    def run():
+        return len(ubuntu.get_page_reviews(page)[0])
+    return run
+
+
+def setup_ubuntu_list_rss(scale):
+    ubuntu = load_script('ubuntu-l10n-review-notifications.py')
+    reviews = ubuntu.parse_page_with_stream(get_reviews_page(ubuntu, scale))[0]
+
+    def run():
+        ubuntu.list_rss(reviews, u'lucid', u'ro', StringIO())
+        ubuntu.reviews_to_string(reviews)
+        return len(reviews)
+    return run
+
+
+# Benchmark names and the functions returning the benchmarked function.
+# The benchmarked function returns the number of processed items.
+BENCHMARKS = [
+    ('emag.parse_page.soup.resigilate', setup_emag_parse_page(
+        'soup', 'resigilate')),
+    ('emag.parse_page.soup.lichidari', setup_emag_parse_page(
+        'soup', 'lichidari')),
+    ('emag.parse_page.stream.resigilate', setup_emag_parse_page(
+        'stream', 'resigilate')),
+    ('emag.parse_page.stream.lichidari', setup_emag_parse_page(
+        'stream', 'lichidari')),
+    ('emag.get_product', setup_emag_get_product),
+    ('emag.filter_products', setup_emag_filter_products),
+    ('emag.list_products', setup_emag_products_to_string),
+    ('ubuntu.parse_page.soup', setup_ubuntu_parse_page('soup')),
+    ('ubuntu.parse_page.stream', setup_ubuntu_parse_page('stream')),
+    ('ubuntu.get_page_reviews', setup_ubuntu_get_page_reviews),
+    ('ubuntu.list_rss', setup_ubuntu_list_rss),
+    ]
+
+
+def run_benchmark(setup, scale, min_time):
+    '''Return a dictionary with the results of the benchmark created by
+    `setup`.
+
+    The benchmarked function is called until `min_time` seconds pass.
+    '''
+    function = setup(scale)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    iterations = 0
+    items = 0
+    start_time = time.time()
+    while True:
+        items += function()
+        iterations += 1
+        duration = time.time() - start_time
+        if duration >= min_time:
+            break
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'iterations': iterations,
+        'seconds': duration,
+        'ops_per_second': iterations / duration,
+        'items_per_op': items / iterations,
+        'items_per_second': items / duration,
+        # Linux reports kilobytes.
+        'peak_rss_kb': rss_after,
+        'rss_increase_kb': rss_after - rss_before,
+        }
+
+
+def run_benchmark_in_child(setup, scale, min_time):
+    '''Run the benchmark in a forked process and return its results.'''
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        try:
+            result = run_benchmark(setup, scale, min_time)
+        except:
+            import traceback
+            result = {'error': traceback.format_exc()}
+        os.write(writer, json.dumps(result))
+        os.close(writer)
+        os._exit(0)
+
+    os.close(writer)
+    output = []
+    while True:
+        data = os.read(reader, 65536)
+        if not data:
+            break
+        output.append(data)
+    os.close(reader)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(output))
+
+
+def run_benchmarks(names=None, scale=BENCHMARK_SCALE,
+                   min_time=BENCHMARK_MIN_TIME, output=None):
+    '''Run all BENCHMARKS with a name starting with one of `names`.
+
+    Print the results to `output` and return them as a dictionary.
+    '''
+    if output is None:
+        output = sys.stdout
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'benchmarks': {},
+        }
+    for name, setup in BENCHMARKS:
+        if names and not [
+                prefix for prefix in names if name.startswith(prefix)]:
+            continue
+        result = run_benchmark_in_child(setup, scale, min_time)
+        results['benchmarks'][name] = result
+        if 'error' in result:
+            output.write('%s: FAILED\n%s\n' % (name, result['error']))
+            continue
+        output.write(
+            '%-36s %10.1f ops/s %12.1f items/s %8d KB peak\n' % (
+                name, result['ops_per_second'], result['items_per_second'],
+                result['peak_rss_kb']))
+    return results
+
+
+def test_run_benchmarks():
+    '''Test running the benchmarks.'''
+    output = StringIO()
+    results = run_benchmarks(
+        names=['emag.parse_page.stream', 'ubuntu'], scale=1, min_time=0,
+        output=output)
+    names = sorted(results['benchmarks'])
+    assert [
+        'emag.parse_page.stream.lichidari',
+        'emag.parse_page.stream.resigilate',
+        'ubuntu.get_page_reviews',
+        'ubuntu.list_rss',
+        'ubuntu.parse_page.soup',
+        'ubuntu.parse_page.stream',
+        ] == names
+    for name in names:
+        result = results['benchmarks'][name]
+        assert 'error' not in result, result['error']
+        assert result['iterations'] >= 1
+        assert result['peak_rss_kb'] > 0
+    assert 2 == results['benchmarks']['ubuntu.list_rss']['items_per_op']
+    assert 2 == results['benchmarks'][
+        'emag.parse_page.stream.resigilate']['items_per_op']
+    assert 6 == len(output.getvalue().splitlines())
+
+
+def run_all_tests(stop_on_failure):
+    '''Run all tests.'''
+    tests_count = 0
+    pass_count = 0
+    fail_count = 0
+    for name, function in sys.modules[__name__].__dict__.items():
+        if name.startswith('test_'):
+            tests_count += 1
+            print name + ': ',
+            try:
+                function()
+                pass_count += 1
+                print 'PASS'
+            except:
+                fail_count += 1
+                print 'FAIL'
+                if stop_on_failure:
+                    raise
+    print '--'
+    print 'Ran %d tests. %d PASSED. %d FAILED.' % (
+        tests_count, pass_count, fail_count)
+
+
+def get_options_or_print_help():
+    '''Get command line options or print help message and exit if unknow
+    options are passed.
+    '''
+    parser = OptionParser(usage='%prog [options] [BENCHMARK_PREFIX ...]')
+
+    parser.add_option(
+        '-o', '--output', action='store', type='string', dest='output',
+        default=None, metavar='FILE',
+        help='Save the results as JSON to FILE.')
+    parser.add_option(
+        '--scale', action='store', type='int', dest='scale',
+        default=BENCHMARK_SCALE, metavar='N',
+        help=(
+            'Repeat the test pages N times. Default %d.' % BENCHMARK_SCALE))
+    parser.add_option(
+        '--min-time', action='store', type='float', dest='min_time',
+        default=BENCHMARK_MIN_TIME, metavar='SECONDS',
+        help=(
+            'Run each benchmark for at least SECONDS. '
+            'Default %s.' % BENCHMARK_MIN_TIME))
+    parser.add_option(
+        '-l', '--list', action='store_true', dest='list', default=False,
+        help='List the benchmark names.')
+    parser.add_option(
+        '-t', '--run-tests', action='store_true', dest='test', default=False,
+        help='Run the (primitive) test suite.')
+    parser.add_option(
+        '--test-exit-on-failure', action='store_true',
+        dest='test_exit', default=False,
+        help='Exit tests on first failure.')
+
+    (options, args) = parser.parse_args()
+    return (options, args)
+
+
+if __name__ == "__main__":
+    options, names = get_options_or_print_help()
+
+    if options.test:
+        run_all_tests(options.test_exit)
+        sys.exit(0)
+
+    if options.list:
+        for name, setup in BENCHMARKS:
+            print name
+        sys.exit(0)
+
+    results = run_benchmarks(names, options.scale, options.min_time)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''Send the emails added to a mail spool by the scraping scripts.
+
+Scripts add emails to the spool when called with --mail-spool DIR.
+Run this script from cron, or with --watch, using the same DIR.
+Emails which could not be sent are tried again later.
+
+It depends on scraperlib.py from this repository.
+
+Distributed under WTFPL 2.0.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from scraperlib import (
+    EMAIL_PASSWORD, EMAIL_PORT, EMAIL_SERVER, EMAIL_TLS, EMAIL_USERNAME,
+    LocalSMTPServer, MailSpool, SMTPSession, SPOOL_MAX_ATTEMPTS)
+
+
+def deliver(spool, session):
+    '''Send all due emails from `spool` and print a summary.
+
+    Return the number of emails which could not be sent.
+    '''
+    sent_count, failed_count = spool.deliver(session)
+    session.close()
+    if sent_count or failed_count:
+        print '%s: sent %d emails, %d failed.' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), sent_count, failed_count)
+    return failed_count
+
+
+def test_deliver():
+    '''Test sending all emails from the spool.'''
+    directory = tempfile.mkdtemp()
+    server = LocalSMTPServer()
+    try:
+        spool = MailSpool(directory)
+        spool.add('from@example.com', ['to@example.com'], 'Message 1')
+        spool.add('from@example.com', ['to@example.com'], 'Message 2')
+        session = SMTPSession('127.0.0.1', server.port)
+        assert 0 == deliver(spool, session)
+        assert 2 == len(server.messages)
+        assert 1 == server.connections_count
+        assert [] == spool.get_names()
+        assert [] == os.listdir(spool.failed_directory)
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def run_all_tests(stop_on_failure):
+    '''Run all tests.'''
+    tests_count = 0
+    pass_count = 0
+    fail_count = 0
+    for name, function in sys.modules[__name__].__dict__.items():
+        if name.startswith('test_'):
+            tests_count += 1
+            print name + ': ',
+            try:
+                function()
+                pass_count += 1
+                print 'PASS'
+            except:
+                fail_count += 1
+                print 'FAIL'
+                if stop_on_failure:
+                    raise
+    print '--'
+    print 'Ran %d tests. %d PASSED. %d FAILED.' % (
+        tests_count, pass_count, fail_count)
+
+
+def get_options_or_print_help():
+    '''Get command line options or print help message and exit if unknow
+    options are passed.
+    '''
+    parser = OptionParser()
+
+    parser.add_option(
+        '-s', '--spool-dir', action='store', type='string', dest='spool_dir',
+        default=None, metavar='DIR',
+        help='Send the emails from the spool in DIR.')
+    parser.add_option(
+        '-w', '--watch', action='store', type='int', dest='watch',
+        default=None, metavar='SECONDS',
+        help=(
+            'Keep running and check the spool every SECONDS. '
+            'Emails failing %d times are moved to DIR/failed.' % (
+                SPOOL_MAX_ATTEMPTS)))
+    parser.add_option(
+        '-t', '--run-tests', action='store_true', dest='test', default=False,
+        help='Run the (primitive) test suite.')
+    parser.add_option(
+        '--test-exit-on-failure', action='store_true',
+        dest='test_exit', default=False,
+        help='Exit tests on first failure.')
+
+    (options, args) = parser.parse_args()
+    if len(args) > 0:
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return options
+
+
+if __name__ == "__main__":
+    options = get_options_or_print_help()
+
+    if options.test:
+        run_all_tests(options.test_exit)
+        sys.exit(0)
+
+    if options.spool_dir is None:
+        print 'The spool directory is required.'
+        print 'See --help for usage.'
+        sys.exit(2)
+
+    spool = MailSpool(options.spool_dir)
+    session = SMTPSession(
+        EMAIL_SERVER, EMAIL_PORT, EMAIL_TLS, EMAIL_USERNAME, EMAIL_PASSWORD)
+    if options.watch is None:
+        if deliver(spool, session):
+            sys.exit(1)
+        sys.exit(0)
+
+    while True:
+        deliver(spool, session)
+        time.sleep(options.watch)
@@ -1,21 +1,39 @@
 #!/usr/bin/env python
 '''This is the base code for scraping 'eMag resigilate' webpage
 
-It depends on re and BeatifulSoup.
+It depends on re, BeatifulSoup and scraperlib.py from this repository.
 
 See tests for valid input.
 
 Distributed under WTFPL 2.0.
 '''
 
+import hashlib
+import itertools
+import json
+import operator
+import os
+import pstats
+import random
 import re
+import shutil
+import sqlite3
 import sys
+import tempfile
+import time
 import urllib2
+from cStringIO import StringIO
 from email.mime.text import MIMEText
+from HTMLParser import HTMLParser
 from optparse import OptionParser
-from smtplib import SMTP, SMTPServerDisconnected
+from smtplib import SMTPException, SMTPServerDisconnected
 from socket import error as SocketError
 from BeautifulSoup import BeautifulSoup
+from scraperlib import (
+    AtomicFile, CACHE_MAX_MB, DiskCache, EMAIL_PASSWORD, EMAIL_PORT,
+    EMAIL_SERVER, EMAIL_TLS, EMAIL_USERNAME, HTTPCache, HTTPClient,
+    HTTP_RATE, LocalSMTPServer, MailSpool, MemoryCache, Profiler,
+    SMTPSession, Stats, parallel_imap, parallel_map)
 
 EMAG_BASE_URL = 'http://www.emag.ro'
 
@@ -24,23 +42,66 @@ EMAG_BASE_URL = 'http://www.emag.ro'
 EMAG_RESIGILATE_PATH = 'resigilate'
 EMAG_LICHIDARI_PATH = 'lichidari'
 
+# Statistics of the current run, saved with --stats-json.
+STATS = Stats()
+# HTTP client shared by all requests, keeping connections open between pages.
+HTTP_CLIENT = HTTPClient(stats=STATS)
+# Cache for products parsed from pages. Set to a ParsedPagesCache to avoid
+# parsing again pages which were not changed.
+PARSED_PAGES_CACHE = None
+# Part of --cache-max-mb used by PARSED_PAGES_CACHE. The rest is used for
+# the downloaded pages.
+PARSED_PAGES_CACHE_SHARE = 0.25
+# Number of pages of each category, from the last time its first pages were
+# fetched.
+CATEGORY_PAGES = {}
+# Version of the product dictionaries created by get_product.
+# Increase it when changing get_product, so that products parsed by older
+# versions are no longer used from PARSED_PAGES_CACHE.
+PRODUCT_SCHEMA_VERSION = 1
+# Name of the engine from PAGE_PARSERS used for parsing pages.
+PAGE_PARSER = 'soup'
+
 # Regular expression for search product attributes
 # group 1 should contain the name and group 2 the value
 # Attribute value can end with a new line, end of text or some <tag>
 EMAG_RESIGILATE_ATTRIBUTE_RE ='<strong>(.*)</strong>([^<]*)'
 
-# SMTP server used for sending emails.
-EMAIL_SERVER = '127.0.0.1'
-# SMTP server port.
-# Make sure your provider is not blocking port 25.
-# For Dreamhost you can use 587
-EMAIL_PORT = 25
-# Connect to SMTP server using TLS.
-EMAIL_TLS = False
-# SMTP username. Set None for not using SMTP authentication
-EMAIL_USERNAME = None
-#  SMTP password. Ignored if EMAIL_USERNAME is None.
-EMAIL_PASSWORD = ''
+# Tag and attributes of the element holding a product, for each page path.
+PRODUCT_CONTAINERS = {
+    EMAG_RESIGILATE_PATH: (
+        'div', {'style': 'height:auto; position:relative;'}),
+    EMAG_LICHIDARI_PATH: (
+        'form', {'action': 'https://www.emag.ro/addtocart', 'method': 'post'}),
+    }
+# Classes of div elements holding a price.
+PRODUCT_PRICE_ELEMENTS = ('pret-produs-listing-rsg', 'pret-produs-listing')
+# Name and attributes of span elements holding a price.
+PRODUCT_PRICE_SPANS = (
+    ('old-price', {'class': 'old-price'}),
+    ('old', {'class': 'old'}),
+    ('new', {'title': 'Pret nou'}),
+    )
+
+# With --watch, each category is checked again after the interval changed
+# by a random fraction of up to WATCH_JITTER, so that requests are spread.
+WATCH_JITTER = 0.2
+# With --watch-budget, categories are checked at least once every
+# WATCH_MAX_INTERVAL seconds, even if they never change.
+WATCH_MAX_INTERVAL = 24 * 60 * 60
+# Before being observed, a category is assumed to change once every
+# WATCH_PRIOR_SECONDS. Observations are added to this assumption.
+WATCH_PRIOR_SECONDS = 60 * 60
+# Observed changes of a category lose half their weight after
+# WATCH_HALF_LIFE seconds, so that the schedule follows recent changes.
+WATCH_HALF_LIFE = 7 * 24 * 60 * 60
+
+# SMTP session shared by all emails, keeping the connection open between
+# messages.
+SMTP_SESSION = SMTPSession(
+    EMAIL_SERVER, EMAIL_PORT, EMAIL_TLS, EMAIL_USERNAME, EMAIL_PASSWORD)
+# MailSpool where emails are added instead of being sent, or None.
+MAIL_SPOOL = None
 
 # Email address use to set the From email field.
 EMAIL_FROM = 'Resigilate Script <no-reply@example.com>'
@@ -69,68 +130,454 @@ RULE_REGEX = '~'
 RULE_REGEX_NOT = '!~'
 RULE_LESS = '<'
 RULE_GREATER = '>'
+# Relative cost of checking a rule, used to check cheap rules first.
+RULE_COSTS = {
+    RULE_LESS: 0,
+    RULE_GREATER: 0,
+    RULE_REGEX: 1,
+    RULE_REGEX_NOT: 1,
+    }
 
 
-def get_all_products(category_id=None):
+def get_all_products(category_id=None, jobs=1, expression=None):
     '''Returns a list of dictionaries containing all products in a
     category.
 
+    See iter_all_products.
+    '''
+    return list(iter_all_products(category_id, jobs, expression))
+
+
+def iter_all_products(category_id=None, jobs=1, expression=None):
+    '''Generate dictionaries for all products in a category, as soon as
+    their page is parsed.
+
+    Resigilate and lichidari pages are fetched at the same time, using at
+    most `jobs` concurrent requests.
+
+    When `expression` is an Expression, products which do not match it are
+    dropped while the pages are parsed.
+
     This function is a bit complicated to test since it requries to fetch
     multiple pages.
     '''
-    results = []
-    results.extend(
-        get_all_products_from_path(
-            EMAG_RESIGILATE_PATH,
-            get_all_resigilate_products_from_page_content,
-            category_id))
-    results.extend(
-        get_all_products_from_path(
-            EMAG_LICHIDARI_PATH,
-            get_all_lichidari_products_from_page_content,
-            category_id))
-    return results
+    for category_id, product in iter_categories_products(
+            [category_id], jobs, expression):
+        yield product
+
 
+def iter_categories_products(category_ids, jobs=1, expression=None):
+    '''Generate (category_id, product) tuples for all products in all
+    `category_ids`.
 
-def get_all_products_from_path(page_path, products_fetcher, category_id=None):
+    Pages from all categories share the same `jobs` concurrent requests.
+    Products are generated grouped by category, in the order of
+    `category_ids`.
+    '''
+    sources = []
+    for category_id in category_ids:
+        for page_path, products_fetcher in get_products_sources():
+            sources.append((page_path, products_fetcher, category_id))
+    for index, product in iter_sources_products(sources, jobs, expression):
+        yield sources[index][2], product
+
+
+def get_products_sources():
+    '''Return the list of (page_path, products_fetcher) for all pages
+    listing products.
+    '''
+    return [
+        (EMAG_RESIGILATE_PATH, get_all_resigilate_products_from_page_content),
+        (EMAG_LICHIDARI_PATH, get_all_lichidari_products_from_page_content),
+        ]
+
+
+def get_all_products_from_path(
+        page_path, products_fetcher, category_id=None, jobs=1,
+        expression=None):
     '''Return a list of all products from page path.
 
     `products_fetcher` is the function used to parse all products form page.
 
     If category is None it will get all products from all categories.
     '''
+    return list(iter_all_products_from_paths(
+        [(page_path, products_fetcher)], category_id, jobs, expression))
+
+
+def iter_all_products_from_paths(
+        sources, category_id=None, jobs=1, expression=None):
+    '''Generate all products from all `sources`.
+
+    `sources` is a list of (page_path, products_fetcher) tuples.
+    '''
+    sources = [
+        (page_path, products_fetcher, category_id)
+        for page_path, products_fetcher in sources]
+    for index, product in iter_sources_products(sources, jobs, expression):
+        yield product
+
+
+def iter_sources_products(sources, jobs=1, expression=None):
+    '''Generate (source_index, product) tuples for all products from all
+    `sources`.
+
+    `sources` is a list of (page_path, products_fetcher, category_id)
+    tuples.
+
+    The first page of each source is fetched to get the number of pages,
+    and then all remaining pages are fetched using `jobs` concurrent
+    requests. Pages which can not be fetched are skipped. Products are
+    generated in the order of `sources` and page numbers, and only a few
+    pages are kept in memory at a time.
+    '''
+    base_urls = [EMAG_BASE_URL + '/' + source[0] for source in sources]
+    first_pages = parallel_map(
+        lambda index: get_first_page_products(
+            base_urls[index], sources[index][0], sources[index][1],
+            sources[index][2], expression),
+        range(len(sources)), jobs)
+
+    # List of (source_index, page_number) for pages not yet fetched.
+    pages_to_fetch = []
+    categories_pages = {}
+    for index, first_page in enumerate(first_pages):
+        category_id = sources[index][2]
+        categories_pages.setdefault(category_id, 0)
+        if first_page is None:
+            categories_pages[category_id] += 1
+            continue
+        number_of_pages = first_page[0]
+        categories_pages[category_id] += max(1, number_of_pages)
+        for page_number in xrange(2, number_of_pages + 1):
+            pages_to_fetch.append((index, page_number))
+    CATEGORY_PAGES.update(categories_pages)
+
+    def get_other_page_products(page_to_fetch):
+        index, page_number = page_to_fetch
+        page_path, products_fetcher, category_id = sources[index]
+        try:
+            content = get_page_content(
+                base_urls[index], category_id, page_number)
+        except urllib2.URLError, error:
+            # Skip the page so that the products of other pages are kept.
+            print >> sys.stderr, 'Failed to get page %d from %s. %s' % (
+                page_number, base_urls[index], error)
+            STATS.increment('pages_failed')
+            return []
+        return parse_page(
+            content, page_path, products_fetcher, expression)[1]
+
+    # Pages are fetched in the same order as they are consumed below.
+    other_pages = parallel_imap(get_other_page_products, pages_to_fetch, jobs)
+    try:
+        for index, first_page in enumerate(first_pages):
+            if first_page is None or first_page[0] < 1:
+                continue
+            number_of_pages, products = first_page
+            first_pages[index] = None
+            for product in products:
+                yield index, product
+            for page_number in xrange(2, number_of_pages + 1):
+                for product in other_pages.next():
+                    yield index, product
+    finally:
+        # Stop the fetching threads.
+        other_pages.close()
+
+
+def iter_grouped_products(categories_products, category_ids):
+    '''Generate a (category_id, products) tuple for each of
+    `category_ids`, including categories without products.
+
+    `categories_products` are the (category_id, product) tuples generated by
+    iter_categories_products. The `products` iterator for a category is
+    skipped if it is not consumed before moving to the next category.
+    '''
+    categories_products = iter(categories_products)
+    # The next (category_id, product) which was not yet generated.
+    pending = [next(categories_products, None)]
+
+    def iter_category_products(category_id):
+        while pending[0] is not None and pending[0][0] == category_id:
+            product = pending[0][1]
+            pending[0] = next(categories_products, None)
+            yield product
+
+    for category_id in category_ids:
+        products = iter_category_products(category_id)
+        yield category_id, products
+        # Skip products which were not consumed.
+        for product in products:
+            pass
+
+
+def test_iter_sources_products_skips_failed_pages():
+    '''Test that products from other pages are kept when a page can not
+    be fetched.'''
+    global get_page_content, STATS
+    original_get_page_content = get_page_content
+    original_stats = STATS
+    pager = (
+        '<div class="holder-pagini-2">'
+        '<span class="pagini-options-2">1</span>'
+        '<a class="pagini-options-2" href="/resigilate/p2">2</a>'
+        '<a class="pagini-options-2" href="/resigilate/p3">3</a></div>')
+
+    def fake_get_page_content(base_url, category_id=None, page_nr=1):
+        if page_nr == 2:
+            raise urllib2.HTTPError(base_url, 500, 'Error', {}, None)
+        return pager + TEST_RESIGILATE_PAGE.replace(
+            'PROD', 'PAGE%d_' % page_nr)
+
+    get_page_content = fake_get_page_content
+    STATS = Stats()
+    try:
+        sources = [(
+            EMAG_RESIGILATE_PATH,
+            get_all_resigilate_products_from_page_content, None)]
+        products = [
+            product['name']
+            for index, product in iter_sources_products(sources, jobs=2)]
+        assert [
+            'PAGE1_1_NAME', 'PAGE1_2_NAME', 'PAGE3_1_NAME', 'PAGE3_2_NAME',
+            ] == products
+        assert 1 == STATS.counters['pages_failed']
+    finally:
+        get_page_content = original_get_page_content
+        STATS = original_stats
+
+
+def test_iter_grouped_products():
+    '''Test grouping products by category.'''
+    categories_products = [(1, 'a'), (1, 'b'), (3, 'c'), (4, 'd')]
+    result = [
+        (category_id, list(products))
+        for category_id, products in iter_grouped_products(
+            categories_products, [1, 2, 3, 4])]
+    assert result == [(1, ['a', 'b']), (2, []), (3, ['c']), (4, ['d'])]
+
+    # Not consumed products are skipped.
+    result = []
+    for category_id, products in iter_grouped_products(
+            categories_products, [1, 2, 3, 4]):
+        if category_id == 4:
+            result.extend(products)
+    assert result == ['d']
+
+
+def get_category_ids(categories_text, categories_file=None):
+    '''Return the list of category IDs from the comma separated
+    `categories_text` and from `categories_file`.
+
+    `categories_file` contains one category ID per line. Empty lines and
+    lines starting with # are ignored.
+
+    Return [None], meaning all categories, when no category is given.
+    Raise ValueError if a category ID is not an integer.
+    '''
+    values = []
+    if categories_text:
+        values.extend(categories_text.split(','))
+    if categories_file:
+        with open(categories_file) as stream:
+            for line in stream:
+                if not line.strip().startswith('#'):
+                    values.append(line)
+
+    category_ids = []
+    for value in values:
+        value = value.strip()
+        if value == '':
+            continue
+        category_id = int(value)
+        if category_id not in category_ids:
+            category_ids.append(category_id)
+
+    if len(category_ids) == 0:
+        return [None]
+    return category_ids
+
+
+def test_get_category_ids():
+    '''Test parsing the list of categories.'''
+    assert [None] == get_category_ids(None)
+    assert [None] == get_category_ids(' , ')
+    assert [12] == get_category_ids('12')
+    assert [12, 3] == get_category_ids('12, 3,12,')
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'categories')
+        with open(path, 'w') as stream:
+            stream.write('# Laptops\n5\n\n6\n')
+        assert [12, 5, 6] == get_category_ids('12', path)
+    finally:
+        shutil.rmtree(directory)
+
+    try:
+        get_category_ids('12,caca')
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised.'
 
-    base_url = EMAG_BASE_URL + '/' + page_path
+
+def get_first_page_products(
+        base_url, page_path, products_fetcher, category_id=None,
+        expression=None):
+    '''Return a tuple of (number_of_pages, products) for the first page of
+    `base_url` or None if it can not be retrieved.
+    '''
     try:
-        page = get_page(base_url, category_id, 1)
+        content = get_page_content(base_url, category_id, 1)
     except urllib2.URLError:
         print 'Server not found at %s.' % (base_url)
-        return
+        return None
     except urllib2.HTTPError:
         print 'Page not found at %s.' % (base_url)
-        return
+        return None
+    return parse_page(content, page_path, products_fetcher, expression)
 
-    number_of_pages = get_number_of_pages(page, page_path)
-    if number_of_pages < 1:
-        return []
 
-    result = []
-    for page_number in xrange(1, number_of_pages + 1):
-        # We already got the first page... so avoid making a new request.
-        if page_number != 1:
-            page = get_page(base_url, category_id, page_number)
-        result.extend(products_fetcher(page))
+def parse_page(content, page_path, products_fetcher, expression=None):
+    '''Return a tuple of (number_of_pages, products) for page `content`.
+
+    The page is parsed by the PAGE_PARSERS engine selected by PAGE_PARSER.
+    Only products matching `expression` are returned.
+
+    When PARSED_PAGES_CACHE is set, pages with the same content are only
+    parsed once.
+    '''
+    if PARSED_PAGES_CACHE is not None:
+        result = PARSED_PAGES_CACHE.get(page_path, content, expression)
+        if result is not None:
+            return result
+
+    page_parser = PAGE_PARSERS[PAGE_PARSER]
+    with STATS.stage('parse'):
+        result = page_parser(content, page_path, products_fetcher, expression)
+
+    if PARSED_PAGES_CACHE is not None:
+        PARSED_PAGES_CACHE.set(page_path, content, result, expression)
     return result
 
 
+class ParsedPagesCache(object):
+    '''Cache for the products parsed from a page, keyed by the hash of the
+    page content.
+
+    Cached products are only used if they were created with the current
+    PRODUCT_SCHEMA_VERSION and filtered using the same expression.
+    Products are stored as JSON, which loads all strings as unicode, so
+    attribute names are encoded back to the UTF-8 byte strings created by
+    the parsers and used by the rules.
+    '''
+
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+
+    def get(self, page_path, content, expression=None):
+        '''Return the (number_of_pages, products) tuple or None.'''
+        value = self.disk_cache.get(
+            self._get_key(page_path, content, expression))
+        if value is None:
+            return None
+        value = json.loads(value)
+        if value['schema'] != PRODUCT_SCHEMA_VERSION:
+            return None
+        products = [
+            dict([
+                (name.encode('utf-8'), attribute_value)
+                for name, attribute_value in product.items()])
+            for product in value['products']]
+        return (value['number_of_pages'], products)
+
+    def set(self, page_path, content, parsed_page, expression=None):
+        '''Store the (number_of_pages, products) tuple for `content`.'''
+        number_of_pages, products = parsed_page
+        self.disk_cache.set(
+            self._get_key(page_path, content, expression), json.dumps({
+                'schema': PRODUCT_SCHEMA_VERSION,
+                'number_of_pages': number_of_pages,
+                'products': products,
+                }))
+
+    def _get_key(self, page_path, content, expression=None):
+        '''Return the cache key for page `content`.'''
+        if expression:
+            expression_text = expression.to_text()
+        else:
+            expression_text = ''
+        return 'products:%d:%s:%s:%s' % (
+            PRODUCT_SCHEMA_VERSION, page_path,
+            hashlib.sha1(content).hexdigest(), expression_text)
+
+
+def test_parse_page_with_cache():
+    '''Test that products are not parsed again for the same content.'''
+    global PARSED_PAGES_CACHE
+    content = '''
+        <div class="holder-pagini-2">
+        <span class="pagini-options-2">1</span>
+        </div>
+        <p>PRODUCT_NAME</p>
+        '''
+
+    def products_fetcher(soup, expression=None):
+        return [{'name': soup.find('p').string, 'price': 10}]
+
+    def fail_products_fetcher(soup, expression=None):
+        assert False, 'Cached products not used.'
+
+    directory = tempfile.mkdtemp()
+    try:
+        PARSED_PAGES_CACHE = ParsedPagesCache(
+            DiskCache(directory, 1024 * 1024))
+        result = parse_page(content, EMAG_RESIGILATE_PATH, products_fetcher)
+        assert result == (1, [{'name': 'PRODUCT_NAME', 'price': 10}])
+
+        result = parse_page(
+            content, EMAG_RESIGILATE_PATH, fail_products_fetcher)
+        assert result == (1, [{'name': 'PRODUCT_NAME', 'price': 10}])
+    finally:
+        PARSED_PAGES_CACHE = None
+        shutil.rmtree(directory)
+
+
+def test_parse_page_with_cache_non_ascii_attribute():
+    '''Test that rules for non-ASCII attributes match cached products.'''
+    global PARSED_PAGES_CACHE
+    content = TEST_RESIGILATE_PAGE.replace('ATTR1_NAME', 'garan\xc8\x9bie')
+    expression = parse_expression('garan\xc8\x9bie~VALUE')
+    PARSED_PAGES_CACHE = ParsedPagesCache(MemoryCache(1024 * 1024))
+    try:
+        for index in xrange(2):
+            number_of_pages, products = parse_page(
+                content, EMAG_RESIGILATE_PATH,
+                get_all_resigilate_products_from_page_content)
+            assert ['garan\xc8\x9bie'] == [
+                name for name in products[0] if name.startswith('garan')]
+            assert 1 == len(filter_products(products, expression))
+    finally:
+        PARSED_PAGES_CACHE = None
+
+
 def get_page(base_url, category_id=None, page_nr=1):
+    '''Return the BeautifulSoup object for the page.'''
+    return BeautifulSoup(get_page_content(base_url, category_id, page_nr))
+
+
+def get_page_content(base_url, category_id=None, page_nr=1):
     '''Return the page content.'''
     if category_id is None:
         url = "%s/p%d" % (base_url, page_nr)
     else:
         url = "%s/p%d?catid=%d" % (base_url, page_nr, category_id)
-    page = urllib2.urlopen(url)
-    return BeautifulSoup(page)
+    with STATS.stage('fetch'):
+        content = HTTP_CLIENT.get(url).body
+    STATS.increment('pages_fetched')
+    return content
 
 
 def test_get_page():
@@ -144,19 +591,19 @@ def test_get_page():
         assert False, 'urllib2.URLError not raised.'
 
 
-def get_all_resigilate_products_from_page_content(soup):
+def get_all_resigilate_products_from_page_content(soup, expression=None):
     '''Return a list of all products from a resigilate page.'''
     products_div = soup.findAll(
         "div", {"style": "height:auto; position:relative;"})
     result = []
     for product_div in products_div:
-        result.append(get_product(product_div))
+        product = get_product(product_div, expression)
+        if product is not None:
+            result.append(product)
     return result
 
 
-def test_get_all_resigilate_products_from_page_content():
-    '''Test getting the list of products from a resigilate page.'''
-    page = create_soup('''
+TEST_RESIGILATE_PAGE = '''
         <div class="content-with-sidebar">
         <div class="products-pagination">
         <div class="holder-pagini-2">
@@ -239,18 +686,25 @@ def test_get_all_resigilate_products_from_page_content():
         </div>
         <div style="clear:both; height:5px;"></div>
         </div>
-        ''')
+        '''
+
+
+def test_get_all_resigilate_products_from_page_content():
+    '''Test getting the list of products from a resigilate page.'''
+    page = create_soup(TEST_RESIGILATE_PAGE)
     products = get_all_resigilate_products_from_page_content(page)
     assert len(products) == 2
 
 
-def get_all_lichidari_products_from_page_content(soup):
+def get_all_lichidari_products_from_page_content(soup, expression=None):
     '''Return a list of all products from a lichidari page.'''
     products_div = soup.findAll(
         'form', {'action': 'https://www.emag.ro/addtocart', 'method': 'post'})
     result = []
     for product_div in products_div:
-        result.append(get_product(product_div))
+        product = get_product(product_div, expression)
+        if product is not None:
+            result.append(product)
     return result
 
 
@@ -336,9 +790,12 @@ def test_get_number_of_pages():
     assert pages == 9, 'Failed to get number of pages for many pages.'
 
 
-def get_product(product_div):
+def get_product(product_div, expression=None):
     '''Return a dictionary containing all product atributes.
 
+    When `expression` is an Expression, None is returned as soon as one of
+    the product attributes does not match it.
+
     <div style="height:auto; position:relative;">
     <div class="col-1-prod">
     <a href="LINK_TO_PRODUCT">
@@ -372,12 +829,16 @@ def get_product(product_div):
     </div>
     ADD_TO_CHART_STUFF
     '''
+    STATS.increment('products_parsed')
     product = {}
 
     details_div = product_div.find('div', {'class': 'col-2-prod'})
     product['name'] = tag_to_plain_text(details_div.find('a'))
     product['link'] = (
         EMAG_BASE_URL + details_div.find('a').get('href').strip())
+    if expression and expression.rejects(product, ('name', 'link')):
+        return None
+
     for attribute_li in details_div.findAll('li'):
         content = attribute_li.renderContents()
         re_match = re.search(EMAG_RESIGILATE_ATTRIBUTE_RE, content)
@@ -386,6 +847,8 @@ def get_product(product_div):
             attribute_name = attribute_name.strip().replace(' ', '-')
             attribute_value = re_match.group(2).strip().decode('utf-8')
             product[attribute_name] = attribute_value
+            if expression and expression.rejects(product, (attribute_name,)):
+                return None
         else:
             print (
                 'Failed to get attribute.\n'
@@ -419,7 +882,14 @@ def get_product(product_div):
             new_price_span = price_div.find('span', {'title': 'Pret nou'})
             product['price'] = get_price(new_price_span)
 
+    set_product_discount(product)
+    if expression and not expression.matches(product):
+        return None
+    return product
+
 
+def set_product_discount(product):
+    '''Set the discount attributes based on product price and old-price.'''
     product['discount'] = product['old-price'] - product['price']
 
     if product['discount'] < 1:
@@ -427,13 +897,9 @@ def get_product(product_div):
     else:
         product['discount-percentage'] = int(round(
             100/(product['old-price']/float(product['discount']))))
-    return product
 
 
-def test_get_product():
-    '''Test getting of a product.'''
-    # Get resigilate product
-    product_tag = '''
+TEST_RESIGILATE_PRODUCT = '''
         <div style="height:auto; position:relative;">
         <div class="col-1-prod">
         <a href="LINK_TO_PRODUCT">
@@ -470,18 +936,8 @@ def test_get_product():
         ADD_TO_CHART_STUFF
         </div>
         '''
-    product = get_product(create_tag(product_tag))
-    assert product['name'] == 'PRODUCT_NAME'
-    assert product['link'] == EMAG_BASE_URL + 'LINK_TO_PRODUCT'
-    assert product['price'] == 7500
-    assert product['old-price'] == 10000
-    assert product['discount'] == 2500
-    assert product['discount-percentage'] == 25
-    assert product['attr1_name'] == 'ATTR1_VALUE'
-    assert product['attr2-name'] == 'ATTR2_VALUE luni'
 
-    # Get lichidari no discount
-    product_tag = '''
+TEST_LICHIDARI_PRODUCT = '''
         <form action="https://www.emag.ro/addtocart" method="post">
         <input type="hidden" name="product[]" value="135336">
         <div id="poza1" class="col-1-prod">
@@ -517,17 +973,8 @@ def test_get_product():
         <a href="ADD_TO_CHART_LINK"></a>
         <div class="clear"></div></div></div></form>
         '''
-    product = get_product(create_tag(product_tag))
-    assert product['name'] == 'PRODUCT_NAME'
-    assert product['link'] == EMAG_BASE_URL + 'LINK_TO_PRODUCT'
-    assert product['price'] == 759
-    assert product['old-price'] == 759
-    assert product['discount'] == 0
-    assert product['discount-percentage'] == 0
-    assert product['attr1_name'] == 'ATTR1_VALUE'
 
-    # Get lichidari with discount
-    product_tag = '''
+TEST_LICHIDARI_DISCOUNT_PRODUCT = '''
         <form action="https://www.emag.ro/addtocart" method="post">
         <input type="hidden" name="product[]" value="128529">
         <div id="poza3" class="col-1-prod">
@@ -568,7 +1015,33 @@ def test_get_product():
         <a href="CART_LINK" rel="nofollow"></a>
         <div class="clear"></div></div></div></form>
     '''
-    product = get_product(create_tag(product_tag))
+
+
+def test_get_product():
+    '''Test getting of a product.'''
+    # Get resigilate product
+    product = get_product(create_tag(TEST_RESIGILATE_PRODUCT))
+    assert product['name'] == 'PRODUCT_NAME'
+    assert product['link'] == EMAG_BASE_URL + 'LINK_TO_PRODUCT'
+    assert product['price'] == 7500
+    assert product['old-price'] == 10000
+    assert product['discount'] == 2500
+    assert product['discount-percentage'] == 25
+    assert product['attr1_name'] == 'ATTR1_VALUE'
+    assert product['attr2-name'] == 'ATTR2_VALUE luni'
+
+    # Get lichidari no discount
+    product = get_product(create_tag(TEST_LICHIDARI_PRODUCT))
+    assert product['name'] == 'PRODUCT_NAME'
+    assert product['link'] == EMAG_BASE_URL + 'LINK_TO_PRODUCT'
+    assert product['price'] == 759
+    assert product['old-price'] == 759
+    assert product['discount'] == 0
+    assert product['discount-percentage'] == 0
+    assert product['attr1_name'] == 'ATTR1_VALUE'
+
+    # Get lichidari with discount
+    product = get_product(create_tag(TEST_LICHIDARI_DISCOUNT_PRODUCT))
     assert product['name'] == 'PRODUCT_NAME'
     assert product['link'] == EMAG_BASE_URL + 'LINK_TO_PRODUCT'
     assert product['price'] == 355
@@ -585,7 +1058,12 @@ def get_price(price_span):
     and then appending the string with '.DECIMALS'
     '''
     decimals = price_span.first().string
-    return int(re.sub('\D', '', price_span.contents[0]).strip())
+    return get_price_from_text(price_span.contents[0])
+
+
+def get_price_from_text(text):
+    '''Return the integer price from the text before the decimals.'''
+    return int(re.sub('\D', '', text).strip())
 
 
 def test_get_price():
@@ -599,6 +1077,381 @@ def test_get_price():
     assert price == 4189
 
 
+class ProductsStreamParser(HTMLParser):
+    '''Event based parser for getting all products from a page in a
+    single pass over the HTML.
+
+    It creates the same product dictionaries as get_product and finds the
+    same number of pages as get_number_of_pages, without building a tree
+    for the whole page.
+
+    `container` is a tuple of (tag, attributes) matching the element holding
+    a product. Use the values from PRODUCT_CONTAINERS.
+
+    When `expression` is an Expression, a product is skipped as soon as one
+    of its attributes does not match it.
+    '''
+
+    def __init__(self, page_type, container, expression=None):
+        HTMLParser.__init__(self)
+        self.page_type = page_type
+        self.container_tag, self.container_attributes = container
+        self.expression = expression
+        self.products = []
+        self.number_of_pages = 0
+        self._last_page_link = None
+        # Roles of the open div elements. See _get_div_role.
+        self._divs = []
+        self._product = None
+        # True when the current product does not match the expression.
+        self._rejected = False
+        # Product sections (details, prices) already found.
+        self._sections = set()
+        # Number of open container tags inside the current product.
+        self._container_depth = 0
+        # Element whose first text is captured and the captured text.
+        self._capture = None
+        self._captured_text = None
+        self._link = None
+        self._link_text = None
+        self._attribute = None
+        # Text at the start of price elements, keyed by price element.
+        self._prices = {}
+
+    def handle_starttag(self, tag, attrs):
+        self._end_capture()
+        attributes = dict(attrs)
+
+        if self._product is None:
+            if (tag == self.container_tag and
+                    self._matches(attributes, self.container_attributes)):
+                self._start_product()
+        elif tag == self.container_tag:
+            self._container_depth += 1
+
+        if tag == 'div':
+            role = self._get_div_role(attributes)
+            self._divs.append(role)
+            if self._rejected:
+                return
+            if role == 'pages' and self.number_of_pages == 0:
+                # Single page, unless some page links are found.
+                self.number_of_pages = 1
+            elif role in PRODUCT_PRICE_ELEMENTS:
+                self._start_capture(role)
+        elif self._product is None:
+            if (tag == 'a' and 'pages' in self._divs and
+                    attributes.get('class') == 'pagini-options-2'):
+                self._last_page_link = attributes.get('href', '')
+        elif self._rejected:
+            return
+        elif 'details' in self._divs:
+            self._handle_details_starttag(tag, attributes)
+        elif 'prices' in self._divs and tag == 'span':
+            for element, element_attributes in PRODUCT_PRICE_SPANS:
+                if self._matches(attributes, element_attributes):
+                    self._start_capture(element)
+                    break
+
+    def handle_endtag(self, tag):
+        self._end_capture()
+        if self._link is not None and tag == 'a':
+            self._set_link()
+        if self._attribute is not None:
+            if (tag == 'strong' and self._attribute['name'] is not None and
+                    self._attribute['value'] is None):
+                self._attribute['value'] = u''
+                self._attribute['value_open'] = True
+            elif tag == 'li':
+                self._set_attribute()
+
+        if tag == 'div' and self._divs:
+            self._divs.pop()
+
+        if self._product is not None and tag == self.container_tag:
+            if self._container_depth > 0:
+                self._container_depth -= 1
+            else:
+                self._end_product()
+
+    def handle_data(self, data):
+        if self._capture is not None:
+            self._captured_text += data
+        if self._link is not None:
+            self._link_text += data
+        if self._attribute is not None:
+            if self._attribute['value'] is None:
+                if self._attribute['name'] is not None:
+                    self._attribute['name'] += data
+                self._attribute['content'] += data
+            elif self._attribute['value_open']:
+                self._attribute['value'] += data
+
+    def handle_entityref(self, name):
+        # Entities are not converted, just like BeautifulSoup does.
+        self.handle_data(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        self.handle_data(u'&#%s;' % name)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_capture()
+        if self._product is not None:
+            self._end_product()
+        if self._last_page_link is not None:
+            result = re.search(
+                self.page_type + '/p(\d+)', self._last_page_link)
+            assert result, 'Could not get the number of pages.'
+            self.number_of_pages = int(result.group(1))
+
+    def _handle_details_starttag(self, tag, attributes):
+        '''Handle tags from the product details element.'''
+        if tag == 'a' and 'name' not in self._product:
+            if self._link is None:
+                self._link = attributes.get('href', '')
+                self._link_text = u''
+        elif tag == 'li':
+            if self._attribute is not None:
+                self._set_attribute()
+            self._attribute = {
+                'name': None, 'value': None, 'value_open': False,
+                'content': u''}
+        elif self._attribute is not None:
+            if tag == 'strong' and self._attribute['name'] is None:
+                self._attribute['name'] = u''
+            elif self._attribute['value'] is not None:
+                # Attribute value ends at the first tag after the name.
+                self._attribute['value_open'] = False
+            if tag != 'strong':
+                self._attribute['content'] += u'<%s>' % tag
+
+    def _get_div_role(self, attributes):
+        '''Return the role of a div based on its attributes.'''
+        css_class = attributes.get('class')
+        if css_class == 'holder-pagini-2' and 'pages' not in self._divs:
+            return 'pages'
+        if self._product is None:
+            return None
+        if css_class == 'col-2-prod' and 'details' not in self._sections:
+            self._sections.add('details')
+            return 'details'
+        if css_class == 'col-3-prod' and 'prices' not in self._sections:
+            self._sections.add('prices')
+            return 'prices'
+        if 'prices' in self._divs and css_class in PRODUCT_PRICE_ELEMENTS:
+            return css_class
+        return None
+
+    def _matches(self, attributes, expected_attributes):
+        '''Return True if `attributes` contains all `expected_attributes`.'''
+        for name, value in expected_attributes.items():
+            if attributes.get(name) != value:
+                return False
+        return True
+
+    def _start_capture(self, element):
+        '''Start capturing the first text of a price element.'''
+        if element in self._prices:
+            # Only the first element is used, like BeautifulSoup.find.
+            return
+        self._prices[element] = None
+        self._capture = element
+        self._captured_text = u''
+
+    def _end_capture(self):
+        '''Stop capturing text at the first tag.'''
+        if self._capture is None:
+            return
+        if self._captured_text:
+            self._prices[self._capture] = self._captured_text
+        self._capture = None
+        self._captured_text = None
+
+    def _set_link(self):
+        '''Set name and link of the product from the first details link.'''
+        self._product['name'] = self._link_text.strip('\r\n\t ')
+        self._product['link'] = EMAG_BASE_URL + self._link.strip()
+        self._link = None
+        self._link_text = None
+        self._check_expression(('name', 'link'))
+
+    def _set_attribute(self):
+        '''Add the attribute from the current list item to the product.'''
+        attribute = self._attribute
+        self._attribute = None
+        if attribute['name'] is None or attribute['value'] is None:
+            print (
+                'Failed to get attribute.\n'
+                'product name: %s\n'
+                'attribute content: %s\n' % (
+                    self._product['name'],
+                    attribute['content'].encode('utf-8')))
+            return
+        # Lowercase the encoded name, as get_product does, so that only
+        # ASCII letters are changed.
+        attribute_name = attribute['name'].encode('utf-8').strip(' :').lower()
+        attribute_name = attribute_name.strip().replace(' ', '-')
+        self._product[attribute_name] = attribute['value'].strip()
+        self._check_expression((attribute_name,))
+
+    def _check_expression(self, attributes):
+        '''Reject the product if it does not match the expression for the
+        `attributes` which were just set.
+        '''
+        if self.expression and self.expression.rejects(
+                self._product, attributes):
+            self._rejected = True
+            self._capture = None
+            self._captured_text = None
+            self._link = None
+            self._attribute = None
+
+    def _start_product(self):
+        '''Start parsing a new product.'''
+        STATS.increment('products_parsed')
+        self._product = {}
+        self._rejected = False
+        self._container_depth = 0
+        self._sections = set()
+        self._prices = {}
+
+    def _end_product(self):
+        '''Set product prices and add it to the list of products.'''
+        if self._attribute is not None:
+            self._set_attribute()
+        if self._rejected:
+            self._product = None
+            return
+        product = self._product
+        prices = self._prices
+
+        if 'pret-produs-listing-rsg' in prices:
+            product['price'] = get_price_from_text(
+                prices['pret-produs-listing-rsg'])
+            product['old-price'] = get_price_from_text(prices['old-price'])
+
+        if 'pret-produs-listing' in prices:
+            if 'old' not in prices:
+                # Looks like we have no discount.
+                product['price'] = get_price_from_text(
+                    prices['pret-produs-listing'])
+                product['old-price'] = product['price']
+            else:
+                product['old-price'] = get_price_from_text(prices['old'])
+                product['price'] = get_price_from_text(prices['new'])
+
+        set_product_discount(product)
+        if not self.expression or self.expression.matches(product):
+            self.products.append(product)
+        self._product = None
+
+
+def parse_page_with_stream(
+        content, page_path, products_fetcher=None, expression=None):
+    '''Return a tuple of (number_of_pages, products) for page `content`
+    using ProductsStreamParser.
+
+    Products are found using the PRODUCT_CONTAINERS for `page_path`, so
+    `products_fetcher` is not used.
+    '''
+    if isinstance(content, str):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            content = content.decode('windows-1252', 'replace')
+    parser = ProductsStreamParser(
+        page_path, PRODUCT_CONTAINERS[page_path], expression)
+    parser.feed(content)
+    parser.close()
+    return (parser.number_of_pages, parser.products)
+
+
+def parse_page_with_soup(
+        content, page_path, products_fetcher, expression=None):
+    '''Return a tuple of (number_of_pages, products) for page `content`
+    using BeautifulSoup and `products_fetcher`.
+    '''
+    soup = BeautifulSoup(content)
+    return (
+        get_number_of_pages(soup, page_path),
+        products_fetcher(soup, expression))
+
+
+# Engines used for parsing pages, selected by name using PAGE_PARSER.
+PAGE_PARSERS = {
+    'soup': parse_page_with_soup,
+    'stream': parse_page_with_stream,
+    }
+
+
+def test_parse_page_with_stream():
+    '''Test that the stream parser and BeautifulSoup give the same
+    results.
+    '''
+    pages_holder = '''
+        <div class="holder-pagini-2">
+        <span class="pagini-options-2">1</span>
+        <a class="pagini-options-2" href="/%s/p2">2</a>
+        <a class="pagini-options-2" href="/%s/p7">&gt;</a>
+        </div>
+        '''
+    pages = [
+        (TEST_RESIGILATE_PAGE, EMAG_RESIGILATE_PATH,
+            get_all_resigilate_products_from_page_content),
+        (TEST_RESIGILATE_PRODUCT, EMAG_RESIGILATE_PATH,
+            get_all_resigilate_products_from_page_content),
+        (pages_holder % (EMAG_RESIGILATE_PATH, EMAG_RESIGILATE_PATH) +
+            TEST_RESIGILATE_PRODUCT, EMAG_RESIGILATE_PATH,
+            get_all_resigilate_products_from_page_content),
+        (pages_holder % (EMAG_LICHIDARI_PATH, EMAG_LICHIDARI_PATH) +
+            TEST_LICHIDARI_PRODUCT + TEST_LICHIDARI_DISCOUNT_PRODUCT,
+            EMAG_LICHIDARI_PATH,
+            get_all_lichidari_products_from_page_content),
+        ('<div>No products</div>', EMAG_LICHIDARI_PATH,
+            get_all_lichidari_products_from_page_content),
+        (TEST_RESIGILATE_PRODUCT.replace(
+            'ATTR1_NAME', '\xc3\x8en\xc4\x83l\xc8\x9bime'),
+            EMAG_RESIGILATE_PATH,
+            get_all_resigilate_products_from_page_content),
+        ]
+    for content, page_path, products_fetcher in pages:
+        soup_result = parse_page_with_soup(
+            content, page_path, products_fetcher)
+        stream_result = parse_page_with_stream(
+            content, page_path, products_fetcher)
+        assert soup_result == stream_result, (
+            'Different results:\n%r\n%r' % (soup_result, stream_result))
+
+    number_of_pages, products = parse_page_with_stream(
+        TEST_RESIGILATE_PAGE, EMAG_RESIGILATE_PATH)
+    assert number_of_pages == 1
+    assert len(products) == 2
+    assert products[1]['attr4_name'] == 'ATTR4_VALUE'
+    assert products[1]['price'] == 189
+
+
+def test_parse_page_with_expression():
+    '''Test that products not matching the expression are skipped while
+    parsing.
+    '''
+    expressions = [
+        ('name~PROD2', ['PROD2_NAME']),
+        ('price>190', ['PROD1_NAME']),
+        ('attr1_name~ATTR1', ['PROD1_NAME']),
+        ('attr1_name!~ATTR1', []),
+        ('discount<30,name~PROD', ['PROD2_NAME']),
+        ]
+    for page_parser in PAGE_PARSERS.values():
+        for expression_text, names in expressions:
+            number_of_pages, products = page_parser(
+                TEST_RESIGILATE_PAGE, EMAG_RESIGILATE_PATH,
+                get_all_resigilate_products_from_page_content,
+                parse_expression(expression_text))
+            assert names == [product['name'] for product in products], (
+                'Wrong products for %s.' % expression_text)
+
+
 class ExpressionError(Exception):
     '''Exception raised when the filter expression is not valid.'''
 
@@ -613,26 +1466,99 @@ class ExpressionError(Exception):
 
 
 def filter_products(products, expression=''):
-    '''Filter products based on expression.'''
-    rules = parse_expression(expression)
+    '''Filter products based on expression.
 
-    if len(rules) == 0:
-        # Return a copy of the list of products if we have no rules.
-        return [product for product in products]
+    `expression` is the expression text or an already parsed Expression.
+    '''
+    return list(iter_filtered_products(products, expression))
 
-    result = []
-    for product in products:
-        matched = False
-        for rule in rules:
-            matched = does_product_match_rule(product, rule)
-            if not matched:
-                matched = False
-                break
+
+def iter_filtered_products(products, expression=''):
+    '''Generate the products matching expression.
+
+    `expression` is the expression text or an already parsed Expression.
+    '''
+    if isinstance(expression, Expression):
+        rules = expression
+    else:
+        rules = parse_expression(expression)
+
+    # Products are also counted when there are no rules.
+    return iter_matching_products(products, rules.matches)
+
+
+def iter_matching_products(products, matches):
+    '''Generate the products for which `matches` is True.
+
+    The time used by `matches` and the number of matched products are
+    added to STATS. When the filter stage is profiled, only the calls to
+    `matches` are profiled.
+    '''
+    duration = 0
+    matched_count = 0
+    profiler = STATS.get_profiler('filter')
+    profile = None
+    if profiler is not None:
+        profile = profiler.start()
+        profile.disable()
+    try:
+        for product in products:
+            start_time = time.time()
+            if profile is None:
+                matched = matches(product)
             else:
-                matched = True
-        if matched:
-            result.append(product)
-    return result
+                profile.enable()
+                matched = matches(product)
+                profile.disable()
+            duration += time.time() - start_time
+            if matched:
+                matched_count += 1
+                yield product
+    finally:
+        STATS.add_stage_time('filter', duration)
+        STATS.increment('products_matched', matched_count)
+        if profile is not None:
+            profiler.stop(profile)
+
+
+def test_iter_matching_products():
+    '''Test that matched products are counted in STATS.'''
+    global STATS
+    original_stats = STATS
+    STATS = Stats()
+    try:
+        products = iter_matching_products(
+            [1, 2, 3, 4], lambda product: product % 2 == 0)
+        assert [2, 4] == list(products)
+        assert 2 == STATS.counters['products_matched']
+        assert 1 == STATS.stages['filter'][0]
+
+        assert [1, 2] == list(iter_filtered_products([1, 2], ''))
+        assert 4 == STATS.counters['products_matched']
+    finally:
+        STATS = original_stats
+
+
+def test_iter_matching_products_profile():
+    '''Test profiling the filter stage.'''
+    global STATS
+    original_stats = STATS
+    STATS = Stats()
+    STATS.profiler = Profiler('filter')
+    directory = tempfile.mkdtemp()
+    try:
+        products = iter_filtered_products(
+            [{'price': 10}, {'price': 20}], 'price<15')
+        assert [{'price': 10}] == list(products)
+        path = os.path.join(directory, 'profile')
+        assert STATS.profiler.save(path)
+        functions = [
+            name for filename, line, name in pstats.Stats(path).stats]
+        assert 'matches' in functions
+        assert 'iter_matching_products' not in functions
+    finally:
+        STATS = original_stats
+        shutil.rmtree(directory)
 
 
 def test_filter_products():
@@ -659,46 +1585,130 @@ def test_filter_products():
 
 def does_product_match_rule(product, rule):
     '''Retrurn True if product match the rule conditions. False otherwise.'''
+    return compile_rule(rule)(product)
 
-    if rule['attribute'] in product:
-        if rule['type'] == RULE_REGEX:
-            if re.search(rule['value'], product[rule['attribute']]):
-                return True
-            else:
-                return False
 
-        if rule['type'] == RULE_REGEX_NOT:
-            if re.search(rule['value'], product[rule['attribute']]):
+def compile_rule(rule):
+    '''Return a function checking if a product matches `rule`.
+
+    Regular expressions are compiled only once and the comparison is
+    selected based on rule type, so that the returned function does the
+    minimum work for each product.
+    '''
+    attribute = rule['attribute']
+    value = rule['value']
+
+    if rule['type'] in (RULE_REGEX, RULE_REGEX_NOT):
+        try:
+            search = re.compile(value).search
+        except re.error, error:
+            raise ExpressionError(
+                'Invalid regular expression "%s" for attribute "%s". %s' % (
+                    value, attribute, error))
+        expected = rule['type'] == RULE_REGEX
+
+        def match_regex(product):
+            if attribute not in product:
                 return False
-            else:
-                return True
+            return (search(product[attribute]) is not None) is expected
+
+        return match_regex
 
-        if rule['type'] == RULE_LESS:
+    if rule['type'] == RULE_LESS:
+        compare = operator.lt
+        name = 'LESS'
+    else:
+        compare = operator.gt
+        name = 'GREATER'
+
+    def match_integer(product):
+        if attribute not in product:
+            return False
+        product_value = product[attribute]
+        if type(product_value) is not int:
             try:
-                if int(product[rule['attribute']]) < rule['value']:
-                    return True
-                else:
-                    return False
+                product_value = int(product_value)
             except ValueError:
                 raise ExpressionError(
                     'Value for attribute "%s" is not an integer and can not '
-                    'be used with a condition of type LESS.' % (
-                        rule['attribute']))
+                    'be used with a condition of type %s.' % (
+                        attribute, name))
+        return compare(product_value, value)
 
-        if rule['type'] == RULE_GREATER:
-            try:
-                if int(product[rule['attribute']]) > rule['value']:
+    return match_integer
+
+
+class Expression(list):
+    '''List of filtering rules compiled into a single product predicate.
+
+    Rules are sorted by RULE_COSTS so that cheap integer comparisons are
+    done before regular expressions searches.
+    '''
+
+    def __init__(self, rules=()):
+        list.__init__(
+            self, sorted(rules, key=lambda rule: RULE_COSTS[rule['type']]))
+        self._predicates = []
+        self._predicates_by_attribute = {}
+        for rule in self:
+            predicate = compile_rule(rule)
+            self._predicates.append(predicate)
+            self._predicates_by_attribute.setdefault(
+                rule['attribute'], []).append(predicate)
+
+    def matches(self, product):
+        '''Return True if product matches all rules.'''
+        for predicate in self._predicates:
+            if not predicate(product):
+                return False
+        return True
+
+    def rejects(self, product, attributes):
+        '''Return True if the product does not match the rules for any of
+        the `attributes`.
+
+        It is used while parsing a product, to reject it as soon as the
+        value of an attribute is known.
+        '''
+        for attribute in attributes:
+            for predicate in self._predicates_by_attribute.get(attribute, ()):
+                if not predicate(product):
                     return True
-                else:
-                    return False
-            except ValueError:
-                raise ExpressionError(
-                    'Value for attribute "%s" is not an integer and can not '
-                    'be used with a condition of type GREATER.' % (
-                        rule['attribute']))
-    else:
         return False
 
+    def to_text(self):
+        '''Return the expression text for the sorted rules.'''
+        return ','.join(
+            '%s%s%s' % (rule['attribute'], rule['type'], rule['value'])
+            for rule in self)
+
+
+def test_expression():
+    '''Test ordering and matching of compiled rules.'''
+    expression = parse_expression('name~some, price<11, size!~big, price>9')
+    assert [rule['type'] for rule in expression] == [
+        RULE_LESS, RULE_GREATER, RULE_REGEX, RULE_REGEX_NOT]
+    assert expression.matches({'name': 'some', 'price': 10, 'size': 'small'})
+    assert expression.matches({'name': 'some', 'price': '10', 'size': 'x'})
+    assert not expression.matches({'name': 'some', 'price': 12, 'size': 'x'})
+    assert not expression.matches({'name': 'some', 'price': 10})
+    assert not expression.matches({'name': 'other', 'price': 10, 'size': ''})
+    assert parse_expression('').matches({'name': 'any'})
+
+    assert expression.rejects({'name': 'other'}, ['name'])
+    assert not expression.rejects({'name': 'some'}, ['name'])
+    # Rules for other attributes are not checked.
+    assert not expression.rejects({'name': 'some', 'price': 10}, ['name'])
+    assert expression.rejects({'name': 'some', 'price': 12}, ['price'])
+    assert expression.to_text() == 'price<11,price>9,name~some,size!~big'
+
+    try:
+        parse_expression('name~(unclosed')
+    except ExpressionError:
+        pass
+    except:
+        assert False, 'ExpressionError not raised.'
+
 
 def test_does_product_match_rule():
     product = {
@@ -739,21 +1749,22 @@ def test_does_product_match_rule():
 
 
 def parse_expression(expression):
-    '''Parse the expression are return a list of filtering rules.
+    '''Parse the expression are return an Expression with all filtering
+    rules.
 
-    Return an empty list for empty expressions.
+    Return an empty Expression for empty expressions.
 
-    Raises ParseError if expression is not valid.
+    Raises ExpressionError if expression is not valid.
     '''
     rules = []
 
     if expression == '':
-        return rules
+        return Expression(rules)
 
     for rule_text in expression.split(','):
         rule_text = rule_text.strip()
         rules.append(parse_rule(rule_text.strip()))
-    return rules
+    return Expression(rules)
 
 
 def test_parse_expression():
@@ -972,61 +1983,695 @@ def products_to_string(products):
     return '\n'.join(results)
 
 
+def peek_first(iterable):
+    '''Return None if `iterable` is empty, otherwise an iterator over
+    all its items.
+    '''
+    iterator = iter(iterable)
+    for first in iterator:
+        return itertools.chain([first], iterator)
+    return None
+
+
 def list_products(products):
     '''List products.'''
-    if len(products) > 0:
-        print products_to_string(products)
-    else:
-        print 'No products found.'
+    with STATS.stage('output'):
+        if len(products) > 0:
+            print products_to_string(products)
+        else:
+            print 'No products found.'
+
+
+def list_products_stream(products, output=None):
+    '''List products as soon as they are generated.
+
+    The output is the same as for list_products. Return the number of listed
+    products.
+    '''
+    if output is None:
+        output = sys.stdout
+    count = 0
+    for product in products:
+        with STATS.stage('output'):
+            if count > 0:
+                output.write('\n')
+            output.write(product_to_string(product))
+            output.flush()
+        count += 1
+    with STATS.stage('output'):
+        if count > 0:
+            output.write('\n')
+        else:
+            output.write('No products found.\n')
+    return count
+
+
+def test_list_products_stream():
+    '''Test listing products from a generator.'''
+    global STATS
+    original_stats = STATS
+    products = [
+        {'name': 'name1', 'price': 1, 'old-price': 2, 'discount': 1,
+            'discount-percentage': 50, 'link': 'link1'},
+        {'name': 'name2', 'price': 3, 'old-price': 3, 'discount': 0,
+            'discount-percentage': 0, 'link': 'link2', 'size': 'big'},
+        ]
+    output = StringIO()
+    STATS = Stats()
+    try:
+        count = list_products_stream(
+            (product for product in products), output=output)
+        assert 3 == STATS.stages['output'][0]
+    finally:
+        STATS = original_stats
+    assert count == 2
+    assert output.getvalue() == products_to_string(products) + '\n'
+
+    output = StringIO()
+    count = list_products_stream(iter([]), output=output)
+    assert count == 0
+    assert output.getvalue() == 'No products found.\n'
+
+
+class ProductIndex(object):
+    '''SQLite index of products, keyed by product link.
+
+    For each product it keeps the last seen price and attributes.
+    Changes are saved by save() and are dropped by discard() or when the
+    index is closed without saving them.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS products ('
+            'link TEXT PRIMARY KEY, '
+            'price INTEGER, '
+            'attributes TEXT, '
+            'last_seen REAL)')
+
+    def get(self, link):
+        '''Return the last seen product for `link` or None.'''
+        row = self._connection.execute(
+            'SELECT attributes FROM products WHERE link = ?',
+            (link,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, product):
+        '''Remember `product` as the last seen version for its link.'''
+        self._connection.execute(
+            'INSERT OR REPLACE INTO products '
+            '(link, price, attributes, last_seen) VALUES (?, ?, ?, ?)', (
+                product['link'], product['price'], json.dumps(product),
+                time.time()))
+
+    def save(self):
+        '''Save all changes.'''
+        self._connection.commit()
+
+    def discard(self):
+        '''Drop the changes made since the last save.'''
+        self._connection.rollback()
+
+    def close(self):
+        '''Close the index, dropping the changes which were not saved.'''
+        self._connection.rollback()
+        self._connection.close()
+
+
+class MemoryProductIndex(object):
+    '''Products index kept in memory, with the same interface as
+    ProductIndex.'''
+
+    def __init__(self):
+        self._products = {}
+        # Products set since the last save.
+        self._changes = {}
+
+    def get(self, link):
+        '''Return the last seen product for `link` or None.'''
+        product = self._changes.get(link)
+        if product is None:
+            product = self._products.get(link)
+        return product
+
+    def set(self, product):
+        '''Remember `product` as the last seen version for its link.'''
+        self._changes[product['link']] = product
+
+    def save(self):
+        '''Keep all changes.'''
+        self._products.update(self._changes)
+        self._changes = {}
+
+    def discard(self):
+        '''Drop the changes made since the last save.'''
+        self._changes = {}
+
+    def close(self):
+        '''Do nothing, as the index is not saved to disk.'''
+
+
+def iter_indexed_products(
+        products, product_index, only_new=False, only_changed=False):
+    '''Generate products while updating `product_index` with them.
+
+    If `only_new` is True, only products not found in the index are
+    generated. If `only_changed` is True, products which are cheaper than
+    the last time they were seen are also generated.
+    '''
+    for product in products:
+        previous_product = product_index.get(product['link'])
+        product_index.set(product)
+        if previous_product is None:
+            yield product
+        elif only_changed:
+            if product['price'] < previous_product['price']:
+                yield product
+        elif not only_new:
+            yield product
+
+
+def test_iter_indexed_products():
+    '''Test listing new products using the index.'''
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'index.sqlite')
+    try:
+        product_index = ProductIndex(path)
+        products = [
+            {'link': 'link1', 'price': 10},
+            {'link': 'link2', 'price': 20},
+            ]
+        assert products == list(iter_indexed_products(
+            products, product_index, only_new=True))
+        product_index.save()
+        product_index.close()
+
+        products = [
+            {'link': 'link1', 'price': 9},
+            {'link': 'link2', 'price': 21},
+            {'link': 'link3', 'price': 30},
+            ]
+        product_index = ProductIndex(path)
+        assert products[2:] == list(iter_indexed_products(
+            products, product_index, only_new=True))
+        product_index.save()
+        product_index.close()
+
+        products = [
+            {'link': 'link1', 'price': 8},
+            {'link': 'link2', 'price': 22},
+            {'link': 'link3', 'price': 30},
+            {'link': 'link4', 'price': 40},
+            ]
+        product_index = ProductIndex(path)
+        assert [products[0], products[3]] == list(iter_indexed_products(
+            products, product_index, only_changed=True))
+        assert product_index.get('link2') == {'link': 'link2', 'price': 22}
+        assert products == list(iter_indexed_products(
+            products, product_index))
+        product_index.close()
+
+        # Changes which were not saved are dropped when closing.
+        product_index = ProductIndex(path)
+        product_index.set({'link': 'link5', 'price': 50})
+        product_index.close()
+        product_index = ProductIndex(path)
+        assert product_index.get('link5') is None
+        assert [products[3]] == list(iter_indexed_products(
+            products, product_index, only_new=True))
+        product_index.close()
+    finally:
+        shutil.rmtree(directory)
+
+    product_index = MemoryProductIndex()
+    products = [{'link': 'link1', 'price': 10}]
+    assert products == list(iter_indexed_products(
+        products, product_index, only_changed=True))
+    assert [] == list(iter_indexed_products(
+        products, product_index, only_changed=True))
+    product_index.discard()
+    assert products == list(iter_indexed_products(
+        products, product_index, only_changed=True))
+    product_index.save()
+    product_index.discard()
+    assert [] == list(iter_indexed_products(
+        products, product_index, only_changed=True))
+
+
+def test_report_categories_email_failure():
+    '''Test that products are reported again when the email was not
+    sent.'''
+    global iter_categories_products, send_email
+    original_iter_categories_products = iter_categories_products
+    original_send_email = send_email
+    sent = []
+
+    def fake_iter_categories_products(category_ids, jobs=1, expression=None):
+        for category_id in category_ids:
+            yield category_id, {
+                'link': 'link%s' % category_id, 'name': 'name',
+                'price': 10, 'old-price': 12, 'discount': 2,
+                'discount-percentage': 16}
+
+    def fake_send_email(content, subject, to_address):
+        sent.append(subject)
+        return len(sent) > 1
+
+    class options:
+        category_ids = [1, 2]
+        jobs = 1
+        stream = False
+        email = 'to@example.com'
+        email_digest = False
+        email_subject = ''
+        filter = ''
+
+    iter_categories_products = fake_iter_categories_products
+    send_email = fake_send_email
+    try:
+        product_index = MemoryProductIndex()
+        report_categories(
+            [1, 2], options, Expression(), product_index, only_new=True)
+        assert 2 == len(sent)
+        assert product_index.get('link1') is None
+        assert product_index.get('link2') is not None
+
+        options.email_digest = True
+        counts = report_categories(
+            [1, 2], options, Expression(), product_index, only_new=True)
+        assert {1: 1, 2: 0} == counts
+        assert 3 == len(sent)
+        assert product_index.get('link1') is not None
+    finally:
+        iter_categories_products = original_iter_categories_products
+        send_email = original_send_email
+
+
+def report_categories(
+        category_ids, options, expression, product_index=None,
+        only_new=False, only_changed=False, silent=False):
+    '''List or email the products matching `expression` from all
+    `category_ids` and return a dictionary with the number of reported
+    products for each category.
+
+    When `product_index` is set, it is updated with the products and
+    `only_new` and `only_changed` are used as for iter_indexed_products.
+    Changes to the index are dropped when their email could not be sent,
+    so that the products are reported again by the next run.
+    If `silent` is True, categories without products are not reported.
+    '''
+    def save_index(saved):
+        if product_index is None:
+            return
+        if saved:
+            product_index.save()
+        else:
+            product_index.discard()
+
+    # Show the category of products only when getting multiple categories.
+    show_categories = len(options.category_ids) > 1
+    products_counts = dict.fromkeys(category_ids, 0)
+    digest = []
+    categories = iter_grouped_products(
+        iter_categories_products(category_ids, options.jobs, expression),
+        category_ids)
+    for category_id, products in categories:
+        products = iter_filtered_products(
+            products=products, expression=expression)
+        if product_index is not None:
+            products = iter_indexed_products(
+                products, product_index, only_new=only_new,
+                only_changed=only_changed)
+
+        if options.stream and options.email is None:
+            products = peek_first(products)
+            if products is None:
+                if silent:
+                    continue
+                products = []
+            if show_categories:
+                print 'Category %s:' % get_category_label(category_id)
+            products_counts[category_id] += list_products_stream(products)
+            continue
+
+        products = list(products)
+        products_counts[category_id] += len(products)
+        if silent and len(products) < 1:
+            continue
+
+        if options.email is None:
+            if show_categories:
+                print 'Category %s:' % get_category_label(category_id)
+            list_products(products)
+        elif options.email_digest:
+            digest.append((category_id, products))
+        else:
+            save_index(email_products(products, options, category_id))
+
+    sent = True
+    if digest:
+        sent = email_products_digest(digest, options)
+    save_index(sent)
+    return products_counts
+
+
+class WatchSchedule(object):
+    '''Times at which each category should be checked again.
+
+    Each category is checked every `interval` seconds, changed by a random
+    fraction of up to `jitter`.
+    '''
+
+    def __init__(self, category_ids, interval, jitter=WATCH_JITTER):
+        self.category_ids = category_ids
+        self.interval = interval
+        self.jitter = jitter
+        self._next_times = dict.fromkeys(category_ids, 0)
+        self._checked_times = {}
+
+    def get_due(self, now):
+        '''Return the categories which should be checked at `now`.'''
+        return [
+            category_id for category_id in self.category_ids
+            if self._next_times[category_id] <= now]
 
+    def get_next_time(self):
+        '''Return the time at which the next category should be checked.'''
+        return min(self._next_times.values())
 
-def email_products(products, options):
-    '''Send products over email.'''
-    email_subject = ''
+    def get_interval(self, category_id):
+        '''Return the seconds between checks of `category_id`.'''
+        return self.interval
+
+    def set_checked(self, category_ids, now):
+        '''Schedule the next check of `category_ids`, checked at `now`.'''
+        for category_id in category_ids:
+            self._checked_times[category_id] = now
+            self._next_times[category_id] = now + self.get_interval(
+                category_id) * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def observe(self, category_id, changed, pages, now):
+        '''Do nothing, as the interval is the same for all categories.'''
+
+    def save(self):
+        '''Do nothing, as there is nothing learned.'''
+
+
+class PrioritySchedule(WatchSchedule):
+    '''Schedule checking more often the categories which more often have
+    new or cheaper products, using at most `budget` requests per hour.
+
+    Each category is checked a number of times proportional to its rate
+    of changes, but not more often than every `interval` seconds and not
+    less often than every WATCH_MAX_INTERVAL seconds.
+
+    `stats` maps category keys to dictionaries with the weighted number of
+    `changes` observed during `seconds` and the number of `pages` of the
+    category. When `path` is set, `stats` are saved there.
+    '''
+
+    def __init__(self, category_ids, interval, budget, stats=None,
+                 path=None, jitter=WATCH_JITTER):
+        super(PrioritySchedule, self).__init__(category_ids, interval, jitter)
+        self.budget = budget
+        if stats is None:
+            stats = {}
+        self.stats = stats
+        self.path = path
+
+    def get_change_rate(self, category_id):
+        '''Return the estimated changes per second of `category_id`.'''
+        stats = self.stats.get(self._get_key(category_id), {})
+        return (stats.get('changes', 0) + 1.0) / (
+            stats.get('seconds', 0) + WATCH_PRIOR_SECONDS)
+
+    def get_pages(self, category_id):
+        '''Return the number of requests for checking `category_id`.'''
+        stats = self.stats.get(self._get_key(category_id), {})
+        return stats.get('pages', len(get_products_sources()))
+
+    def get_interval(self, category_id):
+        '''Return the seconds between checks of `category_id`.'''
+        total = sum([
+            self.get_change_rate(other_id) * self.get_pages(other_id)
+            for other_id in self.category_ids])
+        interval = 3600.0 * total / (
+            self.budget * self.get_change_rate(category_id))
+        return min(max(interval, self.interval), WATCH_MAX_INTERVAL)
+
+    def observe(self, category_id, changed, pages, now):
+        '''Record that checking `category_id` at `now` required `pages`
+        requests and found new or cheaper products if `changed` is True.
+        '''
+        stats = self.stats.setdefault(self._get_key(category_id), {})
+        stats['pages'] = pages
+        checked_time = self._checked_times.get(category_id)
+        if checked_time is None:
+            # Changes are only known since the previous check.
+            return
+        seconds = now - checked_time
+        weight = 0.5 ** (seconds / WATCH_HALF_LIFE)
+        stats['changes'] = stats.get('changes', 0) * weight + int(changed)
+        stats['seconds'] = stats.get('seconds', 0) * weight + seconds
+
+    def save(self):
+        '''Save the statistics at `path`, if set.'''
+        if self.path is not None:
+            save_watch_stats(self.path, self.stats)
+
+    def _get_key(self, category_id):
+        return str(category_id)
+
+
+def load_watch_stats(path):
+    '''Return the PrioritySchedule statistics saved at `path`.'''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as stats_file:
+        return json.load(stats_file)
+
+
+def save_watch_stats(path, stats):
+    '''Save the PrioritySchedule `stats` at `path`.'''
+    with AtomicFile(path) as stats_file:
+        json.dump(stats, stats_file, indent=2, sort_keys=True)
+
+
+def test_watch_schedule():
+    '''Test scheduling categories with jitter.'''
+    schedule = WatchSchedule(['1', '2', '3'], interval=100, jitter=0.2)
+    assert ['1', '2', '3'] == schedule.get_due(0)
+    schedule.set_checked(['1', '2', '3'], 1000)
+    assert [] == schedule.get_due(1079)
+    assert 1080 <= schedule.get_next_time() <= 1120
+    assert ['1', '2', '3'] == schedule.get_due(1120)
+
+    schedule.set_checked(['2'], 2000)
+    assert ['1', '3'] == schedule.get_due(1120)
+    next_times = set()
+    for index in xrange(10):
+        schedule.set_checked(['1', '2', '3'], 1000)
+        next_times.update(schedule._next_times.values())
+    assert len(next_times) > 3
+
+
+def test_priority_schedule():
+    '''Test checking more often the categories which change more often,
+    using at most the budget of requests.'''
+    stats = {
+        '1': {'changes': 10, 'seconds': 3600, 'pages': 2},
+        '2': {'changes': 0, 'seconds': 36000, 'pages': 2},
+        }
+    schedule = PrioritySchedule([1, 2, 3], interval=1, budget=3600,
+                                stats=stats, jitter=0)
+    hot_interval = schedule.get_interval(1)
+    cold_interval = schedule.get_interval(2)
+    new_interval = schedule.get_interval(3)
+    assert hot_interval < new_interval < cold_interval
+    requests = 3600 * (2 / hot_interval + 2 / cold_interval +
+                       2 / new_interval)
+    assert 3599 < requests < 3601
+
+    schedule.interval = 60
+    assert 60 == schedule.get_interval(1)
+    schedule.budget = 1
+    assert WATCH_MAX_INTERVAL == schedule.get_interval(2)
+
+    # Changes are observed since the previous check.
+    schedule.observe(3, True, 4, 1000)
+    assert {'pages': 4} == stats['3']
+    schedule.set_checked([3], 1000)
+    assert 1000 + schedule.get_interval(3) == schedule._next_times[3]
+    schedule.observe(3, True, 4, 1000 + WATCH_HALF_LIFE)
+    assert {
+        'pages': 4, 'changes': 1, 'seconds': WATCH_HALF_LIFE} == stats['3']
+    schedule.set_checked([3], 1000 + WATCH_HALF_LIFE)
+    schedule.observe(3, False, 4, 1000 + 2 * WATCH_HALF_LIFE)
+    assert {
+        'pages': 4, 'changes': 0.5,
+        'seconds': 1.5 * WATCH_HALF_LIFE} == stats['3']
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'watch.json')
+        assert {} == load_watch_stats(path)
+        schedule.path = path
+        schedule.save()
+        assert stats == load_watch_stats(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def watch_categories(options, expression, product_index, schedule):
+    '''Check categories from `schedule` when they are due and report
+    products which are new or cheaper than at the previous check.
+
+    It only stops on KeyboardInterrupt.
+    '''
+    while True:
+        sys.stdout.flush()
+        delay = schedule.get_next_time() - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        category_ids = schedule.get_due(time.time())
+        products_counts = report_categories(
+            category_ids, options, expression, product_index,
+            only_new=options.only_new, only_changed=not options.only_new,
+            silent=True)
+        now = time.time()
+        for category_id in category_ids:
+            schedule.observe(
+                category_id, products_counts[category_id] > 0,
+                CATEGORY_PAGES.get(category_id, 1), now)
+        schedule.set_checked(category_ids, now)
+        schedule.save()
+
+
+def email_products(products, options, category_id=None):
+    '''Send products from category over email.
+
+    Return False if the email could not be sent.
+    '''
+    products_count = len(products)
+    email_subject = get_email_subject(
+        options, products_count, get_category_label(category_id))
+    message_header = (
+        'Got %d results for products in category %s.\n'
+        'Using filter expression: "%s"\n\n' % (
+            products_count, get_category_label(category_id),
+            options.filter))
+
+    products_details = products_to_string(products)
+    return send_email(
+        message_header + products_details + EMAIL_SIGNATURE,
+        email_subject, options.email)
+
+
+def email_products_digest(categories_products, options):
+    '''Send products from all categories in a single email.
+
+    `categories_products` is a list of (category_id, products) tuples.
+    Return False if the email could not be sent.
+    '''
+    products_count = 0
+    sections = []
+    for category_id, products in categories_products:
+        products_count += len(products)
+        sections.append(
+            'Got %d results for products in category %s.\n\n%s' % (
+                len(products), get_category_label(category_id),
+                products_to_string(products)))
+
+    categories_label = ','.join([
+        get_category_label(category_id)
+        for category_id, products in categories_products])
+    email_subject = get_email_subject(
+        options, products_count, categories_label)
+    message_header = 'Using filter expression: "%s"\n\n' % options.filter
+    return send_email(
+        message_header + '\n\n'.join(sections) + EMAIL_SIGNATURE,
+        email_subject, options.email)
+
+
+def get_email_subject(options, products_count, categories_label):
+    '''Return the subject for an email with `products_count` products.'''
     if not options.email_subject:
         email_main_subject = EMAIL_SUBJECT
     else:
-        email_main_subject = options.subject
+        email_main_subject = options.email_subject
 
-    email_tag = ''
-    products_count = len(products)
     if products_count > 0:
         email_tag = EMAIL_SUBJECT_GOT_RESULTS
     else:
         email_tag = EMAIL_SUBJECT_NO_RESULTS
 
-    email_subject = '%s %s (%d-%d)' % (
-        email_tag, email_main_subject, options.category_id, products_count)
-    message_header = (
-        'Got %d results for products in category %d.\n'
-        'Using filter expression: "%s"\n\n' % (
-            products_count, options.category_id, options.filter))
+    return '%s %s (%s-%d)' % (
+        email_tag, email_main_subject, categories_label, products_count)
 
-    products_details = products_to_string(products)
-    message = MIMEText(
-        message_header + products_details + EMAIL_SIGNATURE)
-    message['Subject'] = email_subject
+
+def get_category_label(category_id):
+    '''Return the text used for a category in emails and listings.'''
+    if category_id is None:
+        return 'all'
+    return str(category_id)
+
+
+def send_email(content, subject, to_address):
+    '''Send an email with `content` to `to_address`.
+
+    Return False if it could not be sent or added to MAIL_SPOOL.
+    '''
+    message = MIMEText(content)
+    message['Subject'] = subject
     message['From'] = EMAIL_FROM
-    message['To'] = options.email
+    message['To'] = to_address
+    if MAIL_SPOOL is not None:
+        # Leave the sending to deliver-mail-spool.py.
+        MAIL_SPOOL.add(EMAIL_FROM, [to_address], message.as_string())
+        STATS.increment('emails_spooled')
+        return True
     # Send the message via our own SMTP server, but don't include the
     # envelope header.
-    server = None
     try:
-        server = SMTP(EMAIL_SERVER, EMAIL_PORT)
-        if EMAIL_TLS:
-            server.starttls()
-        if EMAIL_USERNAME:
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        server.sendmail(
-            EMAIL_FROM, [options.email],
-            message.as_string())
-        server.quit()
+        with STATS.stage('email'):
+            SMTP_SESSION.send(EMAIL_FROM, [to_address], message.as_string())
+        STATS.increment('emails_sent')
     except SocketError, error:
         print 'Could not connect to SMTP server. %s' % str(error)
-        return
+        return False
     except SMTPServerDisconnected, error:
         print 'Server does not accepts our credentials.'
-        return
+        return False
+    except SMTPException, error:
+        print 'Could not send email to %s. %s' % (to_address, str(error))
+        return False
+    return True
+
+
+def test_send_email_failure():
+    '''Test that an email which could not be sent is reported.'''
+    global SMTP_SESSION
+    original_session = SMTP_SESSION
+    server = LocalSMTPServer()
+    server.rejected_addresses.add('bad@example.com')
+    SMTP_SESSION = SMTPSession('127.0.0.1', server.port, timeout=5)
+    output = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        assert not send_email('Content', 'Subject', 'bad@example.com')
+        assert 'Could not send email to bad@example.com' in (
+            sys.stdout.getvalue())
+        assert send_email('Content', 'Subject', 'to@example.com')
+    finally:
+        sys.stdout = output
+        SMTP_SESSION.close()
+        SMTP_SESSION = original_session
+        server.stop()
+    assert 1 == len(server.messages)
 
 
 def tag_to_plain_text(tag):
@@ -1075,11 +2720,16 @@ def get_options_or_print_help():
     parser = OptionParser()
 
     parser.add_option(
-        '-c', '--category-id', action='store', type="int", dest='category_id',
-        metavar="ID", default=None,
+        '-c', '--category-id', action='store', type="string",
+        dest='category_id', metavar="ID1,ID2", default=None,
         help=(
-            'Products category ID to get. If no category is specified the '
-            'script will get products from all categories.'))
+            'Comma separated list of products category IDs to get. If no '
+            'category is specified the script will get products from all '
+            'categories.'))
+    parser.add_option(
+        '--category-file', action='store', type='string',
+        dest='category_file', metavar='FILE', default=None,
+        help='Also get products for category IDs from FILE, one per line.')
     parser.add_option(
         '-t', '--run-tests', action='store_true', dest='test', default=False,
         help='Run the (primitive) test suite.')
@@ -1098,16 +2748,132 @@ def get_options_or_print_help():
         '--email-subject', action='store', type='string',
         dest='email_subject', default='', metavar='SUBJECT',
         help='Use SUBJECT as email subject.')
+    parser.add_option(
+        '--email-digest', action='store_true', dest='email_digest',
+        default=False,
+        help=(
+            'Send a single email for all categories instead of one email '
+            'for each category.'))
     parser.add_option(
         '-s', '--silent', action='store_true', dest='silent', default=False,
         help='Do not output/email anything if no results were found.')
+    parser.add_option(
+        '--index-file', action='store', type='string', dest='index_file',
+        default=None, metavar='FILE',
+        help=(
+            'Remember the price of all listed products in FILE, so that '
+            'later runs can list only new products.'))
+    parser.add_option(
+        '--only-new', action='store_true', dest='only_new', default=False,
+        help='Only list products which are not in the index file.')
+    parser.add_option(
+        '--only-changed', action='store_true', dest='only_changed',
+        default=False,
+        help=(
+            'Only list products which are not in the index file or which '
+            'are now cheaper.'))
+    parser.add_option(
+        '--stream', action='store_true', dest='stream', default=False,
+        help=(
+            'List products as soon as their page is parsed, without '
+            'keeping all products in memory.'))
+    parser.add_option(
+        '-j', '--jobs', action='store', type='int', dest='jobs', default=1,
+        metavar='N',
+        help=(
+            'Fetch pages using N concurrent requests, over at most N '
+            'connections. Requests are also limited to %d per second. '
+            'Default 1.' % HTTP_RATE))
+    parser.add_option(
+        '--parser', action='store', type='choice', dest='parser',
+        choices=['soup', 'stream'], default=PAGE_PARSER, metavar='ENGINE',
+        help=(
+            'Engine used for parsing pages: "soup" builds a BeautifulSoup '
+            'tree, "stream" parses products in a single pass. '
+            'Default %s.' % PAGE_PARSER))
+    parser.add_option(
+        '--mail-spool', action='store', type='string', dest='mail_spool',
+        default=None, metavar='DIR',
+        help=(
+            'Add emails to the spool from DIR instead of sending them. '
+            'Use deliver-mail-spool.py for sending them.'))
+    parser.add_option(
+        '--watch', action='store', type='int', dest='watch', default=None,
+        metavar='SECONDS',
+        help=(
+            'Keep running and check each category again about every '
+            'SECONDS. After the first check, only products which are new '
+            'or cheaper are reported. Connections, caches and products '
+            'are kept in memory between checks.'))
+    parser.add_option(
+        '--watch-budget', action='store', type='int', dest='watch_budget',
+        default=None, metavar='REQUESTS',
+        help=(
+            'With --watch, make at most REQUESTS requests per hour and '
+            'check more often the categories which more often have new or '
+            'cheaper products. SECONDS from --watch is the shortest time '
+            'between checks of a category.'))
+    parser.add_option(
+        '--watch-stats', action='store', type='string', dest='watch_stats',
+        default=None, metavar='FILE',
+        help=(
+            'Keep in FILE how often each category has new or cheaper '
+            'products, for using it with --watch-budget in later runs.'))
+    parser.add_option(
+        '--stats-json', action='store', type='string', dest='stats_json',
+        default=None, metavar='FILE',
+        help=(
+            'Save to FILE the time used for fetching, parsing, filtering and '
+            'emailing, the number of pages and products, and the latency '
+            'of requests.'))
+    parser.add_option(
+        '--profile', action='store', type='string', dest='profile',
+        default=None, metavar='FILE',
+        help=(
+            'Profile the run and save the results to FILE. Use '
+            '"python -m pstats FILE" to view them. Without --profile-stage '
+            'only the main thread is profiled.'))
+    parser.add_option(
+        '--profile-stage', action='store', type='choice',
+        dest='profile_stage', default=None, metavar='STAGE',
+        choices=['fetch', 'parse', 'filter', 'output', 'email'],
+        help=(
+            'Only profile STAGE, from all threads. '
+            'STAGE is one of: fetch, parse, filter, output or email.'))
+    parser.add_option(
+        '--cache-dir', action='store', type='string', dest='cache_dir',
+        default=None, metavar='DIR',
+        help=(
+            'Keep downloaded pages and parsed products in DIR and only '
+            'download and parse pages again if they were changed.'))
+    parser.add_option(
+        '--cache-max-mb', action='store', type='int', dest='cache_max_mb',
+        default=CACHE_MAX_MB, metavar='MB',
+        help=(
+            'Remove least recently used pages when cache is bigger than MB '
+            'megabytes. %d%% of MB is used for parsed products and the '
+            'rest for downloaded pages. Default %d.' % (
+                PARSED_PAGES_CACHE_SHARE * 100, CACHE_MAX_MB)))
 
     (options, args) = parser.parse_args()
     if len(args) > 0:
         parser.print_help()
         sys.exit(1)
-    else:
-        return options
+
+    try:
+        options.category_ids = get_category_ids(
+            options.category_id, options.category_file)
+    except (IOError, ValueError), error:
+        parser.error('Invalid category IDs. %s' % error)
+    if options.jobs < 1:
+        parser.error('--jobs must be greater than 0.')
+    if options.profile_stage is not None and options.profile is None:
+        parser.error('--profile-stage can only be used with --profile.')
+    if options.watch_budget is not None and options.watch is None:
+        parser.error('--watch-budget can only be used with --watch.')
+    if options.watch_stats is not None and options.watch_budget is None:
+        parser.error('--watch-stats can only be used with --watch-budget.')
+    return options
 
 
 if __name__ == "__main__":
@@ -1117,23 +2883,89 @@ if __name__ == "__main__":
         run_all_tests(options.test_exit)
         sys.exit(0)
 
-    if options.category_id is None and options.email is None:
+    PAGE_PARSER = options.parser
+    HTTP_CLIENT.max_connections_per_host = options.jobs
+
+    if options.mail_spool:
+        MAIL_SPOOL = MailSpool(options.mail_spool)
+
+    # Both caches share the --cache-max-mb limit.
+    products_cache_size = int(
+        options.cache_max_mb * 1024 * 1024 * PARSED_PAGES_CACHE_SHARE)
+    pages_cache_size = (
+        options.cache_max_mb * 1024 * 1024 - products_cache_size)
+    if options.cache_dir:
+        HTTP_CLIENT.cache = HTTPCache(
+            DiskCache(options.cache_dir, pages_cache_size))
+        PARSED_PAGES_CACHE = ParsedPagesCache(DiskCache(
+            os.path.join(options.cache_dir, 'products'),
+            products_cache_size))
+    elif options.watch:
+        HTTP_CLIENT.cache = HTTPCache(MemoryCache(pages_cache_size))
+        PARSED_PAGES_CACHE = ParsedPagesCache(
+            MemoryCache(products_cache_size))
+
+    if options.category_ids == [None] and options.email is None:
         print 'Getting all categories will take a while...'
         print 'Hope your patience will get a hefty reward!'
 
+    product_index = None
+    if options.index_file:
+        product_index = ProductIndex(options.index_file)
+    elif options.only_new or options.only_changed:
+        print 'An index file is required for listing only new products.'
+        print 'See --help for usage'
+        sys.exit(2)
+    elif options.watch:
+        product_index = MemoryProductIndex()
+
+    profiler = None
+    if options.profile:
+        profiler = Profiler(options.profile_stage)
+        STATS.profiler = profiler
+        profiler.start_run()
+
     try:
-        products = filter_products(
-            products=get_all_products(options.category_id),
-            expression=options.filter)
+        expression = parse_expression(options.filter)
+        products_count = sum(report_categories(
+            options.category_ids, options, expression, product_index,
+            only_new=options.only_new, only_changed=options.only_changed,
+            silent=options.silent).values())
+        if options.watch_budget:
+            stats = {}
+            if options.watch_stats:
+                stats = load_watch_stats(options.watch_stats)
+            schedule = PrioritySchedule(
+                options.category_ids, options.watch, options.watch_budget,
+                stats, options.watch_stats)
+        elif options.watch:
+            schedule = WatchSchedule(options.category_ids, options.watch)
+        if options.watch:
+            now = time.time()
+            for category_id in options.category_ids:
+                schedule.observe(
+                    category_id, False, CATEGORY_PAGES.get(category_id, 1),
+                    now)
+            schedule.set_checked(options.category_ids, now)
+            try:
+                watch_categories(
+                    options, expression, product_index, schedule)
+            except KeyboardInterrupt:
+                pass
     except ExpressionError, error:
         print str(error)
         print 'See --help for usage'
         sys.exit(2)
-
-    if options.silent and len(products) < 1:
+    finally:
+        if product_index is not None:
+            product_index.close()
+        SMTP_SESSION.close()
+        if options.stats_json:
+            STATS.save(options.stats_json)
+        if profiler is not None:
+            profiler.stop_run()
+            if not profiler.save(options.profile):
+                print >> sys.stderr, 'Nothing was profiled.'
+
+    if options.silent and products_count < 1:
         sys.exit(1)
-
-    if options.email is not None:
-        email_products(products, options)
-    else:
-        list_products(products)
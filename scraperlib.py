@@ -0,0 +1,1749 @@
+#!/usr/bin/env python
+'''Code shared by the scraping scripts from this repository.
+
+It only depends on the standard library.
+
+Run this file with --run-tests to run its (primitive) test suite.
+
+Distributed under WTFPL 2.0.
+'''
+
+import cProfile
+import fcntl
+import hashlib
+import httplib
+import json
+import os
+import pstats
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import urllib2
+import urlparse
+import zlib
+from cStringIO import StringIO
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from optparse import OptionParser
+from Queue import Empty, Queue
+from smtplib import (
+    SMTP, SMTPException, SMTPRecipientsRefused, SMTPResponseException,
+    SMTPServerDisconnected)
+from threading import BoundedSemaphore, Event, Lock, Thread
+
+# Value of the User-Agent header sent with all requests.
+HTTP_USER_AGENT = 'Python-urllib/%s' % urllib2.__version__
+# Maximum number of connections opened in parallel to the same host.
+HTTP_MAX_CONNECTIONS_PER_HOST = 4
+# Socket timeout, in seconds, for reading HTTP responses.
+HTTP_TIMEOUT = 60
+# Timeout, in seconds, for opening HTTP connections.
+HTTP_CONNECT_TIMEOUT = 10
+# Number of times a failed request is sent again. Only connection errors and
+# responses with one of HTTP_RETRY_CODES are retried.
+HTTP_RETRIES = 3
+HTTP_RETRY_CODES = (408, 429, 500, 502, 503, 504)
+# Maximum delay, in seconds, before retrying a request. The maximum is
+# doubled after each retry, up to HTTP_MAX_RETRY_DELAY, and the delay is a
+# random value up to the maximum.
+HTTP_RETRY_DELAY = 1
+HTTP_MAX_RETRY_DELAY = 30
+# Maximum average number of requests per second sent to the same host, and
+# number of requests which can be sent at once after a pause.
+HTTP_RATE = 10
+HTTP_BURST = 10
+# After this many requests to a host fail in a row, requests to that host
+# fail without being sent for HTTP_BREAKER_TIMEOUT seconds.
+HTTP_BREAKER_FAILURES = 5
+HTTP_BREAKER_TIMEOUT = 60
+# Maximum number of redirects followed for a single request.
+HTTP_MAX_REDIRECTS = 5
+# Status codes for which the Location header is followed.
+HTTP_REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Default maximum size, in megabytes, of the on-disk cache.
+CACHE_MAX_MB = 100
+# Upper limits, in seconds, of the buckets from the latency histograms.
+STATS_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# SMTP server used for sending emails by all the scripts and by
+# deliver-mail-spool.py.
+EMAIL_SERVER = '127.0.0.1'
+# SMTP server port.
+# Make sure your provider is not blocking port 25.
+# For Dreamhost you can use 587
+EMAIL_PORT = 25
+# Connect to SMTP server using TLS.
+EMAIL_TLS = False
+# SMTP username. Set None for not using SMTP authentication
+EMAIL_USERNAME = None
+#  SMTP password. Ignored if EMAIL_USERNAME is None.
+EMAIL_PASSWORD = ''
+# Socket timeout, in seconds, for SMTP connections.
+SMTP_TIMEOUT = 60
+# Delay, in seconds, before sending again a spooled message which failed.
+# It is doubled after each failure, up to SPOOL_MAX_RETRY_DELAY.
+SPOOL_RETRY_DELAY = 60
+SPOOL_MAX_RETRY_DELAY = 3600
+# Spooled messages failing this many times are moved to the failed folder.
+SPOOL_MAX_ATTEMPTS = 10
+
+
+class HTTPResponse(object):
+    '''The result of a successful HTTP GET request.
+
+    `body` is always the decoded content, even if the server sent it
+    compressed.
+    '''
+
+    def __init__(self, url, status, headers, body, from_cache=False):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # True when the server said the page was not modified and the body
+        # comes from the on-disk cache.
+        self.from_cache = from_cache
+
+
+class HTTPClient(object):
+    '''HTTP client keeping a pool of persistent connections for each host.
+
+    Connections are reused for all requests made with the same client, so
+    only the first request to a host pays for the TCP and TLS handshakes.
+
+    The client is thread safe. At most `max_connections_per_host`
+    requests are sent in parallel to the same host, other requests wait
+    for a free connection.
+
+    Errors are reported using the urllib2 exceptions so that callers can
+    handle them like errors raised by urllib2.urlopen.
+
+    When `cache` is an HTTPCache, pages are requested using conditional
+    GET requests and the cached body is used if the page was not modified.
+
+    When `stats` is a Stats, the latency of each request and the received
+    bytes are recorded.
+
+    Requests to a host are limited to `rate` per second by a TokenBucket.
+    Requests failing with connection errors or HTTP_RETRY_CODES are sent
+    again up to `retries` times, after a random delay which is doubled
+    after each retry. When requests to a host keep failing, a
+    CircuitBreaker makes the next ones fail without being sent.
+    '''
+
+    def __init__(
+            self, max_connections_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            timeout=HTTP_TIMEOUT, cache=None, stats=None,
+            connect_timeout=HTTP_CONNECT_TIMEOUT, retries=HTTP_RETRIES,
+            rate=HTTP_RATE, burst=HTTP_BURST):
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = stats
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.rate = rate
+        self.burst = burst
+        # Idle connections, connection slots, token buckets and circuit
+        # breakers, keyed by (scheme, host, port).
+        self._idle_connections = {}
+        self._host_slots = {}
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = Lock()
+
+    def get(self, url, headers=None):
+        '''Return the HTTPResponse for `url`, following redirects.'''
+        requested_url = url
+        cached_response = None
+        if self.cache is not None:
+            cached_response = self.cache.get_response(url)
+        if cached_response is not None:
+            headers = dict(headers or {})
+            headers.update(get_conditional_headers(cached_response))
+
+        for redirect in xrange(HTTP_MAX_REDIRECTS + 1):
+            response = self._request_with_retries(url, headers)
+            location = response.headers.get('location')
+            if response.status not in HTTP_REDIRECT_CODES or not location:
+                break
+            url = urlparse.urljoin(url, location)
+        else:
+            raise urllib2.HTTPError(
+                url, response.status, 'Too many redirects.',
+                response.headers, StringIO(response.body))
+
+        if response.status == 304 and cached_response is not None:
+            if self.stats is not None:
+                self.stats.increment('http_not_modified')
+            return cached_response
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(
+                url, response.status, httplib.responses.get(
+                    response.status, 'Unknown error'),
+                response.headers, StringIO(response.body))
+
+        if self.cache is not None and response.status == 200:
+            self.cache.set_response(requested_url, response)
+        return response
+
+    def close(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            for connections in self._idle_connections.values():
+                for connection in connections:
+                    connection.close()
+            self._idle_connections = {}
+
+    def _request_with_retries(self, url, headers=None):
+        '''Send a GET request, retrying it if it fails, and return the
+        HTTPResponse.
+
+        The response of the last try is returned even if its status is one
+        of HTTP_RETRY_CODES.
+        '''
+        key = self._get_host_key(url)
+        breaker = self._get_host_breaker(key)
+        bucket = self._get_host_bucket(key)
+        for attempt in xrange(self.retries + 1):
+            if not breaker.allow():
+                raise urllib2.URLError(
+                    'Too many failed requests to %s. Not trying again for '
+                    '%d seconds.' % (key[1], breaker.timeout))
+            if attempt > 0 and self.stats is not None:
+                self.stats.increment('http_retries')
+            if bucket is not None:
+                bucket.acquire()
+
+            start_time = time.time()
+            try:
+                response = self._request(url, headers)
+            except urllib2.URLError:
+                breaker.add_failure()
+                if attempt >= self.retries:
+                    raise
+                self._wait_retry(attempt)
+                continue
+            if self.stats is not None:
+                self.stats.add_latency(url, time.time() - start_time)
+                self.stats.increment('http_requests')
+                self.stats.increment('http_bytes', len(response.body))
+
+            if response.status not in HTTP_RETRY_CODES:
+                breaker.add_success()
+                return response
+            breaker.add_failure()
+            if attempt >= self.retries:
+                return response
+            self._wait_retry(attempt, response.headers.get('retry-after'))
+
+    def _wait_retry(self, attempt, retry_after=None):
+        '''Sleep before retrying a request for the `attempt` time.
+
+        `retry_after` is the value of the Retry-After header, which is used
+        when it is a number of seconds.
+        '''
+        if retry_after is not None and retry_after.strip().isdigit():
+            delay = min(int(retry_after), HTTP_MAX_RETRY_DELAY)
+        else:
+            delay = random.uniform(0, min(
+                HTTP_RETRY_DELAY * 2 ** attempt, HTTP_MAX_RETRY_DELAY))
+        time.sleep(delay)
+
+    def _get_host_key(self, url):
+        '''Return the (scheme, host, port) key for `url`.'''
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib2.URLError('Unknown URL scheme for %s.' % url)
+        if parts.scheme == 'https':
+            port = parts.port or httplib.HTTPS_PORT
+        else:
+            port = parts.port or httplib.HTTP_PORT
+        return (parts.scheme, parts.hostname, port)
+
+    def _request(self, url, headers=None):
+        '''Send a single GET request and return the HTTPResponse.
+
+        If the server closed an idle connection, the request is sent over a
+        new one. Other errors are raised, as they are retried by
+        _request_with_retries.
+        '''
+        key = self._get_host_key(url)
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        request_headers = {
+            'User-Agent': HTTP_USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+            }
+        if headers:
+            request_headers.update(headers)
+
+        slot = self._get_host_slot(key)
+        with slot:
+            connection = self._get_idle_connection(key)
+            if connection is not None:
+                try:
+                    return self._send(
+                        key, connection, url, path, request_headers)
+                except socket.timeout, error:
+                    # The server is slow, not gone.
+                    connection.close()
+                    raise urllib2.URLError(error)
+                except (httplib.HTTPException, socket.error):
+                    # Server closed the kept-alive connection.
+                    connection.close()
+            try:
+                connection = self._create_connection(key)
+            except (httplib.HTTPException, socket.error), error:
+                raise urllib2.URLError(error)
+            try:
+                return self._send(
+                    key, connection, url, path, request_headers)
+            except (httplib.HTTPException, socket.error), error:
+                connection.close()
+                raise urllib2.URLError(error)
+
+    def _send(self, key, connection, url, path, headers):
+        '''Send the request over `connection` and read the response.
+
+        The connection is put back in the idle pool if the server allows it.
+        '''
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        response_headers = dict(response.getheaders())
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle_connections.setdefault(key, []).append(connection)
+        body = decode_content(body, response_headers.get('content-encoding'))
+        return HTTPResponse(url, response.status, response_headers, body)
+
+    def _get_host_slot(self, key):
+        '''Return the semaphore limiting connections to host `key`.'''
+        with self._lock:
+            if key not in self._host_slots:
+                self._host_slots[key] = BoundedSemaphore(
+                    self.max_connections_per_host)
+            return self._host_slots[key]
+
+    def _get_host_bucket(self, key):
+        '''Return the TokenBucket limiting requests to host `key` or None
+        if requests are not limited.'''
+        if not self.rate:
+            return None
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    def _get_host_breaker(self, key):
+        '''Return the CircuitBreaker for host `key`.'''
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker()
+            return self._breakers[key]
+
+    def _get_idle_connection(self, key):
+        '''Return an idle connection to host `key` or None.'''
+        with self._lock:
+            connections = self._idle_connections.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def _create_connection(self, key):
+        '''Return a new connection for host `key`, already connected.'''
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(
+                host, port, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(
+                host, port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.timeout)
+        return connection
+
+
+class TokenBucket(object):
+    '''Rate limiter allowing on average `rate` operations per second and at
+    most `burst` operations at once after a pause.
+
+    The object is thread safe. Threads wait for their turn in the order in
+    which they called acquire.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._time = time.time()
+        self._lock = Lock()
+
+    def acquire(self):
+        '''Wait until an operation is allowed.'''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            # A negative number of tokens reserves the next tokens.
+            self._tokens -= 1
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CircuitBreaker(object):
+    '''Stop calling a service after `failures` calls fail in a row.
+
+    Calls are not allowed for `timeout` seconds. After that, a single
+    call is allowed as a probe. Other calls are not allowed until the probe
+    succeeds, or until `timeout` seconds pass if it fails or is never
+    recorded.
+    The object is thread safe.
+    '''
+
+    def __init__(
+            self, failures=HTTP_BREAKER_FAILURES,
+            timeout=HTTP_BREAKER_TIMEOUT):
+        self.failures = failures
+        self.timeout = timeout
+        self._failures_count = 0
+        self._open_until = 0
+        self._lock = Lock()
+
+    def allow(self):
+        '''Return True if a call is allowed now.'''
+        with self._lock:
+            if self._failures_count < self.failures:
+                return True
+            now = time.time()
+            if now < self._open_until:
+                return False
+            # Allow a single probe, and stop other calls until it ends.
+            self._open_until = now + self.timeout
+            return True
+
+    def add_success(self):
+        '''Record a successful call.'''
+        with self._lock:
+            self._failures_count = 0
+            self._open_until = 0
+
+    def add_failure(self):
+        '''Record a failed call.'''
+        with self._lock:
+            self._failures_count += 1
+            if self._failures_count >= self.failures:
+                self._open_until = time.time() + self.timeout
+
+
+def get_conditional_headers(response):
+    '''Return the headers for revalidating the cached `response`.'''
+    headers = {}
+    if response.headers.get('etag'):
+        headers['If-None-Match'] = response.headers['etag']
+    if response.headers.get('last-modified'):
+        headers['If-Modified-Since'] = response.headers['last-modified']
+    return headers
+
+
+class Stats(object):
+    '''Counters, stage durations and request latencies for a run.
+
+    Stage durations are added from all threads, so with concurrent work
+    they can be longer than the run.
+    Latencies are grouped by URL without the query, in histograms with the
+    STATS_LATENCY_BUCKETS. A histogram is a list of [upper_limit, count]
+    and the last upper limit is None.
+    The object is thread safe.
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        # Map of stage name to [count, seconds].
+        self.stages = {}
+        # Map of URL to [count, seconds, maximum_seconds, buckets_counts].
+        self.latencies = {}
+        # Profiler used for one of the stages, or None.
+        self.profiler = None
+        self._lock = Lock()
+
+    def increment(self, name, value=1):
+        '''Add `value` to the counter `name`.'''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager adding its duration to stage `name`.
+
+        The stage is profiled when `profiler` is set for it.
+        '''
+        profile = None
+        profiler = self.get_profiler(name)
+        if profiler is not None:
+            profile = profiler.start()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.time() - start_time)
+            if profile is not None:
+                self.profiler.stop(profile)
+
+    def get_profiler(self, name):
+        '''Return the profiler for stage `name` or None if it is not
+        profiled.
+
+        It is used for stages timed with add_stage_time.
+        '''
+        if self.profiler is not None and self.profiler.stage == name:
+            return self.profiler
+        return None
+
+    def add_stage_time(self, name, seconds):
+        '''Add `seconds` to the duration of stage `name`.'''
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+
+    def add_latency(self, url, seconds):
+        '''Add a request to `url` which took `seconds`.'''
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        url = urlparse.urlunsplit((scheme, host, path, '', ''))
+        bucket = len(STATS_LATENCY_BUCKETS)
+        for index, limit in enumerate(STATS_LATENCY_BUCKETS):
+            if seconds <= limit:
+                bucket = index
+                break
+        with self._lock:
+            latency = self.latencies.get(url)
+            if latency is None:
+                latency = [0, 0.0, 0.0, [0] * (len(STATS_LATENCY_BUCKETS) + 1)]
+                self.latencies[url] = latency
+            latency[0] += 1
+            latency[1] += seconds
+            latency[2] = max(latency[2], seconds)
+            latency[3][bucket] += 1
+
+    def to_dict(self):
+        '''Return the statistics as a dictionary which can be saved as
+        JSON.'''
+        limits = list(STATS_LATENCY_BUCKETS) + [None]
+        with self._lock:
+            return {
+                'duration': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'stages': dict([
+                    (name, {'count': count, 'seconds': seconds})
+                    for name, (count, seconds) in self.stages.items()]),
+                'latencies': dict([
+                    (url, {
+                        'count': count,
+                        'seconds': seconds,
+                        'max_seconds': maximum,
+                        'histogram': [
+                            list(bucket) for bucket in zip(limits, buckets)],
+                        })
+                    for url, (count, seconds, maximum, buckets)
+                    in self.latencies.items()]),
+                }
+
+    def save(self, path):
+        '''Save the statistics as JSON to `path`.'''
+        with AtomicFile(path) as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2, sort_keys=True)
+
+
+def test_stats():
+    '''Test recording counters, stages and latencies.'''
+    stats = Stats()
+    stats.increment('pages')
+    stats.increment('pages', 2)
+    with stats.stage('parse'):
+        pass
+    try:
+        with stats.stage('parse'):
+            raise ValueError()
+    except ValueError:
+        pass
+    stats.add_latency('http://example.com/page?start=1', 0.2)
+    stats.add_latency('http://example.com/page?start=2', 100)
+
+    result = stats.to_dict()
+    assert {'pages': 3} == result['counters']
+    assert 2 == result['stages']['parse']['count']
+    latency = result['latencies']['http://example.com/page']
+    assert 2 == latency['count']
+    assert 100 == latency['max_seconds']
+    assert [0.1, 0] == latency['histogram'][0]
+    assert [0.25, 1] == latency['histogram'][1]
+    assert [None, 1] == latency['histogram'][-1]
+    json.dumps(result)
+
+
+class Profiler(object):
+    '''Collect cProfile results from multiple threads or stage runs.
+
+    cProfile only profiles the thread in which it was started, so each
+    run of `stage`, from any thread, is profiled separately and all
+    results are merged. When `stage` is None, start_run and stop_run
+    profile the whole run, but only in the thread calling them.
+    '''
+
+    def __init__(self, stage=None):
+        self.stage = stage
+        self._stats = None
+        self._run_profile = None
+        self._lock = Lock()
+
+    def start_run(self):
+        '''Start profiling the whole run, if no stage is set.'''
+        if self.stage is None:
+            self._run_profile = self.start()
+
+    def stop_run(self):
+        '''Stop profiling the whole run.'''
+        if self._run_profile is not None:
+            self.stop(self._run_profile)
+            self._run_profile = None
+
+    def start(self):
+        '''Start profiling the current thread and return the profile.'''
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        '''Stop the `profile` and add its results.'''
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def save(self, path):
+        '''Save the results in the pstats format to `path`.
+
+        Return False if nothing was profiled.
+        '''
+        with self._lock:
+            if self._stats is None:
+                return False
+            self._stats.dump_stats(path)
+            return True
+
+
+def test_profiler():
+    '''Test profiling a stage which runs in multiple threads.'''
+    def parse(value):
+        return sum(xrange(value))
+
+    def fetch(value):
+        return value
+
+    def get(value):
+        with stats.stage('fetch'):
+            value = fetch(value)
+        with stats.stage('parse'):
+            return parse(value)
+
+    stats = Stats()
+    stats.profiler = Profiler('parse')
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'profile')
+        assert not stats.profiler.save(path)
+        parallel_map(get, range(10), jobs=3)
+        assert stats.profiler.save(path)
+
+        functions = dict([
+            (name, values[1]) for (filename, line, name), values
+            in pstats.Stats(path).stats.items()])
+        # Calls from all threads are merged.
+        assert 10 == functions['parse']
+        assert 'fetch' not in functions
+    finally:
+        shutil.rmtree(directory)
+
+
+class AtomicFile(object):
+    '''File which replaces `path` only when it is closed.
+
+    Content is written to a temporary file from the same directory, which
+    is renamed to `path` by close(). Readers of `path` will see either the
+    old or the new content, but never a partial one. When used as a
+    context manager, content is discarded if an exception is raised.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        handle, self._temporary_path = tempfile.mkstemp(
+            prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+        self._file = os.fdopen(handle, 'wb')
+        # mkstemp creates files readable only by their owner.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self._temporary_path, 0666 & ~umask)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        '''Replace `path` with the written content.'''
+        if self._file.closed:
+            return
+        self._file.close()
+        os.rename(self._temporary_path, self.path)
+
+    def discard(self):
+        '''Remove the written content, keeping `path` unchanged.'''
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self._temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def test_atomic_file():
+    '''Test that content replaces the file only when it is closed.'''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'feed.xml')
+        with AtomicFile(path) as output:
+            output.write('old')
+        assert 'old' == open(path).read()
+
+        output = AtomicFile(path)
+        output.write('new')
+        assert 'old' == open(path).read()
+        output.close()
+        assert 'new' == open(path).read()
+
+        try:
+            with AtomicFile(path) as output:
+                output.write('partial')
+                raise ValueError()
+        except ValueError:
+            pass
+        assert 'new' == open(path).read()
+        assert ['feed.xml'] == os.listdir(directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+class DiskCache(object):
+    '''Size bounded cache storing string values as files in `directory`.
+
+    When the total size of the values goes over `max_size` bytes, the least
+    recently used values are removed. The last use time is kept as the file
+    modification time, so the eviction order survives between runs.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = Lock()
+        # Map of file name to [size, last_used_time].
+        self._entries = {}
+        self._size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith('.tmp-'):
+                # Leftover from an interrupted write.
+                os.remove(path)
+                continue
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            self._entries[name] = [stat.st_size, stat.st_mtime]
+            self._size += stat.st_size
+
+    def get(self, key):
+        '''Return the value for `key` or None if it is not cached.'''
+        name = self._get_name(key)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as cache_file:
+                value = cache_file.read()
+        except IOError:
+            return None
+        now = time.time()
+        with self._lock:
+            if name in self._entries:
+                self._entries[name][1] = now
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            # Value was evicted in the meantime.
+            pass
+        return value
+
+    def set(self, key, value):
+        '''Store `value` for `key`.'''
+        name = self._get_name(key)
+        handle, temporary_path = tempfile.mkstemp(
+            prefix='.tmp-', dir=self.directory)
+        with os.fdopen(handle, 'wb') as cache_file:
+            cache_file.write(value)
+        with self._lock:
+            os.rename(temporary_path, os.path.join(self.directory, name))
+            if name in self._entries:
+                self._size -= self._entries[name][0]
+            self._entries[name] = [len(value), time.time()]
+            self._size += len(value)
+            self._evict()
+
+    def _evict(self):
+        '''Remove least recently used values until cache fits in
+        max_size.
+        '''
+        if self._size <= self.max_size:
+            return
+        names = sorted(
+            self._entries, key=lambda name: self._entries[name][1])
+        for name in names:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self._size -= self._entries.pop(name)[0]
+
+    def _get_name(self, key):
+        '''Return the file name used for `key`.'''
+        return hashlib.sha1(key).hexdigest()
+
+
+def test_disk_cache():
+    '''Test storing values and evicting the least recently used ones.'''
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, max_size=10)
+        assert cache.get('key1') is None
+        cache.set('key1', '1234')
+        cache.set('key2', '5678')
+        assert cache.get('key1') == '1234'
+        # key2 is the least recently used and is removed.
+        cache.set('key3', 'abcd')
+        assert cache.get('key2') is None
+        assert cache.get('key1') == '1234'
+        assert cache.get('key3') == 'abcd'
+
+        # Values are available to new caches using the same directory.
+        cache = DiskCache(directory, max_size=10)
+        assert cache.get('key1') == '1234'
+    finally:
+        shutil.rmtree(directory)
+
+
+class MemoryCache(object):
+    '''In memory cache with the same interface as DiskCache.
+
+    When the total size of the values goes over `max_size` bytes, the least
+    recently used values are removed.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        '''Return the value for `key` or None if it is not cached.'''
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                # Move it to the end, as the most recently used.
+                self._values[key] = value
+            return value
+
+    def set(self, key, value):
+        '''Store `value` for `key`.'''
+        with self._lock:
+            previous_value = self._values.pop(key, None)
+            if previous_value is not None:
+                self._size -= len(previous_value)
+            self._values[key] = value
+            self._size += len(value)
+            while self._size > self.max_size:
+                key, value = self._values.popitem(last=False)
+                self._size -= len(value)
+
+
+def test_memory_cache():
+    '''Test storing values and evicting the least recently used ones.'''
+    cache = MemoryCache(max_size=10)
+    assert cache.get('key1') is None
+    cache.set('key1', '1234')
+    cache.set('key2', '5678')
+    assert cache.get('key1') == '1234'
+    # key2 is the least recently used and is removed.
+    cache.set('key3', 'abcd')
+    assert cache.get('key2') is None
+    assert cache.get('key1') == '1234'
+    assert cache.get('key3') == 'abcd'
+    cache.set('key3', 'ab')
+    cache.set('key4', '1234')
+    assert cache.get('key1') == '1234'
+
+
+class HTTPCache(object):
+    '''Cache for HTTP responses which can be revalidated.
+
+    Only responses having an ETag or a Last-Modified header are stored.
+    '''
+
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+
+    def get_response(self, url):
+        '''Return the cached HTTPResponse for `url` or None.'''
+        value = self.disk_cache.get('http:' + url)
+        if value is None:
+            return None
+        metadata, body = value.split('\n', 1)
+        metadata = json.loads(metadata)
+        return HTTPResponse(
+            metadata['url'], 200, metadata['headers'], body, from_cache=True)
+
+    def set_response(self, url, response):
+        '''Store `response` for `url`.'''
+        headers = {}
+        for name in ('etag', 'last-modified'):
+            if response.headers.get(name):
+                headers[name] = response.headers[name]
+        if not headers:
+            return
+        metadata = json.dumps({'url': response.url, 'headers': headers})
+        self.disk_cache.set('http:' + url, metadata + '\n' + response.body)
+
+
+def create_http_cache(directory, max_mb=CACHE_MAX_MB):
+    '''Return the HTTPCache storing at most `max_mb` megabytes in
+    `directory`.
+    '''
+    return HTTPCache(DiskCache(directory, max_mb * 1024 * 1024))
+
+
+def decode_content(body, content_encoding):
+    '''Return the uncompressed `body` sent with `content_encoding`.'''
+    if not content_encoding:
+        return body
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send raw deflate data without zlib headers.
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def test_decode_content():
+    '''Test decoding of compressed content.'''
+    content = 'some content ' * 10
+    assert content == decode_content(content, None)
+    assert content == decode_content(content, 'identity')
+    assert content == decode_content(zlib.compress(content), 'deflate')
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    raw_deflate = compressor.compress(content) + compressor.flush()
+    assert content == decode_content(raw_deflate, 'deflate')
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    gzip_content = compressor.compress(content) + compressor.flush()
+    assert content == decode_content(gzip_content, 'gzip')
+
+
+def parallel_map(function, items, jobs=1):
+    '''Return the list of `function` results for all `items`.
+
+    See parallel_imap.
+    '''
+    return list(parallel_imap(function, items, jobs))
+
+
+def parallel_imap(function, items, jobs=1):
+    '''Generate `function` results for all `items`.
+
+    Items are processed by at most `jobs` threads, but results are
+    generated in the same order as `items`. Only a few results are computed
+    ahead of the one being consumed. If a call raises an exception, it is
+    raised when its result is reached.
+    '''
+    if jobs < 2:
+        for item in items:
+            yield function(item)
+        return
+
+    tasks = Queue()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                task['result'] = function(task['item'])
+            except:
+                task['error'] = sys.exc_info()
+            task['done'].set()
+
+    threads = [Thread(target=worker) for thread in xrange(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    items = iter(items)
+    pending = deque()
+
+    def add_task():
+        for item in items:
+            task = {'item': item, 'done': Event(), 'error': None}
+            pending.append(task)
+            tasks.put(task)
+            return
+
+    try:
+        for index in xrange(jobs * 2):
+            add_task()
+        while pending:
+            task = pending.popleft()
+            # Wait with a timeout, so that KeyboardInterrupt is not blocked.
+            while not task['done'].wait(1):
+                pass
+            add_task()
+            if task['error'] is not None:
+                error = task['error']
+                raise error[0], error[1], error[2]
+            yield task['result']
+    finally:
+        # Drop tasks not yet started and stop all workers.
+        while True:
+            try:
+                tasks.get_nowait()
+            except Empty:
+                break
+        for thread in threads:
+            tasks.put(None)
+        # Wait for tasks already started, with a timeout so that
+        # KeyboardInterrupt is not blocked.
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+
+def test_parallel_map():
+    '''Test running a function in parallel.'''
+    def slow_square(value):
+        time.sleep(0.01 * (5 - value))
+        return value * value
+
+    assert [] == parallel_map(slow_square, [], jobs=3)
+    assert [0, 1, 4, 9, 16] == parallel_map(slow_square, range(5), jobs=1)
+    assert [0, 1, 4, 9, 16] == parallel_map(slow_square, range(5), jobs=3)
+
+    def fail_on_odd(value):
+        if value % 2:
+            raise ValueError(value)
+        return value
+
+    try:
+        parallel_map(fail_on_odd, range(5), jobs=3)
+    except ValueError, error:
+        assert error.args == (1,)
+    else:
+        assert False, 'ValueError not raised.'
+
+    # Results are generated as soon as they are available.
+    results = parallel_imap(slow_square, xrange(1000000), jobs=3)
+    assert [0, 1, 4] == [results.next() for index in xrange(3)]
+    results.close()
+
+
+class LocalHTTPServer(object):
+    '''HTTP/1.1 server running in a thread and used for tests.
+
+    `routes` maps a request path to a function receiving the request
+    handler and returning a tuple of (status, headers, body).
+    '''
+
+    def __init__(self, routes):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append(
+                    (self.client_address, self.path, dict(self.headers)))
+                route = routes.get(self.path)
+                if route is None:
+                    status, headers, body = 404, {}, 'Not found'
+                else:
+                    status, headers, body = route(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(HTTPServer):
+
+            def handle_error(self, request, client_address):
+                # Clients closing the connection early are expected.
+                if not issubclass(sys.exc_info()[0], socket.error):
+                    HTTPServer.handle_error(self, request, client_address)
+
+        self.requests = []
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop the server.'''
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def test_http_client_reuses_connections():
+    '''Test that all requests to a host are sent over the same
+    connection.
+    '''
+    server = LocalHTTPServer({
+        '/page': lambda request: (200, {}, 'content'),
+        })
+    stats = Stats()
+    client = HTTPClient(stats=stats)
+    try:
+        for index in xrange(3):
+            response = client.get(server.url + '/page')
+            assert response.status == 200
+            assert response.body == 'content'
+        assert 3 == stats.counters['http_requests']
+        assert 21 == stats.counters['http_bytes']
+        assert 3 == stats.latencies[server.url + '/page'][0]
+        client_addresses = set(
+            address for address, path, headers in server.requests)
+        assert len(server.requests) == 3
+        assert len(client_addresses) == 1
+        assert server.requests[0][2]['accept-encoding'] == 'gzip, deflate'
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_http_client_decodes_and_redirects():
+    '''Test following redirects and decoding of compressed content.'''
+    server = LocalHTTPServer({
+        '/old': lambda request: (302, {'Location': '/new'}, ''),
+        '/new': lambda request: (
+            200, {'Content-Encoding': 'deflate'}, zlib.compress('content')),
+        })
+    client = HTTPClient()
+    try:
+        response = client.get(server.url + '/old')
+        assert response.body == 'content'
+        assert response.url == server.url + '/new'
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_http_client_errors():
+    '''Test errors are raised using urllib2 exceptions.'''
+    server = LocalHTTPServer({})
+    client = HTTPClient(retries=0)
+    try:
+        try:
+            client.get(server.url + '/no-such-page')
+        except urllib2.HTTPError, error:
+            assert error.code == 404
+        else:
+            assert False, 'urllib2.HTTPError not raised.'
+
+        try:
+            client.get('http://nosuch.domain.in.world/page')
+        except urllib2.HTTPError:
+            assert False, 'urllib2.URLError not raised.'
+        except urllib2.URLError:
+            pass
+        else:
+            assert False, 'urllib2.URLError not raised.'
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_http_client_retries():
+    '''Test retrying requests which failed and stopping after too many
+    failures.'''
+    global HTTP_RETRY_DELAY
+    original_retry_delay = HTTP_RETRY_DELAY
+    statuses = [503, 500, 200]
+
+    def flaky(request):
+        return (statuses.pop(0), {}, 'content')
+
+    server = LocalHTTPServer({
+        '/flaky': flaky,
+        '/busy': lambda request: (429, {'Retry-After': '0'}, 'busy'),
+        '/missing': lambda request: (404, {}, 'missing'),
+        })
+    stats = Stats()
+    client = HTTPClient(stats=stats, retries=2)
+    HTTP_RETRY_DELAY = 0.01
+    try:
+        assert 'content' == client.get(server.url + '/flaky').body
+        assert 2 == stats.counters['http_retries']
+
+        try:
+            client.get(server.url + '/busy')
+        except urllib2.HTTPError, error:
+            assert 429 == error.code
+        else:
+            assert False, 'urllib2.HTTPError not raised.'
+        assert 6 == len(server.requests)
+
+        # Errors which are not temporary are not retried.
+        try:
+            client.get(server.url + '/missing')
+        except urllib2.HTTPError, error:
+            assert 404 == error.code
+        assert 7 == len(server.requests)
+
+        # After 5 failures in a row, requests are no longer sent.
+        client.retries = 4
+        try:
+            client.get(server.url + '/busy')
+        except urllib2.HTTPError, error:
+            assert 429 == error.code
+        assert 12 == len(server.requests)
+        try:
+            client.get(server.url + '/missing')
+        except urllib2.HTTPError:
+            assert False, 'urllib2.URLError not raised.'
+        except urllib2.URLError, error:
+            assert 'Too many failed requests' in str(error.reason)
+        else:
+            assert False, 'urllib2.URLError not raised.'
+        assert 12 == len(server.requests)
+    finally:
+        HTTP_RETRY_DELAY = original_retry_delay
+        client.close()
+        server.stop()
+
+
+def test_http_client_timeout_retries():
+    '''Test that a read timeout is only retried by the retries loop.'''
+    global HTTP_RETRY_DELAY
+    original_retry_delay = HTTP_RETRY_DELAY
+
+    def slow(request):
+        time.sleep(0.3)
+        return (200, {}, 'slow')
+
+    server = LocalHTTPServer({
+        '/page': lambda request: (200, {}, 'content'),
+        '/slow': slow,
+        })
+    client = HTTPClient(timeout=0.2, retries=1)
+    HTTP_RETRY_DELAY = 0.01
+    try:
+        # Leave an idle connection in the pool.
+        client.get(server.url + '/page')
+        try:
+            client.get(server.url + '/slow')
+        except urllib2.HTTPError:
+            assert False, 'urllib2.URLError not raised.'
+        except urllib2.URLError:
+            pass
+        else:
+            assert False, 'urllib2.URLError not raised.'
+        # Wait for the server to handle all sent requests.
+        time.sleep(0.7)
+        paths = [path for address, path, headers in server.requests]
+        assert ['/page', '/slow', '/slow'] == paths
+    finally:
+        HTTP_RETRY_DELAY = original_retry_delay
+        client.close()
+        server.stop()
+
+
+def test_token_bucket():
+    '''Test limiting the rate of operations.'''
+    bucket = TokenBucket(rate=100, burst=3)
+    start_time = time.time()
+    for index in xrange(3):
+        bucket.acquire()
+    assert time.time() - start_time < 0.01
+    for index in xrange(5):
+        bucket.acquire()
+    assert time.time() - start_time >= 0.045
+
+
+def test_circuit_breaker():
+    '''Test that calls are stopped after too many failures.'''
+    breaker = CircuitBreaker(failures=2, timeout=0.05)
+    breaker.add_failure()
+    assert breaker.allow()
+    breaker.add_success()
+    breaker.add_failure()
+    assert breaker.allow()
+    breaker.add_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    # A single probe is allowed.
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.add_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.add_success()
+    assert breaker.allow()
+    assert breaker.allow()
+    breaker.add_failure()
+    assert breaker.allow()
+
+    # A probe which is never recorded only stops calls for the timeout.
+    breaker.add_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_http_client_conditional_get():
+    '''Test that the cached body is used for pages not modified.'''
+    def page(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return (304, {}, '')
+        return (200, {'ETag': '"v1"'}, 'content')
+
+    server = LocalHTTPServer({
+        '/page': page,
+        '/no-etag': lambda request: (200, {}, 'content'),
+        })
+    directory = tempfile.mkdtemp()
+    client = HTTPClient(cache=create_http_cache(directory))
+    try:
+        response = client.get(server.url + '/page')
+        assert response.body == 'content'
+        assert response.from_cache is False
+
+        response = client.get(server.url + '/page')
+        assert response.body == 'content'
+        assert response.from_cache is True
+        assert server.requests[-1][2]['if-none-match'] == '"v1"'
+
+        client.get(server.url + '/no-etag')
+        response = client.get(server.url + '/no-etag')
+        assert response.from_cache is False
+        assert 'if-none-match' not in server.requests[-1][2]
+    finally:
+        client.close()
+        server.stop()
+        shutil.rmtree(directory)
+
+
+class SMTPSession(object):
+    '''SMTP connection used for sending multiple messages.
+
+    The connection is opened, secured and authenticated for the first
+    message and kept open for the next ones. If the server closed the
+    connection in the meantime, the message is sent again using a new
+    connection.
+    '''
+
+    def __init__(
+            self, host, port=25, tls=False, username=None, password=u'',
+            timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._server = None
+        self._lock = Lock()
+
+    def send(self, from_address, to_addresses, message):
+        '''Send the `message` string to the list of `to_addresses`.'''
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.sendmail(from_address, to_addresses, message)
+                    return
+                except (SMTPServerDisconnected, socket.error):
+                    self._disconnect()
+                except SMTPResponseException, error:
+                    # 421 is sent when the server is closing the connection.
+                    if error.smtp_code != 421:
+                        raise
+                    self._disconnect()
+            self._connect()
+            self._server.sendmail(from_address, to_addresses, message)
+
+    def close(self):
+        '''Close the connection, if one is open.'''
+        with self._lock:
+            if self._server is None:
+                return
+            try:
+                self._server.quit()
+            except (SMTPServerDisconnected, socket.error):
+                pass
+            self._disconnect()
+
+    def _connect(self):
+        '''Open and authenticate a new connection.'''
+        server = SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.tls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except:
+            server.close()
+            raise
+        self._server = server
+
+    def _disconnect(self):
+        '''Drop the current connection without talking to the server.'''
+        try:
+            self._server.close()
+        finally:
+            self._server = None
+
+
+class MailSpool(object):
+    '''Folder of messages waiting to be sent.
+
+    Each message is a JSON file, written atomically, so that scripts can
+    add messages while they are delivered. Messages which could not be
+    sent are tried again later, with an exponential backoff, and moved to
+    the `failed` sub-folder after SPOOL_MAX_ATTEMPTS.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, 'failed')
+        if not os.path.isdir(self.failed_directory):
+            os.makedirs(self.failed_directory)
+
+    def add(self, from_address, to_addresses, message):
+        '''Add the `message` string for the list of `to_addresses`.'''
+        name = '%.6f-%s.json' % (time.time(), os.urandom(4).encode('hex'))
+        self._write(name, {
+            'from': from_address,
+            'to': to_addresses,
+            'message': message,
+            'attempts': 0,
+            'next_attempt': 0,
+            'error': None,
+            })
+
+    def get_names(self):
+        '''Return the names of all waiting messages, oldest first.'''
+        return sorted([
+            name for name in os.listdir(self.directory)
+            if name.endswith('.json') and not name.startswith('.')])
+
+    def deliver(self, session, now=None):
+        '''Send all messages due at `now` using the SMTPSession.
+
+        Return a tuple of (sent_count, failed_count). Only one process
+        at a time delivers the messages, others return (0, 0).
+        '''
+        if now is None:
+            now = time.time()
+        lock_file = open(os.path.join(self.directory, '.lock'), 'w')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return (0, 0)
+            sent_count = 0
+            failed_count = 0
+            for name in self.get_names():
+                path = os.path.join(self.directory, name)
+                with open(path, 'rb') as spool_file:
+                    entry = json.load(spool_file)
+                if entry['next_attempt'] > now:
+                    continue
+                try:
+                    session.send(
+                        entry['from'], entry['to'],
+                        entry['message'].encode('utf-8'))
+                except (SMTPException, socket.error), error:
+                    failed_count += 1
+                    self._defer(name, entry, now, error)
+                    continue
+                os.remove(path)
+                sent_count += 1
+            return (sent_count, failed_count)
+        finally:
+            lock_file.close()
+
+    def _defer(self, name, entry, now, error):
+        '''Schedule another attempt for a message which failed.'''
+        entry['attempts'] += 1
+        entry['error'] = str(error)
+        delay = SPOOL_RETRY_DELAY * 2 ** (entry['attempts'] - 1)
+        entry['next_attempt'] = now + min(delay, SPOOL_MAX_RETRY_DELAY)
+        if entry['attempts'] < SPOOL_MAX_ATTEMPTS:
+            self._write(name, entry)
+            return
+        os.rename(
+            os.path.join(self.directory, name),
+            os.path.join(self.failed_directory, name))
+
+    def _write(self, name, entry):
+        '''Write the message `entry` as `name`.'''
+        with AtomicFile(os.path.join(self.directory, name)) as spool_file:
+            json.dump(entry, spool_file)
+
+
+def test_mail_spool():
+    '''Test delivering spooled messages and retrying failed ones.'''
+    directory = tempfile.mkdtemp()
+    server = LocalSMTPServer()
+    try:
+        spool = MailSpool(directory)
+        spool.add('from@example.com', ['to@example.com'], 'Message 1')
+        spool.add('from@example.com', ['to@example.com'], 'Message 2')
+        assert 2 == len(spool.get_names())
+
+        # Nothing is listening on the port of a stopped server.
+        stopped_server = LocalSMTPServer()
+        stopped_server.stop()
+        session = SMTPSession('127.0.0.1', stopped_server.port)
+        assert (0, 2) == spool.deliver(session, now=1000)
+        assert 2 == len(spool.get_names())
+        # Failed messages are not tried again before the delay.
+        assert (0, 0) == spool.deliver(session, now=1001)
+
+        session = SMTPSession('127.0.0.1', server.port)
+        assert (2, 0) == spool.deliver(
+            session, now=1000 + SPOOL_RETRY_DELAY)
+        session.close()
+        assert [] == spool.get_names()
+        assert [
+            ('from@example.com', ['to@example.com'], 'Message 1'),
+            ('from@example.com', ['to@example.com'], 'Message 2'),
+            ] == server.messages
+
+        # Messages failing too many times are moved to the failed folder.
+        session = SMTPSession('127.0.0.1', stopped_server.port)
+        spool.add('from@example.com', ['to@example.com'], 'Message 3')
+        now = 2000
+        for attempt in xrange(SPOOL_MAX_ATTEMPTS):
+            assert (0, 1) == spool.deliver(session, now=now)
+            now += SPOOL_MAX_RETRY_DELAY
+        assert [] == spool.get_names()
+        assert 1 == len(os.listdir(spool.failed_directory))
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+class LocalSMTPServer(object):
+    '''SMTP server running in a thread and used for tests.
+
+    Received messages are kept in `messages` as tuples of
+    (from_address, to_addresses, data). Recipients from
+    `rejected_addresses` are refused.
+    '''
+
+    def __init__(self):
+        import asyncore
+        import smtpd
+
+        server = self
+        self.messages = []
+        self.rejected_addresses = set()
+        self.connections_count = 0
+        self._channels = []
+        self._drop_connections = Event()
+        self._stopped = Event()
+
+        class Channel(smtpd.SMTPChannel):
+
+            def smtp_RCPT(self, arg):
+                address = arg.split(':', 1)[-1].strip(' <>')
+                if address in server.rejected_addresses:
+                    self.push('550 No such user')
+                    return
+                smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+        class Server(smtpd.SMTPServer):
+
+            def handle_accept(self):
+                pair = self.accept()
+                if pair is None:
+                    return
+                connection, address = pair
+                server.connections_count += 1
+                server._channels.append(Channel(self, connection, address))
+
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                server.messages.append((mailfrom, rcpttos, data))
+
+        self._server = Server(('127.0.0.1', 0), None)
+        self.port = self._server.socket.getsockname()[1]
+
+        def loop():
+            while not self._stopped.is_set():
+                if self._drop_connections.is_set():
+                    for channel in self._channels:
+                        channel.close()
+                    self._channels = []
+                    self._drop_connections.clear()
+                asyncore.loop(timeout=0.01, count=1)
+            for channel in self._channels:
+                channel.close()
+            self._server.close()
+
+        self._thread = Thread(target=loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def drop_connections(self):
+        '''Close all client connections, without telling the clients.'''
+        self._drop_connections.set()
+        while self._drop_connections.is_set():
+            time.sleep(0.01)
+
+    def stop(self):
+        '''Stop the server.'''
+        self._stopped.set()
+        self._thread.join()
+
+
+def test_smtp_session():
+    '''Test sending messages over a single connection and reconnecting
+    when the server closed it.
+    '''
+    server = LocalSMTPServer()
+    session = SMTPSession('127.0.0.1', server.port)
+    try:
+        session.send('from@example.com', ['to@example.com'], 'Message 1')
+        session.send(
+            'from@example.com', ['to@example.com', 'cc@example.com'],
+            'Message 2')
+        assert 1 == server.connections_count
+
+        server.drop_connections()
+        session.send('from@example.com', ['to@example.com'], 'Message 3')
+        assert 2 == server.connections_count
+
+        # A rejected recipient does not close the connection.
+        server.rejected_addresses.add('bad@example.com')
+        try:
+            session.send(
+                'from@example.com', ['bad@example.com'], 'Message 4')
+        except SMTPRecipientsRefused:
+            pass
+        else:
+            raise AssertionError('Recipient was not refused.')
+        session.send('from@example.com', ['to@example.com'], 'Message 5')
+        assert 2 == server.connections_count
+        session.close()
+        session.close()
+    finally:
+        server.stop()
+    assert [
+        ('from@example.com', ['to@example.com'], 'Message 1'),
+        ('from@example.com', ['to@example.com', 'cc@example.com'],
+            'Message 2'),
+        ('from@example.com', ['to@example.com'], 'Message 3'),
+        ('from@example.com', ['to@example.com'], 'Message 5'),
+        ] == server.messages
+
+
+def run_all_tests(stop_on_failure):
+    '''Run all tests.'''
+    tests_count = 0
+    pass_count = 0
+    fail_count = 0
+    for name, function in sys.modules[__name__].__dict__.items():
+        if name.startswith('test_'):
+            tests_count += 1
+            print name + ': ',
+            try:
+                function()
+                pass_count += 1
+                print 'PASS'
+            except:
+                fail_count += 1
+                print 'FAIL'
+                if stop_on_failure:
+                    raise
+    print '--'
+    print 'Ran %d tests. %d PASSED. %d FAILED.' % (
+        tests_count, pass_count, fail_count)
+
+
+def get_options_or_print_help():
+    '''Get command line options or print help message and exit if unknow
+    options are passed.
+    '''
+    parser = OptionParser()
+
+    parser.add_option(
+        '-t', '--run-tests', action='store_true', dest='test', default=False,
+        help='Run the (primitive) test suite.')
+    parser.add_option(
+        '--test-exit-on-failure', action='store_true',
+        dest='test_exit', default=False,
+        help='Exit tests on first failure.')
+
+    (options, args) = parser.parse_args()
+    if len(args) > 0 or not options.test:
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return options
+
+
+if __name__ == "__main__":
+    options = get_options_or_print_help()
+    run_all_tests(options.test_exit)
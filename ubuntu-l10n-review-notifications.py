@@ -1,27 +1,72 @@
 #!/usr/bin/env python
 '''This is the base code for scraping 'Launchpad Ubuntu Translations' webpage.
 
-It depends on BeatifulSoup.
+It depends on BeatifulSoup and scraperlib.py from this repository.
 
 See tests for valid input.
 
 Distributed under WTFPL 2.0.
 '''
 
+import hashlib
+import itertools
+import json
+import os
+import re
 import rfc822
+import shutil
+import sqlite3
 import sys
+import tempfile
 import time
+import timeit
 import urllib2
+from cStringIO import StringIO
 from email.mime.text import MIMEText
-from optparse import OptionParser
-from smtplib import SMTP, SMTPServerDisconnected
+from HTMLParser import HTMLParser
+from optparse import OptionParser, Values
+from smtplib import SMTPException, SMTPServerDisconnected
 from socket import error as SocketError
+from threading import Lock
+from xml.dom.minidom import parseString
+from xml.sax.saxutils import XMLGenerator
 from BeautifulSoup import BeautifulSoup
+from scraperlib import (
+    CACHE_MAX_MB, AtomicFile, DiskCache, EMAIL_PASSWORD, EMAIL_PORT,
+    EMAIL_SERVER, EMAIL_TLS, EMAIL_USERNAME, HTTPCache, HTTPClient,
+    HTTPResponse, HTTP_RATE, LocalSMTPServer, MailSpool, MemoryCache,
+    Profiler, SMTPSession, Stats, parallel_imap, parallel_map)
 
 TRANSLATIONS_BASE_URL = u'https://translations.launchpad.net'
 REVIEW_BASE_URL = (
     u'https://translations.launchpad.net/ubuntu/%s/+lang/%s/+index')
+# Number of templates requested in the first batch.
 BATCH_SIZE = 150
+# Sizes used for batches when the size is adapted. Each size is a multiple
+# of the previous one, so batches can always start at a multiple of their
+# size and all runs request the same URLs, which are kept in the HTTP cache.
+BATCH_SIZES = (50, 150, 300)
+# Limits for the number of templates requested in a batch.
+BATCH_SIZE_MIN = BATCH_SIZES[0]
+BATCH_SIZE_MAX = BATCH_SIZES[-1]
+# Time, in seconds, in which a batch should be received. The batch size is
+# adapted to it, based on the time used for previous batches.
+BATCH_DURATION = 5
+# Extract the total number of templates from the batch navigation text.
+REVIEWS_TOTAL_PATTERN = re.compile(r'of\s+([\d,]+)\s+results?')
+# Name of the engine from PAGE_PARSERS used for parsing pages.
+PAGE_PARSER = 'soup'
+# Cache for reviews parsed from pages. Set to a ParsedPagesCache to avoid
+# parsing again pages which the server said were not modified.
+PARSED_PAGES_CACHE = None
+# Part of --cache-max-mb used by PARSED_PAGES_CACHE. The rest is used for
+# the downloaded pages.
+PARSED_PAGES_CACHE_SHARE = 0.25
+# Statistics of the current run, saved with --stats-json.
+STATS = Stats()
+# HTTP client shared by all requests, keeping the TLS connection to
+# Launchpad open between batches.
+HTTP_CLIENT = HTTPClient(stats=STATS)
 RSS_TITLE = u'Ubuntu %(release)s translation reviews for %(language)s'
 RSS_DESCRIPTION = (
     u'RSS feeds for Ubuntu %(release)s translations in %(language)s that '
@@ -29,20 +74,16 @@ RSS_DESCRIPTION = (
 RSS_ITEM_DESCRIPTION = (
     u'Template "%(name)s" has %(count)d new suggestions waiting to be '
     u'reviewed. Template was last changed by %(last_editor)s on %(date)s.')
+# Added to the item description when the increase since last run is known.
+RSS_ITEM_DELTA = u' There are %(delta)d more suggestions than at last check.'
 
 EMAIL_TAG = u'[lp-new-suggestions] '
-# SMTP server used for sending emails.
-EMAIL_SERVER = u'127.0.0.1'
-# SMTP server port.
-# Make sure your provider is not blocking port 25.
-# For Dreamhost you can use 587
-EMAIL_PORT = 25
-# Connect to SMTP server using TLS.
-EMAIL_TLS = False
-# SMTP username. Set None for not using SMTP authentication
-EMAIL_USERNAME = None
-#  SMTP password. Ignored if EMAIL_USERNAME is None.
-EMAIL_PASSWORD = u''
+# SMTP session shared by all emails, keeping the connection open between
+# messages.
+SMTP_SESSION = SMTPSession(
+    EMAIL_SERVER, EMAIL_PORT, EMAIL_TLS, EMAIL_USERNAME, EMAIL_PASSWORD)
+# MailSpool where emails are added instead of being sent, or None.
+MAIL_SPOOL = None
 
 # Email address use to set the From email field.
 EMAIL_FROM = u'Ubuntu Translations Reviews <no-reply@example.com>'
@@ -52,19 +93,213 @@ EMAIL_SUBJECT = u'Results from Ubuntu translations reviews'
 EMAIL_SIGNATURE = u'\n--\nYour faithful servant,\nRobocut'
 
 
-def get_all_reviews(language_code, release_code):
-    '''Return a list containing all PO files that needs review.'''
-    results = []
-    has_next_page = True
-    batch_start = 0
-    while has_next_page:
-        page = get_page(batch_start, language_code, release_code)
-        page_reviews, has_next_page = get_page_reviews(page)
-        results.extend(page_reviews)
-        batch_start += BATCH_SIZE
+class BatchSizer(object):
+    '''Choose the number of templates requested in each batch.
+
+    The size is adapted so that a batch is received in about `duration`
+    seconds, based on the time per template observed for previous
+    batches. It is always one of BATCH_SIZES, up to `maximum`.
+    When `fixed` is True, `size` is always used.
+    '''
+
+    def __init__(
+            self, size=BATCH_SIZE, maximum=BATCH_SIZE_MAX,
+            duration=BATCH_DURATION, fixed=False):
+        self.size = size
+        self.maximum = maximum
+        self.duration = duration
+        self.fixed = fixed
+        # Average time, in seconds, for getting one template.
+        self._template_duration = None
+        self._lock = Lock()
+
+    def observe(self, templates_count, duration):
+        '''Update the size after getting `templates_count` templates in
+        `duration` seconds.'''
+        if self.fixed or templates_count < 1:
+            return
+        template_duration = float(duration) / templates_count
+        with self._lock:
+            if self._template_duration is None:
+                self._template_duration = template_duration
+            else:
+                self._template_duration = (
+                    0.7 * self._template_duration + 0.3 * template_duration)
+            if self._template_duration > 0:
+                size = int(self.duration / self._template_duration)
+            else:
+                size = self.maximum
+            size = min(self.maximum, size)
+            sizes = [
+                batch_size for batch_size in BATCH_SIZES if batch_size <= size]
+            if sizes:
+                self.size = sizes[-1]
+            else:
+                self.size = BATCH_SIZE_MIN
+
+    def iter_batches(self, batch_start, total=None):
+        '''Generate (batch_start, batch_size) for the batches starting at
+        `batch_start`, until `total`.
+
+        The size of each batch is the one at the time it is generated.
+        When it is not fixed, a smaller size from BATCH_SIZES is used until
+        `batch_start` is a multiple of the size.
+        '''
+        while total is None or batch_start < total:
+            batch_size = self.size
+            if not self.fixed:
+                sizes = [
+                    size for size in BATCH_SIZES
+                    if size <= batch_size and batch_start % size == 0]
+                if sizes:
+                    batch_size = sizes[-1]
+            yield (batch_start, batch_size)
+            batch_start += batch_size
+
+
+def test_batch_sizer():
+    '''Test adapting the batch size to the observed durations.'''
+    sizer = BatchSizer(size=150, maximum=300, duration=5)
+    assert [(0, 150), (150, 150), (300, 150)] == list(
+        sizer.iter_batches(0, 400))
+    # 150 templates in 1 second, but no more than maximum.
+    sizer.observe(150, 1)
+    assert 300 == sizer.size
+    # Slow responses are averaged with the previous ones.
+    # Alone, they would give 50 templates in 5 seconds.
+    sizer.observe(100, 6)
+    assert 150 == sizer.size
+    sizer.observe(10, 1000)
+    assert BATCH_SIZE_MIN == sizer.size
+    batches = sizer.iter_batches(450)
+    assert (450, 50) == batches.next()
+    # Larger batches start at a multiple of their size.
+    sizer.size = 300
+    assert [(500, 50), (550, 50), (600, 300), (900, 300)] == [
+        batches.next() for index in xrange(4)]
+
+    sizer = BatchSizer(size=75, fixed=True)
+    sizer.observe(75, 0.1)
+    assert 75 == sizer.size
+
+
+# Batch size shared by all requests.
+BATCH_SIZER = BatchSizer()
+
+
+def get_all_reviews(language_code, release_code, jobs=1):
+    '''Return a list containing all PO files that needs review.
+
+    Batches after the first one are fetched using `jobs` concurrent
+    requests. When the first page does not tell the total number of
+    templates, the next `jobs` batches are fetched ahead until a batch
+    without a next page is found.
+    The size of the batches is chosen by BATCH_SIZER.
+    Reviews are returned in the same order as the batches.
+    '''
+    def get_batch_reviews(batch):
+        batch_start, batch_size = batch
+        start_time = time.time()
+        response = get_page_response(
+            batch_start, language_code, release_code, batch_size)
+        duration = time.time() - start_time
+        reviews, has_next_page, total = parse_page(
+            response.body, response.from_cache)
+        if has_next_page:
+            BATCH_SIZER.observe(batch_size, duration)
+        elif total is not None:
+            BATCH_SIZER.observe(total - batch_start, duration)
+        return (reviews, has_next_page, total)
+
+    first_batch_size = BATCH_SIZER.size
+    results, has_next_page, total = get_batch_reviews((0, first_batch_size))
+    if not has_next_page:
+        return results
+
+    batches = BATCH_SIZER.iter_batches(first_batch_size, total)
+    pages = parallel_imap(get_batch_reviews, batches, jobs)
+    try:
+        for page_reviews, has_next_page, total in pages:
+            results.extend(page_reviews)
+            if not has_next_page:
+                break
+    finally:
+        pages.close()
     return results
 
 
+def test_get_all_reviews():
+    '''Test getting reviews from all batches, with and without a total.'''
+    global get_page_response, PAGE_PARSER, BATCH_SIZER
+    original_get_page_response = get_page_response
+    original_page_parser = PAGE_PARSER
+    original_batch_sizer = BATCH_SIZER
+    requested = []
+
+    def fake_get_page_response(
+            batch_start, language_code, release_code, batch_size):
+        requested.append(batch_start)
+        batch = batch_start // batch_size
+        if batch > 3:
+            raise AssertionError('Batch after last one.')
+        html = TEST_REVIEWS_ROW % {'name': batch, 'nr': 1}
+        html = (
+            '<table class="listing sortable translation-stats">%s</table>' %
+            html)
+        if batch < 3:
+            html = '<a id="upper-batch-nav-batchnav-next">Next</a>' + html
+        if batch == 0:
+            html = '''
+                <table><tr><td class="batch-navigation-index">
+                  <strong>1</strong> &rarr; <strong>150</strong>
+                  of %(total)s results
+                </td></tr></table>''' % {'total': fake_total} + html
+        return HTTPResponse('http://example.com', 200, {}, html)
+
+    get_page_response = fake_get_page_response
+    try:
+        for PAGE_PARSER, fake_total, jobs in itertools.product(
+                PAGE_PARSERS, ['451', 'no'], [1, 3]):
+            requested[:] = []
+            BATCH_SIZER = BatchSizer(size=150, fixed=True)
+            reviews = get_all_reviews('ro', 'lucid', jobs=jobs)
+            assert [u'0', u'1', u'2', u'3'] == [
+                review['name'] for review in reviews]
+            assert 0 == requested[0]
+            if fake_total != 'no' or jobs == 1:
+                assert [0, 150, 300, 450] == sorted(requested)
+    finally:
+        get_page_response = original_get_page_response
+        PAGE_PARSER = original_page_parser
+        BATCH_SIZER = original_batch_sizer
+
+
+def get_reviews_total(page):
+    '''Return the total number of templates listed in all batches.
+
+    Return None if the page has no batch navigation.
+    '''
+    navigation = page.find('td', {'class': 'batch-navigation-index'})
+    if navigation is None:
+        return None
+    match = REVIEWS_TOTAL_PATTERN.search(tag_to_plain_text(navigation))
+    if match is None:
+        return None
+    return int(match.group(1).replace(',', ''))
+
+
+def test_get_reviews_total():
+    '''Test reading the total number of templates from the first page.'''
+    page = create_soup('''
+    <table><tr><td class="batch-navigation-index">
+      <strong>1</strong> &rarr; <strong>150</strong> of 1,234 results
+    </td></tr></table>''')
+    assert 1234 == get_reviews_total(page)
+
+    page = create_soup('<table class="listing"></table>')
+    assert get_reviews_total(page) is None
+
+
 def get_page_reviews(page):
     '''Return a tuple of (reviews, has_next_page).
 
@@ -180,10 +415,18 @@ def test_get_page_reviews_no_results():
     assert [] == results
 
 
-def test_get_page_reviews_with_results():
-    '''Test get_page_reviews results return value.'''
+TEST_REVIEWS_ROW = '''
+    <tr id="%(name)s">
+      <td class="template-name"><a href="/%(name)s">%(name)s</a></td>
+      <td>22</td><td></td><td></td>
+      <td><a href="/%(name)s/+suggestions">%(nr)d</a></td>
+      <td></td>
+      <td><span class="sortkey">2011-04-07 18:42:26 EEST</span></td>
+      <td><a href="https://launchpad.net/~adiroiban">Adi Roiban</a></td>
+    </tr>'''
+
 
-    html_with_reviews = '''
+TEST_REVIEWS_PAGE = '''
     <html><body><table class="listing sortable translation-stats">
     <tr id="unity">
           <td class="template-name">
@@ -277,7 +520,10 @@ def test_get_page_reviews_with_results():
         </tr>
     </table></body></html>'''
 
-    page = create_soup(html_with_reviews)
+
+def test_get_page_reviews_with_results():
+    '''Test get_page_reviews results return value.'''
+    page = create_soup(TEST_REVIEWS_PAGE)
     results, has_next = get_page_reviews(page)
     assert len(results) == 2
     assert results[0]['name'] == 'unity'
@@ -293,15 +539,323 @@ def test_get_page_reviews_with_results():
     assert results[1]['last_editor'] == 'EDUBUNTU EDITOR'
 
 
-def get_page(batch_start, language_code, release_code):
+def get_page(batch_start, language_code, release_code, batch_size=BATCH_SIZE):
     '''Retrun the BeautifulSoup object for page at `url`.'''
+    return BeautifulSoup(get_page_content(
+        batch_start, language_code, release_code, batch_size))
+
+
+def get_page_content(
+        batch_start, language_code, release_code, batch_size=BATCH_SIZE):
+    '''Return the HTML of the batch of `batch_size` templates starting at
+    `batch_start`.'''
+    return get_page_response(
+        batch_start, language_code, release_code, batch_size).body
+
+
+def get_page_response(
+        batch_start, language_code, release_code, batch_size=BATCH_SIZE):
+    '''Return the HTTPResponse for the batch of `batch_size` templates
+    starting at `batch_start`.'''
     base_url = REVIEW_BASE_URL % (release_code, language_code)
-    url = '%s?start=%d&batch=%d' % (base_url, batch_start, BATCH_SIZE)
+    url = '%s?start=%d&batch=%d' % (base_url, batch_start, batch_size)
+    with STATS.stage('fetch'):
+        response = HTTP_CLIENT.get(url)
+    STATS.increment('pages_fetched')
+    return response
+
+
+def parse_page(content, from_cache=False):
+    '''Return a tuple of (reviews, has_next_page, total) for the page
+    `content`.
+
+    The page is parsed by the PAGE_PARSERS engine selected by PAGE_PARSER.
+    `total` is None when the page does not tell the number of templates.
+
+    When PARSED_PAGES_CACHE is set, the parsed reviews are kept and used
+    again for pages `from_cache`, which were not modified.
+    '''
+    if from_cache and PARSED_PAGES_CACHE is not None:
+        result = PARSED_PAGES_CACHE.get(content)
+        if result is not None:
+            STATS.increment('pages_not_parsed')
+            return result
+
+    with STATS.stage('parse'):
+        result = PAGE_PARSERS[PAGE_PARSER](content)
+    STATS.increment('reviews_parsed', len(result[0]))
+
+    if PARSED_PAGES_CACHE is not None:
+        PARSED_PAGES_CACHE.set(content, result)
+    return result
+
+
+class ParsedPagesCache(object):
+    '''Cache for the reviews parsed from a page, keyed by the hash of the
+    page content.'''
+
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+
+    def get(self, content):
+        '''Return the (reviews, has_next_page, total) tuple or None.'''
+        value = self.disk_cache.get(self._get_key(content))
+        if value is None:
+            return None
+        value = json.loads(value)
+        return (value['reviews'], value['has_next_page'], value['total'])
+
+    def set(self, content, parsed_page):
+        '''Store the (reviews, has_next_page, total) tuple for `content`.'''
+        reviews, has_next_page, total = parsed_page
+        self.disk_cache.set(self._get_key(content), json.dumps({
+            'reviews': reviews,
+            'has_next_page': has_next_page,
+            'total': total,
+            }))
+
+    def _get_key(self, content):
+        '''Return the cache key for page `content`.'''
+        return 'reviews:%s' % hashlib.sha1(content).hexdigest()
+
+
+def test_parse_page_with_cache():
+    '''Test that pages which were not modified are not parsed again.'''
+    global PARSED_PAGES_CACHE, STATS
+    original_stats = STATS
+    STATS = Stats()
+    PARSED_PAGES_CACHE = ParsedPagesCache(MemoryCache(1024 * 1024))
     try:
-        return BeautifulSoup(urllib2.urlopen(url))
-    except urllib2.HTTPError:
-        print 'Failed to get page from: %s' % (url)
-        sys.exit(-1)
+        result = parse_page(TEST_REVIEWS_PAGE)
+        assert 2 == len(result[0])
+        assert 1 == STATS.stages['parse'][0]
+
+        assert result == parse_page(TEST_REVIEWS_PAGE)
+        assert 2 == STATS.stages['parse'][0]
+
+        assert result == parse_page(TEST_REVIEWS_PAGE, from_cache=True)
+        assert 2 == STATS.stages['parse'][0]
+        assert 1 == STATS.counters['pages_not_parsed']
+    finally:
+        PARSED_PAGES_CACHE = None
+        STATS = original_stats
+
+
+class ReviewsStreamParser(HTMLParser):
+    '''Event based parser for getting all reviews from a page in a single
+    pass over the HTML.
+
+    It creates the same review dictionaries as get_page_reviews and finds
+    the same total as get_reviews_total, without building a tree for the
+    whole page.
+    '''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.reviews = []
+        self.has_next_page = False
+        self.total = None
+        self._navigation_text = None
+        # Depth of open tables, and the depth of the reviews table.
+        self._table_depth = 0
+        self._reviews_table_depth = None
+        self._reviews_table_done = False
+        # Index of the current cell and its first link and sortkey.
+        self._cell = None
+        self._cells = None
+        # Cell field whose first text is captured and the captured text.
+        self._capture = None
+        self._captured_text = None
+
+    def handle_starttag(self, tag, attrs):
+        self._end_capture()
+        attributes = dict(attrs)
+        if attributes.get('id') == 'upper-batch-nav-batchnav-next':
+            self.has_next_page = True
+
+        if tag == 'table':
+            self._table_depth += 1
+            if (self._reviews_table_depth is None and
+                    not self._reviews_table_done and
+                    attributes.get('class') ==
+                    'listing sortable translation-stats'):
+                self._reviews_table_depth = self._table_depth
+            return
+
+        if (tag == 'td' and self.total is None and
+                self._navigation_text is None and
+                attributes.get('class') == 'batch-navigation-index'):
+            self._navigation_text = u''
+
+        if self._table_depth != self._reviews_table_depth:
+            return
+        if tag == 'tr':
+            self._end_row()
+            self._cell = -1
+            self._cells = {}
+        elif tag == 'td' and self._cells is not None:
+            self._cell += 1
+        elif self._cell is None or self._cell < 0:
+            return
+        elif tag == 'a' and (self._cell, 'a') not in self._cells:
+            self._cells[(self._cell, 'href')] = attributes.get('href')
+            self._start_capture((self._cell, 'a'))
+        elif (tag == 'span' and attributes.get('class') == 'sortkey' and
+                (self._cell, 'sortkey') not in self._cells):
+            self._start_capture((self._cell, 'sortkey'))
+
+    def handle_endtag(self, tag):
+        self._end_capture()
+        if tag == 'td' and self._navigation_text is not None:
+            self._set_total()
+        if tag != 'table' or self._table_depth == 0:
+            if tag == 'tr' and self._table_depth == self._reviews_table_depth:
+                self._end_row()
+            return
+        if self._table_depth == self._reviews_table_depth:
+            self._end_row()
+            self._reviews_table_depth = None
+            self._reviews_table_done = True
+        self._table_depth -= 1
+
+    def handle_data(self, data):
+        if self._capture is not None:
+            self._captured_text += data
+        if self._navigation_text is not None:
+            self._navigation_text += data
+
+    def handle_entityref(self, name):
+        # Entities are not converted, just like BeautifulSoup does.
+        self.handle_data(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        self.handle_data(u'&#%s;' % name)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_capture()
+        if self._navigation_text is not None:
+            self._set_total()
+        self._end_row()
+
+    def _start_capture(self, field):
+        '''Start capturing the text of a cell field.'''
+        self._cells[field] = None
+        self._capture = field
+        self._captured_text = u''
+
+    def _end_capture(self):
+        '''Stop capturing text at the first tag.'''
+        if self._capture is None:
+            return
+        if self._captured_text:
+            self._cells[self._capture] = self._captured_text
+        self._capture = None
+        self._captured_text = None
+
+    def _set_total(self):
+        '''Set the total from the batch navigation text.'''
+        match = REVIEWS_TOTAL_PATTERN.search(
+            self._navigation_text.strip('\r\n\t '))
+        if match is not None:
+            self.total = int(match.group(1).replace(',', ''))
+        self._navigation_text = None
+
+    def _end_row(self):
+        '''Add the review from the current row, if it has one.'''
+        cells = self._cells
+        self._cells = None
+        self._cell = None
+        if cells is None or (4, 'a') not in cells:
+            return
+        review = {
+            'name': cells.get((0, 'a')),
+            'nr': int(cells[(4, 'a')]),
+            'url': cells[(4, 'href')],
+            }
+        if (7, 'a') in cells:
+            review['last_editor'] = cells[(7, 'a')]
+            review['date'] = cells.get((6, 'sortkey'))
+        else:
+            review['last_editor'] = u'Nobody'
+            review['date'] = u'Never'
+        self.reviews.append(review)
+
+
+def parse_page_with_stream(content):
+    '''Return a tuple of (reviews, has_next_page, total) for page `content`
+    using ReviewsStreamParser.'''
+    if isinstance(content, str):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            content = content.decode('windows-1252', 'replace')
+    parser = ReviewsStreamParser()
+    parser.feed(content)
+    parser.close()
+    return (parser.reviews, parser.has_next_page, parser.total)
+
+
+def parse_page_with_soup(content):
+    '''Return a tuple of (reviews, has_next_page, total) for page `content`
+    using BeautifulSoup.'''
+    page = BeautifulSoup(content)
+    reviews, has_next_page = get_page_reviews(page)
+    return (reviews, has_next_page, get_reviews_total(page))
+
+
+# Engines used for parsing pages, selected by name using PAGE_PARSER.
+PAGE_PARSERS = {
+    'soup': parse_page_with_soup,
+    'stream': parse_page_with_stream,
+    }
+
+
+def test_parse_page_with_stream():
+    '''Test that the stream parser and BeautifulSoup give the same
+    results.
+    '''
+    navigation = '''
+        <table><tr><td class="batch-navigation-index">
+          <strong>1</strong> &rarr; <strong>150</strong> of 1,234 results
+        </td></tr></table>
+        <a id="upper-batch-nav-batchnav-next">Next</a>
+        '''
+    nobody_row = '''
+        <table class="listing sortable translation-stats">
+        <tr><th>Template</th></tr>
+        <tr>
+          <td><a href="/gedit">gedit &amp; co</a></td>
+          <td>1</td><td></td><td></td>
+          <td><span class="sortkey">2</span><a href="/gedit/+new">2</a></td>
+          <td></td><td>Never</td><td>&mdash;</td>
+        </tr>
+        </table>'''
+    pages = [
+        TEST_REVIEWS_PAGE,
+        navigation + TEST_REVIEWS_PAGE,
+        nobody_row,
+        navigation + nobody_row,
+        '<table class="listing sortable translation-stats"></table>',
+        ]
+    for content in pages:
+        soup_result = parse_page_with_soup(content)
+        stream_result = parse_page_with_stream(content)
+        assert soup_result == stream_result, (soup_result, stream_result)
+    assert 2 == len(parse_page_with_stream(TEST_REVIEWS_PAGE)[0])
+
+
+def benchmark_page_parsers(repeat=20):
+    '''Print the time used by each engine for parsing a batch made of the
+    TEST_REVIEWS_PAGE rows.'''
+    rows = TEST_REVIEWS_PAGE[
+        TEST_REVIEWS_PAGE.index('<tr'):TEST_REVIEWS_PAGE.rindex('</tr>') + 5]
+    # The page has 2 rows with reviews and one without.
+    content = TEST_REVIEWS_PAGE.replace(rows, rows * (BATCH_SIZE // 3))
+    for name in sorted(PAGE_PARSERS):
+        parser = PAGE_PARSERS[name]
+        duration = min(timeit.Timer(lambda: parser(content)).repeat(3, repeat))
+        print '%s: %.2f ms per page' % (name, duration * 1000 / repeat)
 
 
 def get_excluded_templates(templates_raw_list):
@@ -343,33 +897,373 @@ def test_filter_reviews():
     assert (reviews_filter == filtered_reviews)
 
 
-def list_rss(reviews, options):
-    '''Return a RSS2 XML for reviews.'''
-    base_url = REVIEW_BASE_URL % (
-        options.release.lower(), options.language)
+def get_codes(codes_raw_list):
+    '''Parse a comma separated string and return a list of codes.'''
+    codes = [code.strip() for code in codes_raw_list.split(',')]
+    return [code for code in codes if code != '']
+
+
+def test_get_codes():
+    assert ['ro', 'pt_BR', 'de'] == get_codes('ro, pt_BR,,de,')
+
+
+def get_matrix_reviews(language_codes, release_codes, jobs=1):
+    '''Return a list of (release, language, reviews) for all pairs of
+    languages and releases.
+
+    Pairs are fetched using `jobs` concurrent requests, sharing the
+    connections of HTTP_CLIENT. The jobs are split between the pairs and
+    the batches of each pair. Pairs for which a page could not be
+    fetched are not returned.
+    '''
+    pairs = [
+        (release_code, language_code)
+        for language_code in language_codes
+        for release_code in release_codes]
+    pairs_jobs = max(1, min(jobs, len(pairs)))
+    batches_jobs = max(1, jobs // pairs_jobs)
+
+    def get_pair_reviews(pair):
+        release_code, language_code = pair
+        try:
+            reviews = get_all_reviews(
+                language_code, release_code.lower(), batches_jobs)
+        except urllib2.URLError, error:
+            print >> sys.stderr, 'Failed to get reviews for %s %s. %s' % (
+                release_code, language_code, error)
+            STATS.increment('reports_failed')
+            return None
+        return (release_code, language_code, reviews)
+
+    return [
+        report for report in parallel_map(
+            get_pair_reviews, pairs, pairs_jobs)
+        if report is not None]
+
+
+def test_get_matrix_reviews():
+    '''Test getting reviews for all languages and releases.'''
+    global get_all_reviews
+    original_get_all_reviews = get_all_reviews
+    batches_jobs = []
+
+    def fake_get_all_reviews(language_code, release_code, jobs=1):
+        batches_jobs.append(jobs)
+        if language_code == 'fr':
+            raise urllib2.HTTPError(
+                'http://example.com', 500, 'Error', {}, None)
+        return [{'name': '%s-%s' % (release_code, language_code)}]
+
+    get_all_reviews = fake_get_all_reviews
+    try:
+        results = get_matrix_reviews(
+            ['ro', 'fr', 'de'], ['Lucid', 'natty'], 3)
+        # Jobs are split between pairs and batches.
+        assert [1] * 6 == batches_jobs
+        batches_jobs[:] = []
+        get_matrix_reviews(['ro'], ['Lucid'], 3)
+        assert [3] == batches_jobs
+    finally:
+        get_all_reviews = original_get_all_reviews
+    assert [
+        ('Lucid', 'ro', [{'name': 'lucid-ro'}]),
+        ('natty', 'ro', [{'name': 'natty-ro'}]),
+        ('Lucid', 'de', [{'name': 'lucid-de'}]),
+        ('natty', 'de', [{'name': 'natty-de'}]),
+        ] == results
+
+
+def get_report_key(release_code, language_code):
+    '''Return the name identifying the reviews of `release_code` and
+    `language_code`.'''
+    return '%s-%s' % (release_code.lower(), language_code)
+
+
+def get_rss_path(directory, release_code, language_code):
+    '''Return the path of the RSS file for `release_code` and
+    `language_code`.'''
+    name = get_report_key(release_code, language_code) + '.xml'
+    return os.path.join(directory, name)
+
+
+def get_review_fields(review):
+    '''Return the list of review fields which tell if a review changed.'''
+    return [review['name'], review['nr'], review['url'], review['date']]
+
+
+def get_review_guid(review):
+    '''Return the RSS guid of `review`.
+
+    It is the same for all runs, until the review is changed.
+    '''
+    digest = hashlib.sha1(json.dumps(get_review_fields(review)))
+    return u'%s#%s' % (review['url'], digest.hexdigest())
+
+
+def get_reviews_fingerprint(reviews):
+    '''Return a text which is changed only when `reviews` are changed.'''
+    fields = sorted([get_review_fields(review) for review in reviews])
+    return hashlib.sha1(json.dumps(fields)).hexdigest()
+
+
+def test_get_reviews_fingerprint():
+    '''Test that the fingerprint depends only on the review fields.'''
+    unity = {
+        'name': u'unity', 'nr': 4, 'url': u'/unity', 'last_editor': u'Adi',
+        'date': u'2011-04-07'}
+    gedit = {
+        'name': u'gedit', 'nr': 1, 'url': u'/gedit', 'last_editor': u'Ed',
+        'date': u'2011-04-06'}
+    fingerprint = get_reviews_fingerprint([unity, gedit])
+    assert fingerprint == get_reviews_fingerprint([gedit, unity])
+    assert get_review_guid(unity) == get_review_guid(dict(unity))
+    assert get_review_guid(unity).startswith(u'/unity#')
+
+    changed_unity = dict(unity, nr=5)
+    assert fingerprint != get_reviews_fingerprint([changed_unity, gedit])
+    assert get_review_guid(unity) != get_review_guid(changed_unity)
+
+
+class ReviewsHistory(object):
+    '''SQLite history of the suggestions count of each template.
+
+    Counts from each run are stored together with the run time, for each
+    release, language and template.
+    Changes are saved by save() and are dropped when the history is closed
+    without saving them.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS counts ('
+            'release TEXT, '
+            'language TEXT, '
+            'template TEXT, '
+            'run_time REAL, '
+            'nr INTEGER)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS counts_template ON counts '
+            '(release, language, template, run_time)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS counts_run ON counts '
+            '(release, language, run_time)')
+
+    def get_last_counts(self, release, language):
+        '''Return a dictionary with the count of each template from the
+        last run.'''
+        rows = self._connection.execute(
+            'SELECT template, nr FROM counts '
+            'WHERE release = ? AND language = ? AND run_time = ('
+            'SELECT MAX(run_time) FROM counts '
+            'WHERE release = ? AND language = ?)',
+            (release, language, release, language))
+        return dict([(template, nr) for template, nr in rows if nr > 0])
+
+    def get_template_counts(self, release, language, template):
+        '''Return the list of (run_time, count) for `template`, oldest
+        first.'''
+        return self._connection.execute(
+            'SELECT run_time, nr FROM counts '
+            'WHERE release = ? AND language = ? AND template = ? '
+            'ORDER BY run_time',
+            (release, language, template)).fetchall()
+
+    def add(self, release, language, reviews, run_time=None):
+        '''Store the count of all templates from `reviews`.
+
+        Templates from the last run which are no longer in `reviews` are
+        stored with a count of 0.
+        '''
+        if run_time is None:
+            run_time = time.time()
+        counts = self.get_last_counts(release, language)
+        for template in counts:
+            counts[template] = 0
+        for review in reviews:
+            counts[review['name']] = review['nr']
+        self._connection.executemany(
+            'INSERT INTO counts (release, language, template, run_time, nr) '
+            'VALUES (?, ?, ?, ?, ?)', [
+                (release, language, template, run_time, nr)
+                for template, nr in counts.items()])
+
+    def save(self):
+        '''Save all changes.'''
+        self._connection.commit()
+
+    def close(self):
+        '''Close the history, dropping the changes which were not saved.'''
+        self._connection.rollback()
+        self._connection.close()
+
+
+def load_increased_reports(path, reports):
+    '''Return the (release, language, reviews) `reports` with only the
+    reviews which have more suggestions than at the last run saved in the
+    history at `path`.'''
+    history = ReviewsHistory(path)
+    try:
+        return [
+            (release, language, get_increased_reviews(
+                reviews, history.get_last_counts(release.lower(), language)))
+            for release, language, reviews in reports]
+    finally:
+        history.close()
+
+
+def save_reports_history(path, reports, run_time=None):
+    '''Add the counts from the (release, language, reviews) `reports` to
+    the history at `path`.'''
+    history = ReviewsHistory(path)
+    try:
+        for release, language, reviews in reports:
+            history.add(release.lower(), language, reviews, run_time)
+        history.save()
+    finally:
+        history.close()
+
+
+def get_increased_reviews(reviews, last_counts):
+    '''Return reviews for templates with more suggestions than in
+    `last_counts`.
+
+    Each review gets a `delta` with the number of added suggestions.
+    '''
+    results = []
+    for review in reviews:
+        delta = review['nr'] - last_counts.get(review['name'], 0)
+        if delta > 0:
+            results.append(dict(review, delta=delta))
+    return results
+
+
+def test_reviews_history():
+    '''Test keeping the counts history and getting increased reviews.'''
+    unity = {'name': u'unity', 'nr': 4}
+    gedit = {'name': u'gedit', 'nr': 1}
+    history = ReviewsHistory(':memory:')
+    try:
+        assert {} == history.get_last_counts(u'lucid', u'ro')
+        history.add(u'lucid', u'ro', [unity, gedit], run_time=1)
+        history.add(u'lucid', u'de', [unity], run_time=1)
+        last_counts = history.get_last_counts(u'lucid', u'ro')
+        assert {u'unity': 4, u'gedit': 1} == last_counts
+
+        reviews = [{'name': u'unity', 'nr': 6}, {'name': u'vim', 'nr': 2}]
+        assert [
+            {'name': u'unity', 'nr': 6, 'delta': 2},
+            {'name': u'vim', 'nr': 2, 'delta': 2},
+            ] == get_increased_reviews(reviews, last_counts)
+
+        history.add(u'lucid', u'ro', reviews, run_time=2)
+        assert {u'unity': 6, u'vim': 2} == history.get_last_counts(
+            u'lucid', u'ro')
+        assert [(1, 1), (2, 0)] == history.get_template_counts(
+            u'lucid', u'ro', u'gedit')
+        assert {u'unity': 4} == history.get_last_counts(u'lucid', u'de')
+    finally:
+        history.close()
+
+
+def test_reports_history_email_failure():
+    '''Test that an increase is reported again when the email with it
+    could not be sent.'''
+    global SMTP_SESSION
+    original_session = SMTP_SESSION
+    server = LocalSMTPServer()
+    port = server.port
+    server.stop()
+    SMTP_SESSION = SMTPSession('127.0.0.1', port, timeout=5)
+    options = Values({'email': 'to@ex.com', 'email_subject': None})
+    directory = tempfile.mkdtemp()
+    output = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        path = os.path.join(directory, 'history.db')
+        unity = {
+            'name': u'unity', 'nr': 4, 'url': u'/unity',
+            'last_editor': u'Ed', 'date': u'2011-04-07'}
+        save_reports_history(path, [(u'Lucid', u'ro', [unity])])
+        reports = [(u'Lucid', u'ro', [dict(unity, nr=6)])]
+        increased_reports = [(u'Lucid', u'ro', [dict(unity, nr=6, delta=2)])]
+
+        assert increased_reports == load_increased_reports(path, reports)
+        if send_email(increased_reports, options):
+            save_reports_history(path, reports)
+
+        assert increased_reports == load_increased_reports(path, reports)
+        save_reports_history(path, reports)
+        assert [(u'Lucid', u'ro', [])] == load_increased_reports(
+            path, reports)
+    finally:
+        sys.stdout = output
+        SMTP_SESSION.close()
+        SMTP_SESSION = original_session
+        shutil.rmtree(directory)
+
+
+def load_fingerprints(path):
+    '''Return the dictionary of fingerprints saved at `path`.'''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as state_file:
+        return json.load(state_file)
+
+
+def save_fingerprints(path, fingerprints):
+    '''Save the dictionary of `fingerprints` at `path`.'''
+    with AtomicFile(path) as state_file:
+        json.dump(fingerprints, state_file, indent=2, sort_keys=True)
+
+
+def test_fingerprints():
+    '''Test saving and loading fingerprints.'''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'state.json')
+        assert {} == load_fingerprints(path)
+        save_fingerprints(path, {u'lucid-ro': u'abc'})
+        assert {u'lucid-ro': u'abc'} == load_fingerprints(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def list_rss(reviews, release, language, output=None):
+    '''Write a RSS2 XML for reviews to `output`, by default stdout.
+
+    Items are written as they are generated by `reviews`.
+    '''
+    if output is None:
+        output = sys.stdout
+    base_url = REVIEW_BASE_URL % (release.lower(), language)
     title = RSS_TITLE % {
-        'release': options.release,
-        'language': options.language,
+        'release': release,
+        'language': language,
         }
     description = RSS_DESCRIPTION % {
-        'release': options.release,
-        'language': options.language,
+        'release': release,
+        'language': language,
         }
     date = time_to_rfc822()
-    now = time.time()
-    print '<?xml version="1.0"?>'
-    print '<rss version="2.0">'
-    print '<channel>'
-    print '<title>%s</title>' % (title.encode('UTF-8'))
-    print '<link>%s</link>' % (base_url)
-    print '<description>%s</description>' % (description.encode('UTF-8'))
-    print '<language>en-us</language>'
-    print '<pubDate>%s</pubDate>' % date.encode('UTF-8')
-    print '<lastBuildDate>%s</lastBuildDate>' % date.encode('UTF-8')
-    print '<docs>http://blogs.law.harvard.edu/tech/rss</docs>'
-    print '<generator>Translations Review Scraper</generator>'
-    print '<managingEditor>editor@example.com</managingEditor>'
-    print '<webMaster>webmaster@example.com</webMaster>'
+    writer = XMLGenerator(output, 'utf-8')
+    writer.startDocument()
+    writer.startElement(u'rss', {u'version': u'2.0'})
+    writer.ignorableWhitespace(u'\n')
+    writer.startElement(u'channel', {})
+    writer.ignorableWhitespace(u'\n')
+    write_rss_element(writer, u'title', title)
+    write_rss_element(writer, u'link', base_url)
+    write_rss_element(writer, u'description', description)
+    write_rss_element(writer, u'language', u'en-us')
+    write_rss_element(writer, u'pubDate', date)
+    write_rss_element(writer, u'lastBuildDate', date)
+    write_rss_element(
+        writer, u'docs', u'http://blogs.law.harvard.edu/tech/rss')
+    write_rss_element(writer, u'generator', u'Translations Review Scraper')
+    write_rss_element(writer, u'managingEditor', u'editor@example.com')
+    write_rss_element(writer, u'webMaster', u'webmaster@example.com')
 
     for review in reviews:
         description = RSS_ITEM_DESCRIPTION % {
@@ -378,32 +1272,90 @@ def list_rss(reviews, options):
             'date': review['date'],
             'last_editor': review['last_editor'],
             }
-        print '<item>'
-        print '<title>%s - %s</title>' % (
-            review['name'].encode('UTF-8'), review['nr'])
-        print '<link>%s%s</link>' % (
-            TRANSLATIONS_BASE_URL, review['url'])
-        print '<description>%s</description>' % (description.encode('UTF-8'))
-        print '<guid>%s-%f</guid>' % (review['url'], now)
-        print '</item>'
-
-    print '</channel>'
-    print '</rss>'
+        if 'delta' in review:
+            description += RSS_ITEM_DELTA % review
+        writer.startElement(u'item', {})
+        writer.ignorableWhitespace(u'\n')
+        write_rss_element(
+            writer, u'title', u'%s - %s' % (review['name'], review['nr']))
+        write_rss_element(
+            writer, u'link', TRANSLATIONS_BASE_URL + review['url'])
+        write_rss_element(writer, u'description', description)
+        writer.startElement(u'guid', {u'isPermaLink': u'false'})
+        writer.characters(get_review_guid(review))
+        writer.endElement(u'guid')
+        writer.ignorableWhitespace(u'\n')
+        writer.endElement(u'item')
+        writer.ignorableWhitespace(u'\n')
+
+    writer.endElement(u'channel')
+    writer.ignorableWhitespace(u'\n')
+    writer.endElement(u'rss')
+    writer.ignorableWhitespace(u'\n')
+    writer.endDocument()
+
+
+def write_rss_element(writer, name, text):
+    '''Write an element containing only `text`, on its own line.'''
+    writer.startElement(name, {})
+    writer.characters(text)
+    writer.endElement(name)
+    writer.ignorableWhitespace(u'\n')
+
+
+def test_list_rss():
+    '''Test writing reviews as RSS.'''
+    reviews = [{
+        'name': u'unity & <co>', 'nr': 4, 'url': u'/unity?a=1&b=2',
+        'last_editor': u'Adi \u0219', 'date': u'2011-04-07'}]
+    output = StringIO()
+    list_rss(iter(reviews), u'Lucid', u'ro', output)
+
+    document = parseString(output.getvalue())
+    channel = document.getElementsByTagName('channel')[0]
+    assert (u'Ubuntu Lucid translation reviews for ro' ==
+            channel.getElementsByTagName('title')[0].firstChild.data)
+    items = channel.getElementsByTagName('item')
+    assert 1 == len(items)
+    assert (u'unity & <co> - 4' ==
+            items[0].getElementsByTagName('title')[0].firstChild.data)
+    assert (TRANSLATIONS_BASE_URL + u'/unity?a=1&b=2' ==
+            items[0].getElementsByTagName('link')[0].firstChild.data)
+    description = items[0].getElementsByTagName('description')[0]
+    assert u'Adi \u0219' in description.firstChild.data
+    guid = items[0].getElementsByTagName('guid')[0]
+    assert get_review_guid(reviews[0]) == guid.firstChild.data
+
+
+def write_rss(reviews, release, language, path=None):
+    '''Write the RSS for reviews to `path` or to stdout if `path` is None.
+
+    The file at `path` is replaced only after the whole RSS was written.
+    '''
+    with STATS.stage('rss'):
+        if path is None:
+            list_rss(reviews, release, language)
+            return
+        with AtomicFile(path) as output:
+            list_rss(reviews, release, language, output)
 
 
 def reviews_to_string(reviews):
     '''Serialize the reviews array into a human readable string.'''
     results = []
     for review in reviews:
+        count = u'%d' % review['nr']
+        if 'delta' in review:
+            count += u' (+%d)' % review['delta']
         results.append(
             u'Template: %s\n'
-            u'New suggestion: %d\n'
+            u'New suggestion: %s\n'
             u'URL: %s%s\n'
             u'Last reviewer: %s\n'
             u'Last changed date: %s\n'
             '\n' % (
                 review['name'],
-                review['nr'],
+                count,
                 TRANSLATIONS_BASE_URL, review['url'],
                 review['last_editor'],
                 review['date'],
@@ -411,18 +1363,56 @@ def reviews_to_string(reviews):
     return '\n'.join(results)
 
 
-def send_email(reviews, options):
-    '''Send reviews list over email.'''
+def reports_to_string(reports):
+    '''Serialize the (release, language, reviews) reports into a human
+    readable string.'''
+    if len(reports) == 1:
+        return reviews_to_string(reports[0][2])
+    results = []
+    for release, language, reviews in reports:
+        if not reviews:
+            continue
+        title = RSS_TITLE % {'release': release, 'language': language}
+        results.append(u'%s\n%s\n\n%s' % (
+            title, u'=' * len(title), reviews_to_string(reviews)))
+    return u'\n'.join(results)
+
+
+def test_reports_to_string():
+    '''Test serializing reviews from multiple releases and languages.'''
+    review = {
+        'name': u'unity', 'nr': 4, 'url': u'/URL', 'last_editor': u'Adi',
+        'date': u'2011-04-07'}
+    text = reports_to_string([(u'lucid', u'ro', [review])])
+    assert text == reviews_to_string([review])
+
+    text = reports_to_string([
+        (u'lucid', u'ro', [review]),
+        (u'lucid', u'de', []),
+        (u'natty', u'ro', [review]),
+        ])
+    assert u'translation reviews for ro\n' in text
+    assert u'for de' not in text
+    assert 2 == text.count(u'Template: unity')
+
+
+def send_email(reports, options):
+    '''Send the (release, language, reviews) reports list over email.
+
+    A single email containing all reports is sent to each recipient.
+    Return False if an email could not be sent.
+    '''
 
     # Do nothing if there are no new suggestions.
-    reviews_count = len(reviews)
+    reviews_count = sum([len(reviews) for release, language, reviews
+                         in reports])
     if reviews_count < 1:
-        return
+        return True
 
     if not options.email_subject:
         email_main_subject = EMAIL_SUBJECT
     else:
-        email_main_subject = options.subject
+        email_main_subject = options.email_subject
 
     email_subject = u'%s%s' % (EMAIL_TAG, email_main_subject)
 
@@ -430,32 +1420,73 @@ def send_email(reviews, options):
         'Got %d templates with suggestions that needs to be approved.\n\n' % (
             reviews_count))
 
-    email_details = reviews_to_string(reviews)
+    email_details = reports_to_string(reports)
     email_content = message_header + email_details + EMAIL_SIGNATURE
 
-    message = MIMEText(email_content.encode('utf-8'))
-    message['Subject'] = email_subject
+    sent = True
+    for email_address in get_codes(options.email):
+        if not send_email_message(
+                email_content, email_subject, email_address):
+            sent = False
+    return sent
+
+
+def send_email_message(content, subject, to_address):
+    '''Send a text message to `to_address`.
+
+    Return False if it could not be sent or added to MAIL_SPOOL.
+    '''
+    message = MIMEText(content.encode('utf-8'))
+    message['Subject'] = subject
     message['From'] = EMAIL_FROM
-    message['To'] = options.email
+    message['To'] = to_address
+    if MAIL_SPOOL is not None:
+        # Leave the sending to deliver-mail-spool.py.
+        MAIL_SPOOL.add(EMAIL_FROM, [to_address], message.as_string())
+        STATS.increment('emails_spooled')
+        return True
     # Send the message via our own SMTP server, but don't include the
     # envelope header.
-    server = None
     try:
-        server = SMTP(EMAIL_SERVER, EMAIL_PORT)
-        if EMAIL_TLS:
-            server.starttls()
-        if EMAIL_USERNAME:
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        server.sendmail(
-            EMAIL_FROM, [options.email],
-            message.as_string())
-        server.quit()
+        with STATS.stage('email'):
+            SMTP_SESSION.send(EMAIL_FROM, [to_address], message.as_string())
+        STATS.increment('emails_sent')
     except SocketError, error:
         print 'Could not connect to SMTP server. %s' % str(error)
-        return
+        return False
     except SMTPServerDisconnected, error:
         print 'Server does not accepts our credentials.'
-        return
+        return False
+    except SMTPException, error:
+        print 'Could not send email to %s. %s' % (to_address, str(error))
+        return False
+    return True
+
+
+def test_send_email_message_failure():
+    '''Test that a message which could not be sent is reported.'''
+    global SMTP_SESSION
+    original_session = SMTP_SESSION
+    server = LocalSMTPServer()
+    server.rejected_addresses.add('bad@ex.com')
+    SMTP_SESSION = SMTPSession('127.0.0.1', server.port, timeout=5)
+    output = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        assert not send_email_message(u'Content', u'Subject', 'bad@ex.com')
+        assert 'Could not send email to bad@ex.com' in sys.stdout.getvalue()
+        assert send_email_message(u'Content', u'Subject', 'to@ex.com')
+
+        SMTP_SESSION.close()
+        server.stop()
+        assert not send_email_message(u'Content', u'Subject', 'to@ex.com')
+        assert 'Could not connect' in sys.stdout.getvalue()
+    finally:
+        sys.stdout = output
+        SMTP_SESSION.close()
+        SMTP_SESSION = original_session
+        server.stop()
+    assert 1 == len(server.messages)
 
 
 def time_to_rfc822():
@@ -513,18 +1544,43 @@ def get_options_or_print_help():
 
     parser.add_option(
         '-l', '--language', action='store', type="string", dest='language',
-        metavar="LC",
+        metavar="LC1,LC2",
         help=(
-            'Language code for which we should get the reviews.'))
+            'Comma separated language codes for which we should get the '
+            'reviews.'))
     parser.add_option(
         '-r', '--release', action='store', type="string", dest='release',
-        metavar="RELEASE_NAME",
+        metavar="RELEASE1,RELEASE2",
         help=(
-            'Ubuntu release name. Ex. lucid, natty ... etc.'))
+            'Comma separated Ubuntu release names. Ex. lucid, natty ... etc.'))
     parser.add_option(
         '-x', '--exclude-templates', action='store', type='string',
         dest='exclude', default=None, metavar='POT1,POT2',
         help='Exclude the comma separated templates from the result.')
+    parser.add_option(
+        '-j', '--jobs', action='store', type='int', dest='jobs', default=1,
+        metavar='N',
+        help=(
+            'Fetch batches using N concurrent requests, over at most N '
+            'connections. Requests are also limited to %d per second. '
+            'Default 1.' % HTTP_RATE))
+    parser.add_option(
+        '--batch-size', action='store', type='int', dest='batch_size',
+        default=None, metavar='N',
+        help=(
+            'Request N templates in each batch. By default the size is '
+            'adapted to the response time, up to %d.' % BATCH_SIZE_MAX))
+    parser.add_option(
+        '--parser', action='store', type='choice', dest='parser',
+        choices=['soup', 'stream'], default=PAGE_PARSER, metavar='ENGINE',
+        help=(
+            'Engine used for parsing pages: "soup" builds a BeautifulSoup '
+            'tree, "stream" parses reviews in a single pass. '
+            'Default %s.' % PAGE_PARSER))
+    parser.add_option(
+        '--benchmark-parsers', action='store_true',
+        dest='benchmark_parsers', default=False,
+        help='Print the time used by each page parser and exit.')
     parser.add_option(
         '-t', '--run-tests', action='store_true', dest='test', default=False,
         help='Run the (primitive) test suite.')
@@ -534,18 +1590,89 @@ def get_options_or_print_help():
         help='Exit tests on first failure.')
     parser.add_option(
         '-e', '--send-email', action='store', type='string', dest='email',
-        default=None, metavar='EMAIL', help='Send results to EMAIL.')
+        default=None, metavar='EMAIL1,EMAIL2',
+        help='Send all results in a single email to each EMAIL.')
     parser.add_option(
         '--email-subject', action='store', type='string',
         dest='email_subject', default='', metavar='SUBJECT',
         help='Use SUBJECT as email subject.')
+    parser.add_option(
+        '--rss-file', action='store', type='string', dest='rss_file',
+        default=None, metavar='FILE',
+        help='Write the RSS to FILE instead of printing it.')
+    parser.add_option(
+        '--rss-dir', action='store', type='string', dest='rss_dir',
+        default=None, metavar='DIR',
+        help=(
+            'Write the RSS for each release and language to '
+            'DIR/RELEASE-LC.xml instead of printing it.'))
+    parser.add_option(
+        '--state-file', action='store', type='string', dest='state_file',
+        default=None, metavar='FILE',
+        help=(
+            'Remember in FILE the reviews from the last run and only send '
+            'the email and write the RSS files when reviews were changed.'))
+    parser.add_option(
+        '--history-file', action='store', type='string',
+        dest='history_file', default=None, metavar='FILE',
+        help='Keep in FILE the suggestions count of each run.')
+    parser.add_option(
+        '--only-increased', action='store_true', dest='only_increased',
+        default=False,
+        help=(
+            'Only report templates with more suggestions than at the '
+            'previous run, as found in --history-file.'))
+    parser.add_option(
+        '--mail-spool', action='store', type='string', dest='mail_spool',
+        default=None, metavar='DIR',
+        help=(
+            'Add emails to the spool from DIR instead of sending them. '
+            'Use deliver-mail-spool.py for sending them.'))
+    parser.add_option(
+        '--stats-json', action='store', type='string', dest='stats_json',
+        default=None, metavar='FILE',
+        help=(
+            'Save to FILE the time used for fetching, parsing, writing RSS '
+            'and emailing, the number of pages and reviews, and the '
+            'latency of requests.'))
+    parser.add_option(
+        '--profile', action='store', type='string', dest='profile',
+        default=None, metavar='FILE',
+        help=(
+            'Profile the run and save the results to FILE. Use '
+            '"python -m pstats FILE" to view them. Without --profile-stage '
+            'only the main thread is profiled.'))
+    parser.add_option(
+        '--profile-stage', action='store', type='choice',
+        dest='profile_stage', default=None, metavar='STAGE',
+        choices=['fetch', 'parse', 'rss', 'email'],
+        help=(
+            'Only profile STAGE, from all threads. '
+            'STAGE is one of: fetch, parse, rss or email.'))
+    parser.add_option(
+        '--cache-dir', action='store', type='string', dest='cache_dir',
+        default=None, metavar='DIR',
+        help=(
+            'Keep downloaded pages in DIR and only download them again if '
+            'they were changed.'))
+    parser.add_option(
+        '--cache-max-mb', action='store', type='int', dest='cache_max_mb',
+        default=CACHE_MAX_MB, metavar='MB',
+        help=(
+            'Remove least recently used pages when cache is bigger than MB '
+            'megabytes. Default %d.' % CACHE_MAX_MB))
 
     (options, args) = parser.parse_args()
     if len(args) > 0:
         parser.print_help()
         sys.exit(1)
-    else:
-        return options
+    if options.jobs < 1:
+        parser.error('--jobs must be greater than 0.')
+    if options.profile_stage is not None and options.profile is None:
+        parser.error('--profile-stage can only be used with --profile.')
+    if options.batch_size is not None and options.batch_size < 1:
+        parser.error('--batch-size must be greater than 0.')
+    return options
 
 
 if __name__ == "__main__":
@@ -555,17 +1682,105 @@ if __name__ == "__main__":
         run_all_tests(options.test_exit)
         sys.exit(0)
 
+    if options.benchmark_parsers:
+        benchmark_page_parsers()
+        sys.exit(0)
+
+    PAGE_PARSER = options.parser
+    HTTP_CLIENT.max_connections_per_host = options.jobs
+    if options.batch_size:
+        BATCH_SIZER = BatchSizer(size=options.batch_size, fixed=True)
+    else:
+        BATCH_SIZER = BatchSizer()
+
+    if options.mail_spool:
+        MAIL_SPOOL = MailSpool(options.mail_spool)
+
+    if options.cache_dir:
+        # Both caches share the --cache-max-mb limit.
+        reviews_cache_size = int(
+            options.cache_max_mb * 1024 * 1024 * PARSED_PAGES_CACHE_SHARE)
+        HTTP_CLIENT.cache = HTTPCache(DiskCache(
+            options.cache_dir,
+            options.cache_max_mb * 1024 * 1024 - reviews_cache_size))
+        PARSED_PAGES_CACHE = ParsedPagesCache(DiskCache(
+            os.path.join(options.cache_dir, 'reviews'), reviews_cache_size))
+
     if options.language is None or options.release is None:
         print 'Language and release names are required.'
         print 'See --help for usage.'
         sys.exit(2)
-    reviews = get_all_reviews(
-        options.language, options.release.lower())
+    language_codes = get_codes(options.language)
+    release_codes = get_codes(options.release)
+    if (len(language_codes) * len(release_codes) > 1 and
+            options.rss_dir is None):
+        print 'Use --rss-dir for more than one language or release.'
+        sys.exit(2)
+    if options.rss_file and options.rss_dir:
+        print 'Use only one of --rss-file and --rss-dir.'
+        sys.exit(2)
+    if options.only_increased and not options.history_file:
+        print '--only-increased requires --history-file.'
+        sys.exit(2)
 
-    if options.exclude:
-        reviews = filter_reviews(reviews, options.exclude)
+    profiler = None
+    if options.profile:
+        profiler = Profiler(options.profile_stage)
+        STATS.profiler = profiler
+        profiler.start_run()
 
-    if options.email is not None:
-        send_email(reviews, options)
+    reports = get_matrix_reviews(language_codes, release_codes, options.jobs)
+    failed_count = len(language_codes) * len(release_codes) - len(reports)
 
-    list_rss(reviews, options)
+    if options.exclude:
+        reports = [
+            (release, language, filter_reviews(reviews, options.exclude))
+            for release, language, reviews in reports]
+
+    counted_reports = reports
+    if options.only_increased:
+        reports = load_increased_reports(options.history_file, reports)
+
+    previous_fingerprints = {}
+    if options.state_file:
+        previous_fingerprints = load_fingerprints(options.state_file)
+    fingerprints = dict(previous_fingerprints)
+    changed_keys = set()
+    for release, language, reviews in reports:
+        key = get_report_key(release, language)
+        fingerprints[key] = get_reviews_fingerprint(reviews)
+        if previous_fingerprints.get(key) != fingerprints[key]:
+            changed_keys.add(key)
+
+    emails_sent = True
+    if options.email is not None and changed_keys:
+        try:
+            emails_sent = send_email(reports, options)
+        finally:
+            SMTP_SESSION.close()
+
+    for release, language, reviews in reports:
+        rss_path = options.rss_file
+        if options.rss_dir is not None:
+            rss_path = get_rss_path(options.rss_dir, release, language)
+        if (rss_path is not None and os.path.exists(rss_path) and
+                get_report_key(release, language) not in changed_keys):
+            continue
+        write_rss(reviews, release, language, rss_path)
+
+    # Without the new fingerprints, the next run sends the emails again.
+    if options.state_file and emails_sent:
+        save_fingerprints(options.state_file, fingerprints)
+    # Without the new counts, the next run reports the same increase again.
+    if options.history_file and emails_sent:
+        save_reports_history(options.history_file, counted_reports)
+
+    if options.stats_json:
+        STATS.save(options.stats_json)
+    if profiler is not None:
+        profiler.stop_run()
+        if not profiler.save(options.profile):
+            print >> sys.stderr, 'Nothing was profiled.'
+
+    if failed_count or not emails_sent:
+        sys.exit(1)